@@ -0,0 +1,514 @@
+#!/usr/bin/env python3
+# coding: utf-8
+'''Micro-benchmarks for the server hot paths.
+
+Usage: ./benchmark.py [name ...]
+'''
+
+from irc.messages import messages, templates
+from irc.parser import parse_message, decode
+
+from timeit import repeat
+from random import Random
+import sys
+import re
+
+def report(name: str, number: int, seconds: float):
+    '''Print a benchmark result line.'''
+    print('%-40s %10.0f ops/s %8.3f us/op' %
+          (name, number / seconds, seconds / number * 1e6))
+
+def measure(name: str, stmt, number: int = 100000):
+    '''Run stmt number times (best of 5) and report.'''
+    seconds = min(repeat(stmt, number = number, repeat = 5))
+    report(name, number, seconds)
+
+##
+# Message formatting
+##
+class FakeUser(object):
+    nick = 'somenick'
+    username = '~someuser'
+    hostname = '127.0.0.1'
+
+    @property
+    def address(self):
+        return '%s!%s@%s' % (self.nick, self.username, self.hostname)
+
+def bench_templates():
+    '''Compiled templates vs dict %-formatting of the message table.'''
+    servername = 'irc.testnetwork.org'
+    prefix = (':%s ' % servername).encode('utf-8')
+    user = FakeUser()
+    address = '127.0.0.1'
+
+    def legacy(msgid, **params):
+        params['servername'] = servername
+        params['target'] = user.nick
+        params['targetaddr'] = user.address
+        params['ipaddr'] = address
+        return (messages[msgid] % params + '\r\n').encode('utf-8')
+
+    def compiled(msgid, **params):
+        template = templates[msgid]
+        fields = template.fields
+        if 'servername' in fields:
+            params['servername'] = servername
+        if 'target' in fields:
+            params['target'] = user.nick
+        if 'targetaddr' in fields:
+            params['targetaddr'] = user.address
+        if 'ipaddr' in fields:
+            params['ipaddr'] = address
+        return template.render(prefix, params)
+
+    cases = [
+        ('RPL_ENDOFMOTD', {}),
+        ('RPL_TOPIC', {'channel': '#channel', 'topic': 'Some topic'}),
+        ('CMD_PRIVMSG', {'sender': user.address, 'recipient': '#channel',
+                         'text': 'just babbling ' * 8}),
+    ]
+    for msgid, params in cases:
+        assert legacy(msgid, **params) == compiled(msgid, **params)
+        measure('legacy %s' % msgid, lambda: legacy(msgid, **params))
+        measure('compiled %s' % msgid, lambda: compiled(msgid, **params))
+
+##
+# Line parsing
+##
+legacy_regex = re.compile(
+    r'(?P<prefix>:\S+)?'
+    r'[ ]*'
+    r'(?P<command>[a-zA-Z]+|[0-9]{3})'
+    r'[ ]*'
+    r'(?P<params>[\S: ]+)?'
+)
+
+def legacy_parse(data: bytes):
+    '''Regex based parser formerly used by IRCTCPServer.handle_stream.'''
+    data = data.decode('utf-8', 'ignore')
+    data = data.rstrip('\r\n')
+    match = legacy_regex.match(data)
+    if not match:
+        return None
+    prefix, command, param_str = match.groups()
+    if prefix:
+        prefix = prefix.split(':', maxsplit = 1)[1].rstrip()
+    param_str = param_str if param_str else ''
+    params = []
+    autoword = True
+    for word in param_str.split(' '):
+        if not word:
+            continue
+        if autoword or (word[0] == ':'):
+            if word[0] == ':':
+                autoword = False
+                word = word.split(':')[1] if len(word) > 1 else ''
+            params.append(word)
+        else:
+            params[-1] = '%s %s' % (params[-1], word)
+    return prefix, command, params
+
+def random_message(rnd: Random):
+    '''Build a random (prefix, command, params, line) message.'''
+    alphabet = 'abcXYZ019#!@.*-_[]{}\\|^~\x01é€'
+    word = lambda: ''.join(rnd.choice(alphabet)
+                           for _ in range(rnd.randint(1, 12)))
+    prefix = word() if rnd.random() < 0.3 else None
+    command = (rnd.choice(['PRIVMSG', 'notice', 'Join', 'MODE'])
+               if rnd.random() < 0.8 else '%03d' % rnd.randint(0, 999))
+    params = [word() for _ in range(rnd.randint(0, 4))]
+    line = ('%s%s' % ((':%s ' % prefix) if prefix else '', command) +
+            ''.join(' %s' % param for param in params))
+    if rnd.random() < 0.7:
+        trailing = ' '.join(word() if rnd.random() < 0.9 else ''
+                            for _ in range(rnd.randint(0, 40)))
+        if rnd.random() < 0.2:
+            trailing = ':' + trailing
+        params.append(trailing)
+        line += ' :%s' % trailing
+    return prefix, command, params, (line + '\r\n').encode('utf-8')
+
+def check_parser(count: int = 20000):
+    '''Round-trip randomly generated lines through parse_message.'''
+    rnd = Random(0)
+    for _ in range(count):
+        prefix, command, params, line = random_message(rnd)
+        parsed = parse_message(line)
+        assert parsed, line
+        assert decode(parsed[0]) == prefix, line
+        assert parsed[1] == command, line
+        assert [decode(param) for param in parsed[2]] == params, line
+    for line in [b'', b'\r\n', b':prefix', b':prefix ', b'   ', b'12 x',
+                 b'PRIV.MSG x', bytes(range(256)), b':\xff\xfe \xff']:
+        assert parse_message(line) is None, line
+    print('parser: %d random lines round-tripped' % count)
+
+def bench_parser():
+    '''parse_message vs the legacy regex parser, in lines/s.'''
+    check_parser()
+    lines = [
+        b'PING :irc.testnetwork.org\r\n',
+        b'PRIVMSG #channel :just babbling\r\n',
+        b':nick!user@host PRIVMSG #channel :' + b'word ' * 80 + b'\r\n',
+    ]
+    for line in lines:
+        name = line.split(b' :')[0].decode('utf-8')[0 : 24]
+        decoded = lambda: [decode(param)
+                           for param in parse_message(line)[2]]
+        measure('legacy %s (%dB)' % (name, len(line)),
+                lambda: legacy_parse(line))
+        measure('bytes %s (%dB)' % (name, len(line)),
+                lambda: parse_message(line))
+        measure('bytes+decode %s (%dB)' % (name, len(line)), decoded)
+
+##
+# Liveness timers
+##
+def bench_timers(connections: int = 50000, rounds: int = 3):
+    '''Ping/pong timer churn on IOLoop timeouts vs the timer wheel.'''
+    from tornado.ioloop import IOLoop
+    from irc.timers import TimerWheel
+    import time
+
+    callback = lambda: None
+
+    def churn(call_later, remove_timeout):
+        # One ping timer per connection, then rounds of PING (arm the
+        # pong timeout) and PONG (cancel it and arm the next ping)
+        t0 = time.process_time()
+        pings = [call_later(120, callback) for _ in range(connections)]
+        for _ in range(rounds):
+            timeouts = []
+            for ping in pings:
+                remove_timeout(ping)
+                timeouts.append(call_later(60, callback))
+            pings = []
+            for timeout in timeouts:
+                remove_timeout(timeout)
+                pings.append(call_later(120, callback))
+        return time.process_time() - t0
+
+    io_loop = IOLoop()
+    seconds = churn(io_loop.call_later, io_loop.remove_timeout)
+    print('%-40s %8.3f s cpu, heap size %d' %
+          ('IOLoop.call_later', seconds, len(io_loop._timeouts)))
+    io_loop.close()
+
+    io_loop = IOLoop()
+    io_loop.make_current()
+    wheel = TimerWheel()
+    wheel.start()
+    seconds = churn(wheel.call_later, wheel.remove_timeout)
+    print('%-40s %8.3f s cpu, heap size %d, armed %d' %
+          ('TimerWheel.call_later', seconds, len(io_loop._timeouts),
+           len(wheel)))
+    wheel.stop()
+    io_loop.clear_current()
+    io_loop.close()
+
+##
+# NAMES replies
+##
+def bench_names(members: int = 5000):
+    '''Join storm: NAMES payloads rebuilt per join vs the NameList cache.'''
+    from irc.names import NameList
+    import time
+
+    nicks = ['member%d' % i for i in range(members)]
+    capacity = 400
+
+    def rebuild(joined):
+        # Former send_names: annotate, encode and pack every member
+        payloads = []
+        values = []
+        size = -1
+        for nick in joined:
+            bytex = ('@%s' % nick if nick == nicks[0] else nick).encode('utf-8')
+            if values and size + len(bytex) + 1 > capacity:
+                payloads.append(b' '.join(values))
+                values = []
+                size = -1
+            values.append(bytex)
+            size += len(bytex) + 1
+        payloads.append(b' '.join(values))
+        return payloads
+
+    t0 = time.process_time()
+    for i in range(1, members + 1):
+        rebuild(nicks[:i])
+    print('%-40s %8.3f s cpu' % ('rebuild per join', time.process_time() - t0))
+
+    t0 = time.process_time()
+    names = NameList(capacity = capacity)
+    for i, nick in enumerate(nicks):
+        names.set(nick, ('@%s' % nick if i == 0 else nick).encode('utf-8'))
+        names.payloads()
+    print('%-40s %8.3f s cpu' % ('NameList per join', time.process_time() - t0))
+
+##
+# Memory
+##
+class ClosedStream(object):
+    '''Stream stand-in for connections that are never written to.'''
+    def closed(self):
+        return True
+
+def bench_memory(users: int = 100000, joins: int = 3, size: int = 30):
+    '''Bytes per connected user and per channel membership (tracemalloc).'''
+    from irc.server import IRCServer
+    from irc.connection import Connection
+    from irc.user import User
+    import settings
+    import tracemalloc
+
+    server = IRCServer(settings.ircd)
+    server.timers.stop()
+    server.looplag.stop()
+    server.fanout.slice = float('inf') # no IOLoop runs the slices here
+    channels = users * joins // size
+    stream = ClosedStream()
+
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    members = []
+    for i in range(users):
+        connection = Connection(stream, server, '127.0.0.1', i)
+        nick = 'user%d' % i
+        user = User(nick = nick, connection = connection, server = server,
+                    hopcount = 0, username = '~' + nick,
+                    hostname = '127.0.0.1', servername = server.name,
+                    realname = nick)
+        connection.user = user
+        server.users[user.folded] = user
+        members.append(user)
+    used = tracemalloc.get_traced_memory()[0]
+    print('%-40s %8d bytes' % ('per user (%d users)' % users,
+                               (used - base) / users))
+
+    base = used
+    for i, user in enumerate(members):
+        for j in range(joins):
+            server.channels.join(user, '#chan%d' % ((i + j * size // joins)
+                                                    % channels))
+    used = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print('%-40s %8d bytes' % ('per membership (%d channels)' % channels,
+                               (used - base) / (users * joins)))
+
+##
+# Fan-out
+##
+class NullStream(object):
+    '''Stream stand-in discarding writes.'''
+    open = True
+    written = 0
+
+    def closed(self):
+        return not self.open
+
+    def writing(self):
+        return False
+
+    def write(self, data):
+        self.written += 1
+
+    def write_buffer_size(self):
+        return 0
+
+    def close(self):
+        self.open = False
+
+def bench_fanout(channels: int = 100, size: int = 500):
+    '''Longest IOLoop iteration while a user in many large channels quits.'''
+    from irc.server import IRCServer
+    from irc.connection import Connection
+    from irc.user import User
+    from tornado.ioloop import IOLoop
+    import settings
+    import time
+    import gc
+
+    for label, slice in (('quit, unsliced', float('inf')),
+                         ('quit, sliced', settings.ircd['fanoutslice'])):
+        io_loop = IOLoop()
+        io_loop.make_current()
+        server = IRCServer(dict(settings.ircd, chanlimit = size))
+        server.timers.stop()
+        server.looplag.stop()
+        server.fanout.slice = float('inf')
+
+        # Quitter plus size - 1 members in each channel, joined while their
+        # streams are closed so the setup doesn't write anything
+        streams = []
+        def user(nick):
+            stream = NullStream()
+            stream.open = False
+            streams.append(stream)
+            connection = Connection(stream, server, '127.0.0.1', 0)
+            user = User(nick = nick, connection = connection, server = server,
+                        hopcount = 0, username = '~' + nick,
+                        hostname = '127.0.0.1', servername = server.name,
+                        realname = nick)
+            connection.user = user
+            server.users[user.folded] = user
+            return user
+        quitter = user('quitter')
+        for i in range(channels):
+            name = '#chan%d' % i
+            server.channels.join(quitter, name)
+            for j in range(size - 1):
+                server.channels.join(user('user%d_%d' % (i, j)), name)
+        for stream in streams:
+            stream.open = True
+        server.fanout.slice = slice
+
+        stalls = []
+        last = [0.0]
+        def tick():
+            now = time.perf_counter()
+            stalls.append(now - last[0])
+            last[0] = now
+            if server.fanout.jobs or len(stalls) < 3:
+                io_loop.add_callback(tick)
+            else:
+                io_loop.stop()
+        def start():
+            last[0] = time.perf_counter()
+            io_loop.add_callback(tick)
+            quitter.quit('bye')
+        io_loop.add_callback(start)
+        gc.collect()
+        gc.disable() # collections of the setup garbage would dominate
+        t0 = time.perf_counter()
+        io_loop.start()
+        total = time.perf_counter() - t0
+        gc.enable()
+        print('%-40s %8.2f ms longest, %.2f ms total, %d iterations, '
+              '%d writes' % (label, max(stalls) * 1e3, total * 1e3,
+                             len(stalls), sum(s.written for s in streams)))
+        io_loop.clear_current()
+        io_loop.close(all_fds = False)
+
+##
+# Channel journal
+##
+def bench_journal(channels: int = 100000, bans: int = 3):
+    '''Warm restart: indexing a journal of channels and restoring them.'''
+    from irc.server import IRCServer
+    from irc.channel import Channel, ModeItem
+    from irc.journal import ChannelJournal
+    import settings
+    import tempfile
+    import time
+    import os
+    import gc
+
+    server = IRCServer(settings.ircd)
+    server.timers.stop()
+    server.looplag.stop()
+    path = os.path.join(tempfile.mkdtemp(), 'channels.journal')
+
+    journal = ChannelJournal(path = path, fold = server.fold)
+    journal.load()
+    journal.start()
+    for i in range(channels):
+        channel = Channel(name = '#channel%d' % i, catalog = server.channels)
+        channel.topic = 'Topic of channel %d' % i
+        channel.topic_time = time.time()
+        channel.key = 'key%d' % i
+        for j in range(bans):
+            channel.banlist['ban%d!*@*' % j] = ModeItem('op!op@host', 0)
+        journal.dirty.add(channel)
+    t0 = time.perf_counter()
+    journal.close()
+    print('%-40s %8.3f s (%d bytes)' % ('write %d channels' % channels,
+                                        time.perf_counter() - t0,
+                                        os.path.getsize(path)))
+
+    t0 = time.perf_counter()
+    journal = ChannelJournal(path = path, fold = server.fold)
+    journal.load()
+    print('%-40s %8.3f s' % ('load', time.perf_counter() - t0))
+    created = [Channel(name = '#channel%d' % i, catalog = server.channels)
+               for i in range(channels)]
+    gc.collect()
+    gc.disable() # collections of the channels would dominate
+    t0 = time.perf_counter()
+    for channel in created:
+        journal.restore(channel)
+    print('%-40s %8.3f s' % ('restore all', time.perf_counter() - t0))
+    gc.enable()
+    os.unlink(path)
+
+##
+# Welcome burst
+##
+def bench_welcome():
+    '''Registration burst formatted per user vs spliced into bytes.'''
+    from irc.server import IRCServer
+    from irc.connection import Connection
+    from irc.user import User
+    import settings
+
+    class DiscardingConnection(Connection):
+        __slots__ = ()
+
+        def write(self, message: bytes, lines: int = 1):
+            pass
+
+    server = IRCServer(settings.ircd)
+    server.timers.stop()
+    server.looplag.stop()
+    connection = DiscardingConnection(NullStream(), server, '127.0.0.1', 0)
+    user = User(nick = 'somenick', connection = connection, server = server,
+                hopcount = 0, username = '~someuser', hostname = '127.0.0.1',
+                servername = server.name, realname = 'Some User')
+    connection.user = user
+
+    def legacy():
+        user.send_message('RPL_WELCOME')
+        user.send_message('RPL_YOURHOST', version = server.version)
+        user.send_message('RPL_CREATED', date = server.date)
+        user.send_message('RPL_MYINFO', date = server.date,
+                          version = server.version,
+                          usermodes = server.usermodes,
+                          channelmodes = server.channelmodes)
+        user.send_message('RPL_LUSERCLIENT', usercount = len(server.users),
+                          servicescount = 0, serverscount = 1)
+        user.send_message('RPL_LUSERME', usercount = len(server.users),
+                          serverscount = 0)
+        user.send_message('RPL_MOTDSTART')
+        for text in server.settings['motd']:
+            user.send_message('RPL_MOTD',
+                              text = text[0 : min(len(text) + 1, 81)])
+        user.send_message('RPL_ENDOFMOTD')
+
+    def spliced():
+        welcome = server.welcome
+        user.send_splice(welcome.welcome)
+        user.send_splice(welcome.lusers)
+        user.send_splice(welcome.motd)
+
+    measure('welcome burst, formatted', legacy, number = 20000)
+    measure('welcome burst, spliced', spliced, number = 20000)
+
+benchmarks = {
+    'fanout': bench_fanout,
+    'journal': bench_journal,
+    'memory': bench_memory,
+    'names': bench_names,
+    'parser': bench_parser,
+    'timers': bench_timers,
+    'templates': bench_templates,
+    'welcome': bench_welcome,
+}
+
+def main():
+    names = sys.argv[1:] or sorted(benchmarks)
+    for name in names:
+        print('## %s' % name)
+        benchmarks[name]()
+
+if __name__ == '__main__':
+    main()
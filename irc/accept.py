@@ -0,0 +1,129 @@
+# coding: utf-8
+
+from .flood import TokenBucket
+
+from typing import Undefined, Optional, Dict, List, Tuple
+import socket
+
+__all__ = ['PrefixCounts', 'AcceptLimiter']
+
+def parse_address(address: str) -> Tuple[int, int]:
+    '''Integer value and bit length of an IP address. IPv4-mapped IPv6
+    addresses are taken as IPv4.'''
+    if ':' not in address:
+        return int.from_bytes(socket.inet_aton(address), 'big'), 32
+    value = int.from_bytes(socket.inet_pton(socket.AF_INET6,
+                                            address.split('%', 1)[0]), 'big')
+    if value >> 32 == 0xffff:
+        return value & 0xffffffff, 32
+    return value, 128
+
+def parse_network(network: str) -> Tuple[int, int, int]:
+    '''Value, bit length and prefix length of a CIDR network.'''
+    address, _, prefixlen = network.partition('/')
+    value, bits = parse_address(address)
+    prefixlen = int(prefixlen) if prefixlen else bits
+    return value >> (bits - prefixlen), bits, prefixlen
+
+def prefix_key(value: int, bits: int, prefixlen: int) -> int:
+    '''Key of the prefixlen bits network holding address value: network
+    bits, prefix length (8 bits) and family (1 bit), in one integer.'''
+    return (((value >> (bits - prefixlen)) << 8 | prefixlen) << 1 |
+            (bits == 128))
+
+class PrefixCounts(object):
+    '''Counts per address or network prefix, with integer keys (see
+    prefix_key). Zero counts are dropped.'''
+    __slots__ = ('counts',)
+
+    def __init__(self):
+        self.counts = {} # type: Dict[int, int]
+
+    def __len__(self):
+        return len(self.counts)
+
+    def get(self, key: int) -> int:
+        return self.counts.get(key, 0)
+
+    def add(self, key: int):
+        self.counts[key] = self.counts.get(key, 0) + 1
+
+    def remove(self, key: int):
+        count = self.counts.get(key, 0) - 1
+        if count > 0:
+            self.counts[key] = count
+        else:
+            self.counts.pop(key, None)
+
+class AcceptLimiter(object):
+    '''Admission of new connections, before anything is allocated for them.
+
+    Refuses connections past maxperhost open ones from the same address,
+    past maxpernetwork from the same network (networkprefix bits long, for
+    IPv4 and IPv6), or past the server-wide accept rate (acceptrate per
+    second, in bursts of up to acceptburst). None disables a limit.
+    Addresses in the acceptexempt networks are not limited nor counted.
+    '''
+    maxperhost = Undefined(Optional[int])
+    maxpernetwork = Undefined(Optional[int])
+    prefixes = Undefined(Dict[int, int]) # {address bits: network prefix}
+    exempt = Undefined(List[Tuple[int, int, int]])
+    bucket = Undefined(Optional[TokenBucket])
+    counts = Undefined(PrefixCounts)
+
+    def __init__(self, settings: dict):
+        self.maxperhost = settings['maxperhost']
+        self.maxpernetwork = settings['maxpernetwork']
+        prefix4, prefix6 = settings['networkprefix']
+        self.prefixes = {32: prefix4, 128: prefix6}
+        self.exempt = [parse_network(network)
+                       for network in settings['acceptexempt']]
+        self.bucket = None
+        if settings['acceptrate']:
+            self.bucket = TokenBucket(rate = settings['acceptrate'],
+                                      burst = settings['acceptburst'])
+        self.counts = PrefixCounts()
+
+    def _keys(self, address: str) -> Optional[Tuple[int, int]]:
+        '''Address and network keys of address, or None if it\'s exempt.'''
+        value, bits = parse_address(address)
+        for network, netbits, prefixlen in self.exempt:
+            if (netbits == bits and
+                value >> (bits - prefixlen) == network):
+                return None
+        return (prefix_key(value, bits, bits),
+                prefix_key(value, bits, self.prefixes[bits]))
+
+    def admit(self, address: str) -> Optional[str]:
+        '''Count in a connection from address. Returns why it must be
+        refused instead ('host', 'network' or 'rate'), if it must.'''
+        keys = self._keys(address)
+        if keys is None:
+            return None
+        host, network = keys
+        counts = self.counts
+        if (self.maxperhost is not None and
+            counts.get(host) >= self.maxperhost):
+            return 'host'
+        if (self.maxpernetwork is not None and
+            counts.get(network) >= self.maxpernetwork):
+            return 'network'
+        if self.bucket is not None and not self.bucket.take():
+            return 'rate'
+        counts.add(host)
+        counts.add(network)
+        return None
+
+    def add(self, address: str):
+        '''Count in a connection from address without limiting it.'''
+        keys = self._keys(address)
+        if keys is not None:
+            self.counts.add(keys[0])
+            self.counts.add(keys[1])
+
+    def release(self, address: str):
+        '''Count out a closed connection from address.'''
+        keys = self._keys(address)
+        if keys is not None:
+            self.counts.remove(keys[0])
+            self.counts.remove(keys[1])
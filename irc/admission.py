@@ -0,0 +1,102 @@
+# coding: utf-8
+
+from .metrics import MetricsRegistry
+
+from tornado.ioloop import IOLoop
+
+from typing import Undefined, Callable, Dict, Tuple
+from collections import OrderedDict, deque
+
+__all__ = ['RegistrationAdmission']
+
+class RegistrationAdmission(object):
+    '''Bounded window of registrations in progress.
+
+    A registration holds its place in the window until the welcome burst
+    is written out to the client (or for timeout seconds at most). Past
+    window registrations in progress, connections wait their turn: one
+    FIFO queue per source address, the queues being taken round-robin, so
+    a single host reconnecting many clients doesn\'t hold back the rest.
+    '''
+    window = Undefined(int)
+    metrics = Undefined(MetricsRegistry)
+    active = Undefined(Dict['Connection', float]) # {Connection: deadline}
+    queues = Undefined(OrderedDict) # {'address': deque([Connection])}
+    waiting = Undefined(Dict['Connection', Tuple[Callable, float]])
+    check_scheduled = False
+
+    # Seconds a slow client may hold its place in the window
+    timeout = 10.0
+    # Seconds between checks of welcome bursts not written out at once
+    interval = 0.05
+    # Buckets of the histogram of waits for a place, in seconds
+    wait_buckets = (0.001, 0.01, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, window: int, metrics: MetricsRegistry):
+        self.window = window
+        self.metrics = metrics
+        self.active = {}
+        self.queues = OrderedDict()
+        self.waiting = {}
+
+    def __len__(self):
+        return len(self.waiting)
+
+    def admit(self, connection: 'Connection', register: Callable):
+        '''Call register, for connection, now or once its turn comes.'''
+        if connection in self.waiting:
+            return
+        if len(self.active) < self.window and not self.waiting:
+            self._start(connection, register, 0.0)
+            return
+
+        queue = self.queues.get(connection.address)
+        if queue is None:
+            queue = self.queues[connection.address] = deque()
+        queue.append(connection)
+        self.waiting[connection] = (register, IOLoop.current().time())
+        self.metrics.counter('registrations_queued').inc()
+
+    def cancel(self, connection: 'Connection'):
+        '''Forget connection, if still waiting (it's skipped when its
+        turn comes).'''
+        self.waiting.pop(connection, None)
+
+    def _start(self, connection: 'Connection', register: Callable,
+               waited: float):
+        ioloop = IOLoop.current()
+        self.metrics.histogram('registration_wait',
+                               buckets = self.wait_buckets).observe(waited)
+        self.active[connection] = ioloop.time() + self.timeout
+        register()
+        # Runs after the flush of the welcome burst, queued by register
+        if not self.check_scheduled:
+            self.check_scheduled = True
+            ioloop.add_callback(self._check)
+
+    def _check(self):
+        '''Free the places of the registrations done, and give them to the
+        next ones.'''
+        self.check_scheduled = False
+        ioloop = IOLoop.current()
+        now = ioloop.time()
+        for connection, deadline in list(self.active.items()):
+            stream = connection.stream
+            if (stream.closed() or now > deadline or
+                not (connection.sendq or stream.writing())):
+                del self.active[connection]
+
+        while len(self.active) < self.window and self.queues:
+            address, queue = self.queues.popitem(last = False)
+            connection = queue.popleft()
+            if queue:
+                self.queues[address] = queue
+            entry = self.waiting.pop(connection, None)
+            if entry is None or connection.stream.closed():
+                continue
+            register, queued = entry
+            self._start(connection, register, now - queued)
+
+        if self.active and not self.check_scheduled:
+            self.check_scheduled = True
+            ioloop.call_later(self.interval, self._check)
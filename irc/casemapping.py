@@ -0,0 +1,47 @@
+# coding: utf-8
+
+from typing import Undefined, Optional, Callable
+
+__all__ = ['casefolder', 'IdentityIndex']
+
+##
+# Casemappings
+##
+# Characters folded besides letters (RFC 1459 2.2: {}| are the lower case
+# of []\, and ^ of ~ for servers that don't claim to be strict)
+casemappings = {
+    'ascii': {},
+    'rfc1459': str.maketrans('[]\\~', '{}|^'),
+    'strict-rfc1459': str.maketrans('[]\\', '{}|'),
+}
+
+def casefolder(casemapping: str) -> Callable[[str], str]:
+    '''Function folding names according to casemapping.
+
+    Letters are folded with str.lower(), so non-ASCII nicks and channel
+    names compare case insensitively as well.
+    '''
+    if casemapping not in casemappings:
+        raise ValueError('Unknown casemapping: %s' % casemapping)
+    table = casemappings[casemapping]
+    if not table:
+        return str.lower
+    return lambda name: name.lower().translate(table)
+
+class IdentityIndex(dict):
+    '''Dict keyed by casefolded names.
+
+    Keys must already be folded: users and channels keep their folded
+    name in their folded attribute, so the index is used with it as a
+    plain dict. Names coming from clients go through find(), which folds
+    once and looks up once.
+    '''
+    fold = Undefined(Callable[[str], str])
+
+    def __init__(self, fold: Callable[[str], str], *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fold = fold
+
+    def find(self, name: str) -> Optional[object]:
+        '''Value stored for name in any case, or None.'''
+        return self.get(self.fold(name))
@@ -1,36 +1,76 @@
 # coding: utf-8
 
-from .util import LowerCaseDict, log_exceptions
+from .util import log_exceptions
 from .exceptions import *
+from .messages import untargeted, format_message
+from .masks import MaskIndex
+from .names import NameList
+from .casemapping import IdentityIndex
+from .directory import ChannelDirectory
 
-from typing import Undefined, Optional, Tuple, List, Dict, Callable
+from typing import Undefined, Optional, Tuple, List, Dict, Set, Callable
 from datetime import datetime
-from fnmatch import fnmatch
 from collections import namedtuple
 import logging
+import time
 import re
 
 logger = logging.getLogger('tornado.general')
 
 ModeItem = namedtuple('ModeItem', ['author', 'timestamp'])
-ChanUser = namedtuple('ChanUser', ['user', 'operator', 'voice'])
 ModeAttr = namedtuple('ModeAttr', ['param', 'method'])
 
+class Membership(object):
+    '''Membership of user in channel.
+
+    The same record is held in User.channels and Channel.users, so
+    status changes are seen from both sides. banned caches the ban check
+    of the member (None when unknown).
+    '''
+    __slots__ = ('user', 'channel', 'flags', 'banned')
+
+    # flags bits
+    OPERATOR = 1
+    VOICE = 2
+
+    def __init__(self, user: 'User', channel: 'Channel', flags: int = 0):
+        self.user = user # type: User
+        self.channel = channel # type: Channel
+        self.flags = flags
+        self.banned = None # type: Optional[bool]
+
+    def __repr__(self):
+        return '<Membership: %s %s %s>' % (self.channel.name, self.user.nick,
+                                           bin(self.flags))
+
+    @property
+    def operator(self) -> bool:
+        return bool(self.flags & self.OPERATOR)
+
+    @operator.setter
+    def operator(self, value: bool):
+        if value:
+            self.flags |= self.OPERATOR
+        else:
+            self.flags &= ~self.OPERATOR
+
+    @property
+    def voice(self) -> bool:
+        return bool(self.flags & self.VOICE)
+
+    @voice.setter
+    def voice(self, value: bool):
+        if value:
+            self.flags |= self.VOICE
+        else:
+            self.flags &= ~self.VOICE
+
 class Channel(object):
     '''IRC channel'''
-    name = Undefined(str)
-    catalog = Undefined('ChannelCatalog')
-    topic = Undefined(Optional[str])
-    users = Undefined(LowerCaseDict) # users = {'nick': ChanUser}
-    key = Undefined(Optional[str])
-    moderated = False
-    inviteonly = False
-    secret = False
-    banlist = Undefined(Dict[str, ModeItem])
-    invlist = Undefined(Dict[str, ModeItem])
-    exclist = Undefined(Dict[str, ModeItem])
-    limit = Undefined(int)
-    hardlimit = Undefined(int)
+    __slots__ = ('name', 'folded', 'catalog', 'topic', 'topic_time', 'users',
+                 'names', 'key', 'moderated', 'inviteonly', 'secret',
+                 'banlist', 'invlist', 'exclist', 'banmasks', 'invmasks',
+                 'excmasks', 'limit', 'hardlimit')
     _name_regex = re.compile(r'^#\w+$')
     _knownmodes = {
          'b': ModeAttr(param = True,  method = 'mode_ban'),
@@ -45,23 +85,32 @@ class Channel(object):
          'v': ModeAttr(param = True,  method = 'mode_voice'),
     }
     _addrmask_regex = re.compile(
-        r'^((?:[\w?*]+$)|(?:[\w?*]+!))?'              # nickmask or nickmask!
-        r'((?:[a-zA-Z0-9*?]+$)|(?:[a-zA-Z0-9*?]+@))?' # usermask or usermask@
-        r'([a-zA-Z0-9.*?]+)?$'                        # hostmask
+        r'^((?:[\w\[\]\\`^{|}?*-]+$)|(?:[\w\[\]\\`^{|}?*-]+!))?' # nickmask or nickmask!
+        r'((?:[a-zA-Z0-9*?]+$)|(?:[a-zA-Z0-9*?]+@))?'            # usermask or usermask@
+        r'([a-zA-Z0-9.*?]+)?$'                                   # hostmask
     )
 
     def __init__(self, name: str, catalog: 'ChannelCatalog'):
         chanlen_max = catalog.server.settings['chanlen']
         self.set_name(value = name, chanlen_max = chanlen_max)
-        self.catalog = catalog
-        self.topic = None
-        self.users = LowerCaseDict()
-        self.key = None
-        self.banlist = {}
-        self.invlist = {}
-        self.exclist = {}
-        self.limit = None
-        self.hardlimit = catalog.server.settings['chanlimit']
+        self.folded = catalog.fold(self.name)
+        self.catalog = catalog # type: ChannelCatalog
+        self.topic = None # type: Optional[str]
+        self.topic_time = None # type: Optional[float]
+        self.users = IdentityIndex(catalog.fold) # {'nick': Membership}
+        self.names = NameList(capacity = self._names_capacity(catalog.server))
+        self.key = None # type: Optional[str]
+        self.moderated = False
+        self.inviteonly = False
+        self.secret = False
+        self.banlist = {} # type: Dict[str, ModeItem]
+        self.invlist = {} # type: Dict[str, ModeItem]
+        self.exclist = {} # type: Dict[str, ModeItem]
+        self.banmasks = MaskIndex()
+        self.invmasks = MaskIndex()
+        self.excmasks = MaskIndex()
+        self.limit = None # type: Optional[int]
+        self.hardlimit = catalog.server.settings['chanlimit'] # type: int
 
     def set_name(self, value: str, chanlen_max: int):
         '''Set channel name. Raise exception if it\'s invalid.'''
@@ -71,16 +120,67 @@ class Channel(object):
             raise NoSuchChannelError(channel = value)
         self.name = value
 
-    def broadcast_message(self, *args, **kwargs):
-        '''Broadcast message to all channel members.'''
-        for nick in self.users:
-            target = self.users[nick].user
-            target.send_message(*args, **kwargs)
+    def _names_capacity(self, server: 'IRCServer') -> int:
+        '''Room left for nicks in a RPL_NAMREPLY line to any user.'''
+        line = format_message('RPL_NAMREPLY', server.prefix,
+                              {'servername': server.name,
+                               'target': 'x' * server.settings['nicklen'],
+                               'chantype': '=',
+                               'channel': self.name,
+                               'iterator': ''})
+        return 512 - len(line)
+
+    def _update_names(self, membership: Membership):
+        '''Refresh the NAMES entry of a member.'''
+        if membership.operator:
+            entry = '@' + membership.user.nick
+        elif membership.voice:
+            entry = '+' + membership.user.nick
+        else:
+            entry = membership.user.nick
+        self.names.set(membership.user.folded, entry.encode('utf-8'))
+
+    @log_exceptions
+    def broadcast_message(self, msgid: str, exclude: Optional['User'] = None,
+                          **params):
+        '''Broadcast message to all channel members.
+
+        Messages that don't depend on the recipient are serialized once
+        and the same bytes are written to every member\'s connection.
+        '''
+        users = self.users
+        if msgid not in untargeted:
+            for membership in users.values():
+                target = membership.user
+                if target is exclude:
+                    continue
+                target.send_message(msgid, **params)
+            return
+
+        server = self.catalog.server
+        params['servername'] = server.name
+        message = format_message(msgid, server.prefix, params)
+        if len(message) > 512:
+            raise TooLongMessageException(length = len(message))
+
+        self.deliver(message, exclude = exclude)
+        if server.cluster:
+            server.cluster.channel_message(self.name, message)
+
+    def deliver(self, message: bytes, exclude: Optional['User'] = None):
+        '''Write serialized message to every local member.
+
+        Large channels are written to in slices (see FanoutQueue).
+        '''
+        connections = [membership.user.connection
+                       for membership in self.users.values()
+                       if membership.user is not exclude]
+        self.catalog.server.fanout.deliver(message, connections)
 
     def join(self, user: 'User', key: Optional[str] = None):
         '''Joins user to this channel.'''
         # Check if it's already in
-        if user.nick in self.users:
+        if user.folded in self.users:
             return
 
         # Check password
@@ -93,36 +193,34 @@ class Channel(object):
             raise ChannelIsFullError(channel = self.name)
 
         # Check ban list
-        if self._banned(user.address):
+        if self._banned(user):
             raise BannedFromChanError(channel = self.name)
 
         # Check invite
-        lcaddr = user.address.lower()
-        if self.inviteonly:
-            invited = False
-            for mask in self.invlist:
-                logger.info('%s %s', lcaddr, mask)
-                if fnmatch(lcaddr, mask):
-                    logger.info('invited')
-                    invited = True
-                    break
-            if not invited:
-                raise InviteOnlyChanError(channel = self.name)
-
-        # Join user
-        operator = len(self.users) == 0
-        self.users[user.nick] = ChanUser(user = user, operator = operator,
-                                          voice = False)
-        user.channels[self.name] = self
+        if (self.inviteonly and
+            not self.invmasks.match(user.folded_address)):
+            raise InviteOnlyChanError(channel = self.name)
+
+        # Join user (the first one, counting other workers', gets op)
+        founder = not self.users and self.folded not in self.catalog.remote
+        flags = Membership.OPERATOR if founder else 0
+        membership = Membership(user = user, channel = self, flags = flags)
+        self.users[user.folded] = membership
+        user.channels[self.folded] = membership
+        self._update_names(membership)
+        self.catalog.directory.update(self)
         self.broadcast_message('CMD_JOIN',
                                useraddr = user.address,
                                channel = self.name)
+        cluster = self.catalog.server.cluster
+        if cluster:
+            cluster.channel_join(self.name, user.nick)
         self.send_topic(user)
         self.send_names(user)
 
     def part(self, user: 'User', message: str = None):
         '''Parts user from this channel.'''
-        if user.nick not in self.users:
+        if user.folded not in self.users:
             return
         if not message:
             message = ''
@@ -130,32 +228,61 @@ class Channel(object):
                                useraddr = user.address,
                                channel = self.name,
                                message = message)
-        del self.users[user.nick]
-        del user.channels[self.name]
-
+        del self.users[user.folded]
+        self.names.remove(user.folded)
+        del user.channels[self.folded]
+        cluster = self.catalog.server.cluster
+        if cluster:
+            cluster.channel_leave(self.name, user.nick)
+        self._left()
+
+    def quit(self, user: 'User'):
+        '''Removes quitting user from this channel.
+
+        The QUIT line is sent by User.quit(), once to every user sharing a
+        channel with the quitter.
+        '''
+        if user.folded in self.users:
+            del self.users[user.folded]
+            self.names.remove(user.folded)
+        user.channels.pop(self.folded, None)
+        cluster = self.catalog.server.cluster
+        if cluster:
+            cluster.channel_leave(self.name, user.nick)
+        self._left()
+
+    def _left(self):
+        '''Update the directory after a member left; drop empty channel.'''
+        catalog = self.catalog
+        catalog.directory.update(self)
         if len(self.users) == 0:
-            catalog = self.catalog
             self.catalog = None
-            del catalog[self.name]
-            self.server = None
-
-    def quit(self, user: 'User', message: str = None):
-        '''Parts user from this channel.'''
-        if not message:
-            message = ''
-        self.broadcast_message('CMD_QUIT',
-                               useraddr = user.address,
-                               message = message)
-        if user.nick in self.users:
-            del self.users[user.nick]
-        if self.name in user.channels:
-            del user.channels[self.name]
+            del catalog[self.folded]
+            if catalog.journal is not None:
+                catalog.journal.removed(self)
+
+    def _changed(self):
+        '''Save channel state (topic, modes and mask lists).'''
+        if self.catalog.journal is not None:
+            self.catalog.journal.changed(self)
+
+    def rename_user(self, user: 'User', oldkey: str):
+        '''Update membership after user changed nick from folded oldkey.'''
+        membership = self.users.pop(oldkey, None)
+        if membership is None:
+            return
+        membership.banned = None
+        self.users[user.folded] = membership
+        self.names.remove(oldkey)
+        self._update_names(membership)
 
     def set_topic(self, user: 'User', topic: str = ''):
         '''Sets channel topic.'''
-        if not self.users[user.nick].operator:
+        if not self.users[user.folded].operator:
             raise ChanOpsPrivsNeededError(channel = self.name)
         self.topic = topic
+        self.topic_time = time.time()
+        self._changed()
         self.broadcast_message('CMD_TOPIC',
                                useraddr = user.address,
                                channel = self.name,
@@ -172,58 +299,48 @@ class Channel(object):
     @log_exceptions
     def send_names(self, user: 'User', suppress_end = False):
         '''Send current channel members nicks to user.'''
-        users = self.users
-        nicklist = []
-        for nick in users:
-            if users[nick].operator:
-                nicklist.append('@%s' % users[nick].user.nick)
-                continue
-            if users[nick].voice:
-                nicklist.append('+%s' % users[nick].user.nick)
-                continue
-            nicklist.append(users[nick].user.nick)
-
         user.send_message('RPL_NAMREPLY',
                           channel = self.name,
                           chantype = '=',
-                          iterator = nicklist)
+                          chunks = self.names)
+
+        remote = self.catalog.remote.get(self.folded)
+        if remote:
+            user.send_message('RPL_NAMREPLY',
+                              channel = self.name,
+                              chantype = '=',
+                              iterator = remote.values())
 
         if not suppress_end:
             user.send_message('RPL_ENDOFNAMES', channel = self.name)
 
     def send_privmsg(self, sender: str, recipient: str, text: str):
         '''Send PRIVMSG command to channel\'s users.'''
-        sendernick = sender.split('!')[0]
-        if sendernick not in self.users:
+        senderuser = self.users.find(sender.split('!')[0])
+        if senderuser is None:
             raise CannotSendToChanError(channel = self.name)
 
-        senderuser = self.users[sendernick]
         if (self.moderated and
             not senderuser.operator and
             not senderuser.voice):
             raise CannotSendToChanError(channel = self.name)
 
-        if self._banned(senderuser.user.address):
+        if self._banned(senderuser.user):
             raise CannotSendToChanError(channel = self.name)
 
-        for nick in self.users:
-            target = self.users[nick].user
-            if target.address == sender:
-                continue
-            target.send_privmsg(sender = sender, recipient = recipient,
-                                text = text)
+        self.broadcast_message('CMD_PRIVMSG', exclude = senderuser.user,
+                               sender = sender, recipient = recipient,
+                               text = text)
 
     def send_notice(self, sender: str, recipient: str, text: str):
         '''Send NOTICE command to channel\'s users.'''
-        sendernick = sender.split('!')[0]
-        if sendernick not in self.users:
+        senderuser = self.users.find(sender.split('!')[0])
+        if senderuser is None:
             return
 
-        for nick in self.users:
-            target = self.users[nick].user
-            if target.address == sender:
-                continue
-            target.send_notice(sender = sender, recipient = recipient,
+        self.broadcast_message('CMD_NOTICE',
+                               exclude = senderuser.user,
+                               sender = sender, recipient = recipient,
                                text = text)
 
     @log_exceptions
@@ -254,7 +371,7 @@ class Channel(object):
     @log_exceptions
     def mode(self, user: 'User', modes: Tuple[str]):
         '''Process MODE command for channels.'''
-        if user.nick not in self.users:
+        if user.folded not in self.users:
             return
         if not modes:
             self.send_modes(user = user)
@@ -286,27 +403,30 @@ class Channel(object):
     def mode_invite(self, user: 'User', operations: List[Tuple[str, str]]):
         '''Process MODE +I operations'''
         self._mode_list(user = user, operations = operations, char = 'I',
-                        modelist = self.invlist, listmsgid = 'RPL_INVITELIST',
+                        modelist = self.invlist, maskindex = self.invmasks,
+                        listmsgid = 'RPL_INVITELIST',
                         listendmsgid = 'RPL_ENDOFINVITELIST')
 
     @log_exceptions
     def mode_except(self, user: 'User', operations: List[Tuple[str, str]]):
         '''Process MODE +e operations'''
         self._mode_list(user = user, operations = operations, char = 'e',
-                        modelist = self.exclist, listmsgid = 'RPL_EXCEPTLIST',
+                        modelist = self.exclist, maskindex = self.excmasks,
+                        listmsgid = 'RPL_EXCEPTLIST',
                         listendmsgid = 'RPL_ENDOFEXCEPTLIST')
 
     @log_exceptions
     def mode_ban(self, user: 'User', operations: List[Tuple[str, str]]):
         '''Process MODE +b operations'''
         self._mode_list(user = user, operations = operations, char = 'b',
-                        modelist = self.banlist, listmsgid = 'RPL_BANLIST',
+                        modelist = self.banlist, maskindex = self.banmasks,
+                        listmsgid = 'RPL_BANLIST',
                         listendmsgid = 'RPL_ENDOFBANLIST')
 
     @log_exceptions
     def _mode_list(self, user: 'User', operations: List[Tuple[str, str]],
                    char: str, modelist: Dict[str, Tuple[str, int]],
-                   listmsgid: str, listendmsgid: str):
+                   maskindex: MaskIndex, listmsgid: str, listendmsgid: str):
         '''Process MODE +b / +I / +e operations'''
         timestamp = int(datetime.now().timestamp())
         sendlist = False
@@ -317,7 +437,7 @@ class Channel(object):
             if not param: # MODE #chan +x
                 sendlist = True
                 continue
-            if not self.users[user.nick].operator:
+            if not self.users[user.folded].operator:
                 raise ChanOpsPrivsNeededError(channel = self.name)
 
             # Parse mask
@@ -330,21 +450,27 @@ class Channel(object):
             param = ('%s!' % parts[0].rstrip('!')) if parts[0] else '*!'
             param += ('%s@' % parts[1].rstrip('@')) if parts[1] else '*@'
             param += parts[2] if parts[2] else '*'
-            param = param.lower()
+            param = self.catalog.fold(param)
 
             if oper == '+' and param not in modelist: # MODE #chan +x nick!*@*
                 if oper != lastoper: eff_modes.append(oper); lastoper = oper
                 eff_modes.append(char)
                 eff_params.append(param)
                 modelist[param] = ModeItem(user.address, timestamp)
+                maskindex.add(param)
                 continue
             if oper == '-' and param in modelist: # MODE #chan -x nick!*@*
                 if oper != lastoper: eff_modes.append(oper); lastoper = oper
                 eff_modes.append(char)
                 eff_params.append(param)
                 del modelist[param]
+                maskindex.remove(param)
                 continue
         if eff_modes:
+            if char != 'I':
+                for membership in self.users.values():
+                    membership.banned = None
+            self._changed()
             eff_str = '%s %s' % (''.join(eff_modes), ' '.join(eff_params))
             self.broadcast_message('CMD_MODE_CHAN',
                                    useraddr = user.address,
@@ -375,33 +501,31 @@ class Channel(object):
     def _mode_user_bool(self, user: 'User', operations: List[Tuple[str, str]],
                         attrname: str, char: str):
         '''Process MODE +o / +v operations'''
-        if user.nick not in self.users:
+        if user.folded not in self.users:
             return
-        if not self.users[user.nick].operator:
+        if not self.users[user.folded].operator:
             raise ChanOpsPrivsNeededError(channel = self.name)
 
         eff_modes = []
         eff_params = []
         lastoper = None
         for oper, param in operations:
-            if param not in self.users:
+            target = self.users.find(param)
+            if target is None:
                 continue
-            target = self.users[param]
             if oper == '+' and not getattr(target, attrname): # +o nick
                 if oper != lastoper: eff_modes.append(oper); lastoper = oper
                 eff_modes.append(char)
                 eff_params.append(param)
-                userdict = self.users[param]._asdict()
-                userdict[attrname] = True
-                self.users[param] = ChanUser(**userdict)
+                setattr(target, attrname, True)
+                self._update_names(target)
                 continue
             if oper == '-' and getattr(target, attrname): # -o nick
                 if oper != lastoper: eff_modes.append(oper); lastoper = oper
                 eff_modes.append(char)
                 eff_params.append(param)
-                userdict = self.users[param]._asdict()
-                userdict[attrname] = False
-                self.users[param] = ChanUser(**userdict)
+                setattr(target, attrname, False)
+                self._update_names(target)
                 continue
         if eff_modes:
             eff_str = '%s %s' % (''.join(eff_modes), ' '.join(eff_params))
@@ -429,9 +553,9 @@ class Channel(object):
     @log_exceptions
     def _mode_chan_bool(self, user: 'User', operations: List[Tuple[str, str]],
                         attrname: str, char: str):
-        if user.nick not in self.users:
+        if user.folded not in self.users:
             return
-        if not self.users[user.nick].operator:
+        if not self.users[user.folded].operator:
             raise ChanOpsPrivsNeededError(channel = self.name)
 
         eff_modes = []
@@ -448,6 +572,7 @@ class Channel(object):
                 setattr(self, attrname, False)
                 continue
         if eff_modes:
+            self._changed()
             eff_str = ''.join(eff_modes)
             self.broadcast_message('CMD_MODE_CHAN',
                                    useraddr = user.address,
@@ -488,9 +613,9 @@ class Channel(object):
     @log_exceptions
     def _mode_chan_value(self, user: 'User', operations: List[Tuple[str, str]],
                         attrname: str, value_maker: Callable, char: str):
-        if user.nick not in self.users:
+        if user.folded not in self.users:
             return
-        if not self.users[user.nick].operator:
+        if not self.users[user.folded].operator:
             raise ChanOpsPrivsNeededError(channel = self.name)
 
         eff_modes = []
@@ -512,44 +637,89 @@ class Channel(object):
                 setattr(self, attrname, None)
                 continue
         if eff_modes:
+            self._changed()
             eff_str = '%s %s' % (''.join(eff_modes), ' '.join(eff_params))
             self.broadcast_message('CMD_MODE_CHAN',
                                    useraddr = user.address,
                                    channel = self.name,
                                    modes = eff_str)
 
-    def _banned(self, useraddr: str):
-        '''Check if useraddr is banned and not excepted'''
-        lcaddr = useraddr.lower()
-        for mask in self.exclist:
-            if fnmatch(lcaddr, mask):
-                return False
+    def _banned(self, user: 'User'):
+        '''Check if user is banned and not excepted'''
+        membership = self.users.get(user.folded)
+        if membership is not None and membership.banned is not None:
+            return membership.banned
 
-        for mask in self.banlist:
-            if fnmatch(lcaddr, mask):
-                return True
+        lcaddr = user.folded_address
+        banned = (self.banmasks.match(lcaddr) and
+                  not self.excmasks.match(lcaddr))
+        if membership is not None:
+            membership.banned = banned
+        return banned
 
-        return False
-
-class ChannelCatalog(LowerCaseDict):
+class ChannelCatalog(IdentityIndex):
     '''Catalog with all channels within an IRC server/network.'''
     server = Undefined('Server')
+    remote = Undefined(IdentityIndex) # {'#chan': {'nick': 'Nick'}}
+    directory = Undefined(ChannelDirectory)
+    journal = None # ChannelJournal, when channel state is saved
 
     def __init__(self, server: 'Server', *args, **kwargs):
-        super().__init__(*args, **kwargs)
+        super().__init__(server.fold, *args, **kwargs)
         self.server = server
+        self.remote = IdentityIndex(server.fold)
+        self.directory = ChannelDirectory(self)
+
+    def add_remote(self, name: str, nick: str):
+        '''Record nick as member of channel name on another worker.'''
+        members = self.remote.setdefault(self.fold(name),
+                                         IdentityIndex(self.fold))
+        members[self.fold(nick)] = nick
+
+    def remove_remote(self, name: str, nick: str):
+        key = self.fold(name)
+        members = self.remote.get(key)
+        if members is None:
+            return
+        members.pop(self.fold(nick), None)
+        if not members:
+            del self.remote[key]
+
+    def remote_neighbours(self, nick: str) -> Set['Connection']:
+        '''Connections of the local users sharing a channel with nick,
+        connected to another worker.'''
+        key = self.fold(nick)
+        connections = set()
+        for name, members in self.remote.items():
+            if key not in members:
+                continue
+            channel = self.get(name)
+            if channel is not None:
+                connections.update(membership.user.connection
+                                   for membership in channel.users.values())
+        return connections
+
+    def rename_remote(self, oldnick: str, nick: str):
+        oldkey = self.fold(oldnick)
+        for members in self.remote.values():
+            if oldkey in members:
+                del members[oldkey]
+                members[self.fold(nick)] = nick
 
     def join(self, user: 'User', name: str, key: Optional[str] = None):
         '''Add an user to a channel. Returns channel.'''
         # Create or get channel
-        if name in self:
-            channel = self[name]
-        else:
+        channel = self.find(name)
+        created = channel is None
+        if created:
             channel = Channel(name = name, catalog = self)
-            self[name] = channel
+            if self.journal is not None:
+                self.journal.restore(channel)
 
-        # Join
+        # Join (a restored channel may refuse it: only add it once joined)
         if key:
             channel.join(user = user, key = key)
         else:
             channel.join(user = user)
+        if created:
+            self[channel.folded] = channel
@@ -0,0 +1,297 @@
+# coding: utf-8
+
+from .util import log_exceptions
+
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.iostream import IOStream, StreamClosedError
+from tornado.netutil import bind_unix_socket, add_accept_handler
+from tornado import gen
+
+from multiprocessing.managers import BaseManager, DictProxy
+from concurrent.futures import ThreadPoolExecutor
+from typing import Undefined, Optional, Dict
+import threading
+import logging
+import socket
+import time
+import os
+
+logger = logging.getLogger('tornado.general')
+
+__all__ = ['ClusterCoordinator', 'ClusterLink']
+
+##
+# Shared state
+##
+_nicks = {} # {'folded nick': worker id}
+
+def _get_nicks():
+    return _nicks
+
+class ClusterManager(BaseManager):
+    '''Manager serving the state shared by all worker processes.'''
+
+ClusterManager.register('nicks', callable = _get_nicks, proxytype = DictProxy)
+
+class ClusterCoordinator(object):
+    '''Process holding the cluster state, forked before the workers.
+
+    It serves the nick ownership table over a Unix socket in rundir; the
+    same directory holds each worker\'s relay socket.
+    '''
+    rundir = Undefined(str)
+    address = Undefined(str)
+    authkey = Undefined(bytes)
+    pid = Undefined(Optional[int])
+
+    def __init__(self, rundir: str):
+        self.rundir = rundir
+        self.address = os.path.join(rundir, 'state.sock')
+        self.authkey = os.urandom(32)
+        self.pid = None
+
+    def start(self):
+        '''Fork the coordinator process and wait for it to be serving.'''
+        os.makedirs(self.rundir, exist_ok = True)
+        if os.path.exists(self.address):
+            os.unlink(self.address)
+
+        pid = os.fork()
+        if pid:
+            self.pid = pid
+            while not os.path.exists(self.address):
+                time.sleep(0.01)
+            return
+
+        # Coordinator process: serve until the master process goes away
+        parent = os.getppid()
+        def watch_parent():
+            while os.getppid() == parent:
+                time.sleep(1)
+            os._exit(0)
+        threading.Thread(target = watch_parent, daemon = True).start()
+
+        manager = ClusterManager(address = self.address,
+                                 authkey = self.authkey)
+        manager.get_server().serve_forever()
+        os._exit(0)
+
+    def worker_path(self, worker_id: int) -> str:
+        '''Path of the relay socket of worker_id.'''
+        return os.path.join(self.rundir, 'worker-%d.sock' % worker_id)
+
+class ClusterLink(object):
+    '''Link of a worker process to the coordinator and the other workers.
+
+    Nick ownership is kept in the coordinator, so claiming a nick is
+    atomic across workers. The calls to the coordinator are made from a
+    thread of their own, never blocking the IOLoop; each worker keeps a
+    cache of the nicks owned by the others, to route private messages
+    and refuse nicks in use without asking. Channel lines, private
+    messages, nick ownership and channel membership changes are relayed
+    to the other workers as frames over Unix sockets:
+
+        M <channel> <line>      line for the local members of channel
+        P <nick> <line>         line for local user nick
+        U <nick> <line>         line for local users sharing a channel
+                                with nick
+        J <channel> <nick>      nick joined channel on another worker
+        L <channel> <nick>      nick left channel on another worker
+        N <oldnick> <newnick>   nick change on another worker
+        C <nick> <worker id>    nick claimed by worker
+        R <nick> <worker id>    nick released by worker
+
+    Channel modes, topics, mask lists and operator status are kept by
+    each worker for its own members; only membership is shared.
+    '''
+    server = Undefined('IRCServer')
+    coordinator = Undefined(ClusterCoordinator)
+    worker_id = Undefined(int)
+    workers = Undefined(int)
+    nicks = Undefined(DictProxy)
+    executor = Undefined(ThreadPoolExecutor) # calls to the coordinator
+    owners = Undefined(Dict[str, int]) # {'folded nick': other worker id}
+    held = Undefined(Dict[str, int]) # {'folded nick': local claims}
+    peers = Undefined(Dict[int, IOStream])
+
+    def __init__(self, server: 'IRCServer', coordinator: ClusterCoordinator,
+                 worker_id: int, workers: int):
+        self.server = server
+        self.coordinator = coordinator
+        self.worker_id = worker_id
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(1)
+        self.owners = {}
+        self.held = {}
+        self.peers = {}
+
+        manager = ClusterManager(address = coordinator.address,
+                                 authkey = coordinator.authkey)
+        manager.connect()
+        self.nicks = manager.nicks()
+
+        # Drop claims left behind by a previous run of this worker
+        for nick, owner in self.nicks.items():
+            if owner == worker_id:
+                self.nicks.pop(nick, None)
+            else:
+                self.owners[nick] = owner
+
+        # Listen to other workers
+        sock = bind_unix_socket(coordinator.worker_path(worker_id))
+        add_accept_handler(sock, self._on_accept)
+
+        # Exit along with the master process
+        parent = os.getppid()
+        def watch_parent():
+            if os.getppid() != parent:
+                IOLoop.current().stop()
+        PeriodicCallback(watch_parent, 1e3).start()
+
+    ##
+    # Nick ownership
+    ##
+    @gen.coroutine
+    def claim_nick(self, nick: str):
+        '''Claim nick for this worker. Resolves to False if it\'s taken.
+
+        Claims are counted: every successful one must be matched by a
+        release_nick, and the nick is only given up after the last one.
+        '''
+        folded = self.server.fold(nick)
+        if folded in self.held:
+            self.held[folded] += 1
+            return True
+        if folded in self.owners:
+            return False
+        owner = yield self.executor.submit(self.nicks.setdefault, folded,
+                                           self.worker_id)
+        if owner != self.worker_id:
+            self.owners[folded] = owner
+            return False
+        self.held[folded] = self.held.get(folded, 0) + 1
+        if self.held[folded] == 1:
+            self._publish(('C %s %d\n' % (nick, self.worker_id))
+                          .encode('utf-8'))
+        return True
+
+    def release_nick(self, nick: str):
+        '''Drop a claim on nick, made by claim_nick.'''
+        folded = self.server.fold(nick)
+        count = self.held.get(folded, 0) - 1
+        if count > 0:
+            self.held[folded] = count
+            return
+        self.held.pop(folded, None)
+        self.executor.submit(self._release, folded)
+        self._publish(('R %s %d\n' % (nick, self.worker_id))
+                      .encode('utf-8'))
+
+    def _release(self, folded: str):
+        # Runs in the executor, after any claim of folded submitted before
+        if self.nicks.get(folded) == self.worker_id:
+            self.nicks.pop(folded, None)
+
+    ##
+    # Outgoing frames
+    ##
+    def channel_message(self, channel: str, message: bytes):
+        '''Relay a channel line to the other workers.'''
+        self._publish(b'M ' + channel.encode('utf-8') + b' ' + message)
+
+    def neighbour_message(self, nick: str, message: bytes):
+        '''Relay a line for the users sharing a channel with nick.'''
+        self._publish(b'U ' + nick.encode('utf-8') + b' ' + message)
+
+    def channel_join(self, channel: str, nick: str):
+        self._publish(('J %s %s\n' % (channel, nick)).encode('utf-8'))
+
+    def channel_leave(self, channel: str, nick: str):
+        self._publish(('L %s %s\n' % (channel, nick)).encode('utf-8'))
+
+    def nick_change(self, oldnick: str, nick: str):
+        self._publish(('N %s %s\n' % (oldnick, nick)).encode('utf-8'))
+
+    def private_message(self, nick: str, message: bytes) -> bool:
+        '''Relay a line to the worker owning nick, if any.'''
+        owner = self.owners.get(self.server.fold(nick))
+        if owner is None:
+            return False
+        self._publish(b'P ' + nick.encode('utf-8') + b' ' + message,
+                      worker_id = owner)
+        return True
+
+    def _publish(self, frame: bytes, worker_id: Optional[int] = None):
+        '''Send frame to worker_id, or to every other worker.'''
+        targets = (range(self.workers) if worker_id is None
+                   else (worker_id,))
+        for target in targets:
+            if target == self.worker_id:
+                continue
+            stream = self.peers.get(target) or self._connect(target)
+            try:
+                stream.write(frame)
+            except StreamClosedError:
+                self.peers.pop(target, None)
+
+    def _connect(self, worker_id: int) -> IOStream:
+        stream = IOStream(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM))
+        stream.connect(self.coordinator.worker_path(worker_id))
+        stream.set_close_callback(lambda: self._on_peer_close(worker_id,
+                                                              stream))
+        self.peers[worker_id] = stream
+        return stream
+
+    def _on_peer_close(self, worker_id: int, stream: IOStream):
+        if self.peers.get(worker_id) is stream:
+            del self.peers[worker_id]
+        logger.info('Relay link to worker %s closed', worker_id)
+
+    ##
+    # Incoming frames
+    ##
+    def _on_accept(self, connection: socket.socket, address: str):
+        self._read_frames(IOStream(connection))
+
+    @gen.coroutine
+    def _read_frames(self, stream: IOStream):
+        while True:
+            try:
+                frame = yield stream.read_until(b'\n')
+            except StreamClosedError:
+                return
+            self.on_frame(frame)
+
+    @log_exceptions
+    def on_frame(self, frame: bytes):
+        '''Apply a frame received from another worker.'''
+        kind, name, payload = frame.split(b' ', 2)
+        name = name.decode('utf-8')
+        users = self.server.users
+        channels = self.server.channels
+
+        if kind == b'M':
+            channel = channels.find(name)
+            if channel is not None:
+                channel.deliver(payload)
+        elif kind == b'P':
+            user = users.find(name)
+            if user is not None:
+                user.connection.send_raw(payload)
+        elif kind == b'U':
+            connections = channels.remote_neighbours(name)
+            if connections:
+                self.server.fanout.deliver(payload, list(connections))
+        elif kind == b'J':
+            channels.add_remote(name, payload.decode('utf-8').rstrip())
+        elif kind == b'L':
+            channels.remove_remote(name, payload.decode('utf-8').rstrip())
+        elif kind == b'N':
+            channels.rename_remote(name, payload.decode('utf-8').rstrip())
+        elif kind == b'C':
+            self.owners[self.server.fold(name)] = int(payload)
+        elif kind == b'R':
+            folded = self.server.fold(name)
+            # A claim by another worker may have been relayed first
+            if self.owners.get(folded) == int(payload):
+                del self.owners[folded]
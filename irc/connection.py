@@ -1,135 +1,339 @@
 # coding: utf-8
 
 from .user import User
-from .messages import messages
+from .messages import templates
 from .exceptions import *
-from .util import log_exceptions
+from .util import log_exceptions, build_dispatch_table, CommandHandler
+from .parser import decode
+from .timers import Deadline
+from .flood import FloodClass, TokenBucket
 
 from tornado.iostream import IOStream
 from tornado.ioloop import IOLoop
+from tornado.concurrent import Future
+from tornado import gen
 
-from typing import Undefined, List, Optional, Callable
-from random import randint
+from typing import Undefined, List, Optional, Callable, Dict
+from collections import deque
 import logging
-import inspect
 import time
 
 logger = logging.getLogger('tornado.general')
 
 class Connection(object):
-    stream = Undefined(IOStream)
-    address = Undefined(str)
-    port = Undefined(int)
-    server = Undefined('Server')
-    password = Undefined(Optional[str])
-    user = Undefined(Optional[User])
-    req_user = None
-    req_nick = None
-    regtimer = None
+    __slots__ = ('stream', 'address', 'port', 'server', 'password', 'user',
+                 'req_user', 'req_nick', 'regtimer', 'readbuf', 'sendq',
+                 'sendq_size', 'flush_scheduled',
+                 'sendq_exceeded', 'floodclass', 'flood', 'throttled',
+                 'queued', 'closing', 'connected', 'bytes_in', 'bytes_out',
+                 'lines_in', 'lines_out', 'sendq_peak', 'pending', 'reading',
+                 'suspended')
+    commands = Undefined(Dict[str, CommandHandler])
+
+    # Buckets of the histogram of send queue high-water marks, in bytes
+    sendq_peak_buckets = (512, 4096, 16384, 65536, 262144, 1048576, 4194304)
 
     def __init__(self, stream: IOStream, server: 'Server',
                  address: str, port: int):
-        self.stream = stream
-        self.address = address
-        self.port = port
-        self.server = server
-        self.password = None
-        self.user = None
+        self.stream = stream # type: IOStream
+        self.address = address # type: str
+        self.port = port # type: int
+        self.server = server # type: Server
+        self.password = None # type: Optional[str]
+        self.user = None # type: Optional[User]
+        self.req_user = None # type: Optional[Dict[str, str]]
+        self.req_nick = None # type: Optional[str]
+        self.regtimer = None # type: Optional[Deadline]
+        self.readbuf = b''
+        self.sendq = [] # type: List[bytes]
+        self.sendq_size = 0
+        self.flush_scheduled = False
+        self.sendq_exceeded = False
+        self.floodclass = server.flood_class(address) # type: FloodClass
+        self.flood = self.floodclass.bucket() # type: Optional[TokenBucket]
+        self.throttled = False
+        self.queued = 0 # messages waiting in server.fanout
+        self.closing = False
+        self.connected = time.time()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.lines_in = 0
+        self.lines_out = 0
+        self.sendq_peak = 0 # bytes
+        self.pending = deque() # lines read but not processed yet
+        self.reading = None # type: Optional[Future]
+        self.suspended = None # type: Optional[Future]
 
         # Set timeout for registering
-        self.regtimer = IOLoop.current().call_later(
+        self.regtimer = self.server.timers.call_later(
                             self.server.settings['pingtimeout'],
-                            self.stream.close)
+                            self.close)
 
     ##
     # Events
     ##
-    def on_read(self, prefix: str, command: str, params: List[str]):
-        '''Process message received from connection.'''
-        # Created method name
-        methodname = 'cmd_%s' % command.lower()
+    def on_read(self, prefix: Optional[memoryview], command: str,
+                params: List[memoryview]):
+        '''Process message received from connection.
+
+        prefix and params are undecoded fields from parse_message; only
+        the ones the handler takes get decoded.
+        '''
+        if self.closing:
+            return
+        command = command.upper()
 
         # Process command
-        client = (self.user.address
-                 if self.user
-                 else '%s:%s' % (self.address, self.port))
-        action_name = '%s %s' % (client, command.upper())
-
-        if self.user and hasattr(self.user, methodname):
-            self.take_action(action_name, self._call_user_method,
-                             command, params)
-        elif hasattr(self, methodname):
-            self.take_action(action_name, self._call_conn_method,
-                             prefix, command, params)
+        handler = self.user.commands.get(command) if self.user else None
+        if handler:
+            self.take_action(command, self._call_user_method,
+                             handler, command, params)
+            return
+
+        handler = self.commands.get(command)
+        if handler:
+            self.take_action(command, self._call_conn_method,
+                             handler, prefix, command, params)
         else:
             self.send_message(msgid = 'ERR_UNKNOWNCOMMAND',
-                              command = command.upper())
+                              command = command)
 
     def on_close(self):
         '''Deals with a connection closed event.'''
+        self.server.connections.discard(self)
+        self.server.limiter.release(self.address)
+        metrics = self.server.metrics
+        metrics.counter('bytes_in').inc(self.bytes_in)
+        metrics.counter('bytes_out').inc(self.bytes_out)
+        metrics.counter('lines_in').inc(self.lines_in)
+        metrics.counter('lines_out').inc(self.lines_out)
+        metrics.histogram('sendq_peak_bytes',
+                          buckets = self.sendq_peak_buckets).observe(
+                              self.sendq_peak)
+        if self.regtimer:
+            self.server.timers.remove_timeout(self.regtimer)
+            self.regtimer = None
         if self.user:
             self.user.on_close()
+        else:
+            self.server.admission.cancel(self)
 
     ##
     # Server initiated actions
     ##
     def take_action(self, name: str, method: Callable, *args: list, **kwargs: dict):
-        '''Calls method wrapped in error handling and logging structure.'''
+        '''Calls method wrapped in error handling and metrics structure.
+
+        Every call is counted under name; calls picked by the metrics
+        sampling are also timed, and logged if logcommands is set.
+        '''
+        metrics = self.server.metrics
+        metrics.counter('commands', name).inc()
+        timed = metrics.sampled()
+
         # Process command
-        t0 = time.monotonic()
+        t0 = time.monotonic() if timed else 0
         try:
             method(*args, **kwargs)
         except CommandError as e:
             self.send_message(msgid = e.msgid, **e.msgparams)
         finally:
-            t1 = time.monotonic()
-            elapsed = format((t1 - t0) * 1e3, '.2f')
-            logger.info('%s %sms', name, elapsed)
+            if timed:
+                elapsed = time.monotonic() - t0
+                metrics.histogram('command_latency', name).observe(elapsed)
+                if self.server.settings['logcommands']:
+                    client = (self.user.address
+                             if self.user
+                             else '%s:%s' % (self.address, self.port))
+                    logger.info('%s %s %sms', client, name,
+                                format(elapsed * 1e3, '.2f'))
+
+    def suspend(self, future: Future, callback: Callable):
+        '''Stop processing commands until future resolves, then call
+        callback with its result. Command errors it raises are sent to
+        the connection, as from take_action.'''
+        resumed = Future()
+        def resume(future):
+            try:
+                callback(future.result())
+            except CommandError as e:
+                self.send_message(msgid = e.msgid, **e.msgparams)
+            except Exception:
+                logger.error('Suspended command failed', exc_info = True)
+            finally:
+                self.suspended = None
+                resumed.set_result(None)
+        self.suspended = resumed
+        IOLoop.current().add_future(future, resume)
 
     @log_exceptions
     def send_message(self, msgid: str, **params):
         '''Send message to connection.'''
         if self.stream.closed():
             return
-        params['servername'] = self.server.name
-        params['target'] = self.user.nick if self.user else '*'
-        params['targetaddr'] = self.user.address if self.user else '*'
-        params['ipaddr'] = self.address
-
-        iterator = None
-        if 'iterator' in params:
-            iterator = params['iterator']
-            params['iterator'] = '\aiterator\a'
-
-        message = messages[msgid] % params + '\r\n'
-        message = message.encode('utf-8')
-
-        def stream_write(message):
+        template = templates[msgid]
+        fields = template.fields
+        user = self.user
+        if 'servername' in fields:
+            params['servername'] = self.server.name
+        if 'target' in fields:
+            params['target'] = user.nick if user else '*'
+        if 'targetaddr' in fields:
+            params['targetaddr'] = user.address if user else '*'
+        if 'ipaddr' in fields:
+            params['ipaddr'] = self.address
+
+        iterator = params.pop('iterator', None)
+        chunks = params.pop('chunks', None)
+        if iterator is None and chunks is None:
+            message = template.render(self.server.prefix, params)
             if len(message) > 512:
                 raise TooLongMessageException(length = len(message))
-            self.stream.write(message)
-
-        if not iterator:
-            stream_write(message)
+            self.write(message)
             return
 
+        params['iterator'] = '\aiterator\a'
+        message = template.render(self.server.prefix, params)
+        head, tail = message.split(b'\aiterator\a')
+        room = 512 - len(head) - len(tail)
+
+        # Prebuilt payloads are packed for the longest possible target
+        if chunks is not None:
+            if chunks.capacity <= room:
+                for payload in chunks.payloads():
+                    self.write(head + payload + tail)
+                return
+            iterator = chunks.entries()
+
         values = []
-        valsize = 0
+        valsize = -1 # no space before the first value
         for x in iterator:
-            bytex = x.encode('utf-8')
-            bytexsize = len(bytex) + 1
-            if len(message) + valsize + bytexsize > 513: # no trailling space
-                ready = message.replace(b'\aiterator\a', b' '.join(values))
+            bytex = x.encode('utf-8') if isinstance(x, str) else x
+            if values and valsize + len(bytex) + 1 > room:
+                self.write(head + b' '.join(values) + tail)
                 values = []
-                valsize = 0
-                stream_write(ready)
-            else:
-                values.append(bytex)
-                valsize += len(bytex) + 1
-        if not values:
+                valsize = -1
+            values.append(bytex)
+            valsize += len(bytex) + 1
+        if values:
+            self.write(head + b' '.join(values) + tail)
+
+    def send_raw(self, message: bytes, lines: int = 1):
+        '''Send already serialized message (or lines) to connection.'''
+        if self.stream.closed():
+            return
+        self.write(message, lines = lines)
+
+    def write(self, message: bytes, lines: int = 1):
+        '''Queue message to be written at the end of this IOLoop iteration.
+
+        Messages go behind the server fan-out deliveries still queued for
+        this connection, if any.
+        '''
+        if self.queued:
+            self.server.fanout.enqueue(message, [self], lines = lines)
             return
-        ready = message.replace(b'\aiterator\a', b' '.join(values))
-        stream_write(ready)
+        self.push(message, lines = lines)
+
+    def push(self, message: bytes, lines: int = 1):
+        '''Add message to the send queue.
+
+        Everything queued during an iteration goes out in a single
+        stream write. Connections whose send queue (queued plus not yet
+        sent bytes) grows past settings['sendq'] are disconnected.
+        '''
+        if self.sendq_exceeded:
+            return
+        size = len(message)
+        self.sendq.append(message)
+        self.sendq_size += size
+        self.bytes_out += size
+        self.lines_out += lines
+
+        pending = self.backlog()
+        if pending > self.sendq_peak:
+            self.sendq_peak = pending
+        if pending > self.server.settings['sendq']:
+            self.sendq_exceeded = True
+            self.sendq = []
+            self.sendq_size = 0
+            self.server.metrics.counter('sendq_exceeded').inc()
+            IOLoop.current().add_callback(self.drop, 'SendQ exceeded')
+            return
+
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            IOLoop.current().add_callback(self.flush)
+
+    def flush(self):
+        '''Write queued messages to stream.'''
+        self.flush_scheduled = False
+        if not self.sendq:
+            return
+        data = b''.join(self.sendq)
+        self.sendq = []
+        self.sendq_size = 0
+        if self.stream.closed():
+            return
+
+        self.server.metrics.counter('writes').inc()
+        self.stream.write(data)
+
+    def backlog(self) -> int:
+        '''Bytes queued or still in the stream write buffer.'''
+        # stream is a MeteredIOStream (see IRCTCPServer.make_stream)
+        return self.sendq_size + self.stream.write_buffer_size()
+
+    def close(self):
+        '''Flush queued messages and close stream.
+
+        With fan-out deliveries still queued, the connection stops
+        processing commands and is closed once they are written.
+        '''
+        if self.queued and not self.stream.closed():
+            self.closing = True
+            return
+        self.flush()
+        self.stream.close()
+
+    def drop(self, reason: str):
+        '''Disconnect a connection the server gave up on.'''
+        logger.info('Dropping %s:%s: %s', self.address, self.port, reason)
+        if self.user:
+            self.user.quit(message = reason)
+        else:
+            self.close()
+
+    def set_flood_class(self, name: str):
+        '''Move connection to flood class name, with a full bucket.'''
+        floodclass = self.server.floodclasses.get(name)
+        if floodclass is None or floodclass is self.floodclass:
+            return
+        self.floodclass = floodclass
+        self.flood = floodclass.bucket()
+        self.throttled = False
+
+    def charge(self, command: str) -> float:
+        '''Take the penalty of command from the flood bucket. Returns how
+        many seconds reading must pause for (0.0 if none).'''
+        if self.flood is None:
+            return 0.0
+        return self.flood.consume(self.floodclass.penalty(command.upper()))
+
+    def throttle(self, delay: float) -> 'Future':
+        '''Count a flood pause of delay seconds. Returns a Future resolved
+        once it is over.'''
+        self.server.metrics.counter('flood_throttled',
+                                    self.floodclass.name).inc()
+        self.throttled = True
+        return gen.sleep(delay)
+
+    def is_throttled(self) -> bool:
+        '''Whether flood control paused connection and its bucket hasn\'t
+        refilled since.'''
+        if self.throttled and self.flood.level() >= self.flood.burst:
+            self.throttled = False
+        return self.throttled
 
     def register_user(self):
         '''Creates new user and adds it to server user\'s list.'''
@@ -140,7 +344,31 @@ class Connection(object):
             raise AlreadyRegisteredError()
 
         def do_register():
-            self.user = User(nick = self.req_nick, server = self.server,
+            cluster = self.server.cluster
+            if cluster is None:
+                create_user(self.req_nick)
+                return
+
+            # Claim the nick across the cluster first
+            nick = User.parse_nick(self.req_nick,
+                                   self.server.settings['nicklen'])
+            if self.server.fold(nick) in self.server.users:
+                raise NicknameInUseError(nick)
+            def claimed(success: bool):
+                if not success:
+                    raise NicknameInUseError(nick)
+                if self.stream.closed():
+                    cluster.release_nick(nick)
+                    return
+                try:
+                    create_user(nick)
+                except CommandError:
+                    cluster.release_nick(nick)
+                    raise
+            self.suspend(cluster.claim_nick(nick), claimed)
+
+        def create_user(nick: str):
+            self.user = User(nick = nick, server = self.server,
                              connection = self, hopcount = 0,
                              username = '~' + self.req_user['username'],
                              hostname = self.address,
@@ -148,64 +376,48 @@ class Connection(object):
                              realname = self.req_user['realname'])
             self.req_nick = None
             self.req_user = None
-            self.server.users[self.user.nick] = self.user
+            self.server.users[self.user.folded] = self.user
 
             # Remove register timeout timer
             if self.regtimer:
-                IOLoop.current().remove_timeout(self.regtimer)
+                self.server.timers.remove_timeout(self.regtimer)
                 self.regtimer = None
 
             # Call user on_register event
             self.user.on_register()
 
         register_action = lambda: self.take_action('REGUSER', do_register)
-
-        wait_time = randint(0, 5)
-        IOLoop.current().call_later(wait_time, register_action)
+        self.server.admission.admit(self, register_action)
 
 
     ##
     # Command processing auxiliary methods
     ##
-    def _call_conn_method(self, prefix: str, command: str, params: list):
+    def _call_conn_method(self, handler: CommandHandler,
+                          prefix: Optional[memoryview], command: str,
+                          params: list):
         '''Process command by calling method on Connection.'''
-        methodname = 'cmd_%s' % command.lower()
-        method = getattr(self, methodname)
-
-        # Check method args
-        args, varargs, _, defaults, _, _, _ = inspect.getfullargspec(method)
-        argnum = len(args) if args else 0
-        defnum = len(defaults) if defaults else 0
-
         # Check if we have enough parameters to call method
-        if len(params) < argnum - defnum - 2:
-            raise NeedMoreParamsError(command = command.upper())
+        if len(params) < handler.minparams:
+            raise NeedMoreParamsError(command = command)
 
         # Call method
-        if not varargs:
-            method(prefix, *params[0 : argnum - 2])
-        else:
-            method(prefix, *params)
+        if not handler.varargs:
+            params = params[0 : handler.maxparams]
+        handler.function(self, decode(prefix),
+                         *[decode(param) for param in params])
 
-    def _call_user_method(self, command: str, params: list):
+    def _call_user_method(self, handler: CommandHandler, command: str,
+                          params: list):
         '''Process command by calling method on User.'''
-        methodname = 'cmd_%s' % command.lower()
-        method = getattr(self.user, methodname)
-
-        # Check method args
-        args, varargs, _, defaults, _, _, _ = inspect.getfullargspec(method)
-        argnum = len(args) if args else 0
-        defnum = len(defaults) if defaults else 0
-
         # Check if we have enough parameters to call method
-        if len(params) < argnum - defnum - 1:
-            raise NeedMoreParamsError(command = command.upper())
+        if len(params) < handler.minparams:
+            raise NeedMoreParamsError(command = command)
 
         # Call method
-        if not varargs:
-            method(*params[0 : argnum - 1])
-        else:
-            method(*params)
+        if not handler.varargs:
+            params = params[0 : handler.maxparams]
+        handler.function(self.user, *[decode(param) for param in params])
 
     ##
     # User initiated actions
@@ -223,3 +435,6 @@ class Connection(object):
         self.req_user = {'username': username, 'mode': mode,
                          'realname': realname}
         self.register_user()
+
+# Commands handled before registration: {'NICK': CommandHandler, ...}
+Connection.commands = build_dispatch_table(Connection, skip = 2)
@@ -0,0 +1,121 @@
+# coding: utf-8
+
+from .masks import MaskIndex
+
+from typing import Undefined, List, Dict, Set
+import time
+
+__all__ = ['ChannelDirectory']
+
+class ChannelDirectory(object):
+    '''Channels indexed by member count, for LIST.
+
+    Channels are kept in one bucket per member count and moved between
+    buckets as members join and leave, so size conditions only look at
+    the buckets in range and results come out largest channels first.
+    '''
+    catalog = Undefined('ChannelCatalog')
+    sizes = Undefined(Dict['Channel', int])
+    buckets = Undefined(Dict[int, Set['Channel']])
+
+    def __init__(self, catalog: 'ChannelCatalog'):
+        self.catalog = catalog
+        self.sizes = {}
+        self.buckets = {}
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def update(self, channel: 'Channel'):
+        '''Refile channel after its member count changed.'''
+        size = len(channel.users)
+        oldsize = self.sizes.get(channel)
+        if size == oldsize:
+            return
+        if oldsize is not None:
+            self._unfile(channel, oldsize)
+        if not size:
+            del self.sizes[channel]
+            return
+        self.sizes[channel] = size
+        self.buckets.setdefault(size, set()).add(channel)
+
+    def remove(self, channel: 'Channel'):
+        oldsize = self.sizes.pop(channel, None)
+        if oldsize is not None:
+            self._unfile(channel, oldsize)
+
+    def _unfile(self, channel: 'Channel', size: int):
+        bucket = self.buckets[size]
+        bucket.discard(channel)
+        if not bucket:
+            del self.buckets[size]
+
+    def search(self, conditions: str = '') -> List['Channel']:
+        '''Channels matching LIST conditions, largest first.
+
+        conditions is a comma separated list of channel names, masks
+        (!mask excludes) and ELIST conditions: >n and <n members, T>n and
+        T<n for topics set more and less than n minutes ago.
+        '''
+        minsize = 1
+        maxsize = None
+        names = []
+        masks = MaskIndex()
+        nomasks = MaskIndex()
+        topic_before = topic_after = None
+        now = time.time()
+        fold = self.catalog.fold
+
+        for cond in conditions.split(','):
+            if not cond:
+                continue
+            try:
+                if cond[0] == '>':
+                    minsize = max(minsize, int(cond[1:]) + 1)
+                elif cond[0] == '<':
+                    maxsize = int(cond[1:]) - 1
+                elif cond[:2] in ('T>', 't>'):
+                    topic_before = now - int(cond[2:]) * 60
+                elif cond[:2] in ('T<', 't<'):
+                    topic_after = now - int(cond[2:]) * 60
+                elif cond[0] == '!':
+                    nomasks.add(fold(cond[1:]))
+                elif '*' in cond or '?' in cond:
+                    masks.add(fold(cond))
+                else:
+                    names.append(cond)
+            except ValueError:
+                continue
+
+        if names:
+            found = (self.catalog.find(name) for name in names)
+            candidates = [channel for channel in found
+                          if channel is not None and channel in self.sizes]
+        else:
+            candidates = []
+            for size in sorted(self.buckets, reverse = True):
+                if size < minsize:
+                    break
+                if maxsize is None or size <= maxsize:
+                    candidates.extend(self.buckets[size])
+
+        matches = []
+        for channel in candidates:
+            size = self.sizes[channel]
+            if size < minsize or (maxsize is not None and size > maxsize):
+                continue
+            if masks and not masks.match(channel.folded):
+                continue
+            if nomasks and nomasks.match(channel.folded):
+                continue
+            if topic_before is not None or topic_after is not None:
+                topic_time = channel.topic_time
+                if topic_time is None:
+                    continue
+                if topic_before is not None and topic_time > topic_before:
+                    continue
+                if topic_after is not None and topic_time < topic_after:
+                    continue
+            matches.append(channel)
+        return matches
@@ -108,6 +108,13 @@ class AlreadyRegisteredError(CommandError):
         self.msgid = 'ERR_ALREADYREGISTRED'
         self.msgparams = {}
 
+class PasswdMismatchError(CommandError):
+    '''464 - Password incorrect'''
+    def __init__(self):
+        super().__init__()
+        self.msgid = 'ERR_PASSWDMISMATCH'
+        self.msgparams = {}
+
 class ChannelIsFullError(CommandError):
     '''471 - Cannot join channel (+l)'''
     def __init__(self, channel: str):
@@ -136,6 +143,13 @@ class BadChannelKeyError(CommandError):
         self.msgid = 'ERR_BADCHANNELKEY'
         self.msgparams = {'channel': channel}
 
+class NoPrivilegesError(CommandError):
+    '''481 - Permission Denied- You\'re not an IRC operator'''
+    def __init__(self):
+        super().__init__()
+        self.msgid = 'ERR_NOPRIVILEGES'
+        self.msgparams = {}
+
 class ChanOpsPrivsNeededError(CommandError):
     '''482 - You\'re not channel operator'''
     def __init__(self, channel: str):
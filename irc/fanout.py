@@ -0,0 +1,93 @@
+# coding: utf-8
+
+from .metrics import MetricsRegistry
+
+from tornado.ioloop import IOLoop
+
+from typing import Undefined, List
+from collections import deque
+
+__all__ = ['FanoutQueue']
+
+class FanoutQueue(object):
+    '''Delivery of serialized messages to many connections, in slices.
+
+    Up to slice writes per IOLoop iteration are done right away; past
+    that, deliveries are queued and written slice writes at a time, from
+    IOLoop callbacks, so other connections are served in between.
+
+    Queued deliveries go out in FIFO order. Connections keep count of the
+    messages queued for them (Connection.queued) and send everything
+    else through the queue too while it isn\'t zero, so each connection
+    still gets its messages in the order they were sent.
+    '''
+    slice = Undefined(int)
+    metrics = Undefined(MetricsRegistry)
+    jobs = Undefined(deque) # deque([[message, lines, connections, position]])
+    spent = 0
+    scheduled = False
+    reset_scheduled = False
+
+    def __init__(self, slice: int, metrics: MetricsRegistry):
+        self.slice = slice
+        self.metrics = metrics
+        self.jobs = deque()
+
+    def __len__(self):
+        return sum(len(job[2]) - job[3] for job in self.jobs)
+
+    def deliver(self, message: bytes, connections: List['Connection']):
+        '''Write message to connections, now or in later slices.'''
+        if not self.jobs and self.spent + len(connections) <= self.slice:
+            self._spend(len(connections))
+            for connection in connections:
+                connection.send_raw(message)
+            return
+        self.enqueue(message, connections)
+
+    def enqueue(self, message: bytes, connections: List['Connection'],
+                lines: int = 1):
+        '''Queue message (of lines lines) to connections behind the queued
+        deliveries.'''
+        for connection in connections:
+            connection.queued += 1
+        self.jobs.append([message, lines, connections, 0])
+        self.metrics.counter('fanout_queued').inc()
+        if not self.scheduled:
+            self.scheduled = True
+            IOLoop.current().add_callback(self._run)
+
+    def _spend(self, writes: int):
+        '''Account writes done in the current IOLoop iteration.'''
+        self.spent += writes
+        if not self.reset_scheduled:
+            self.reset_scheduled = True
+            IOLoop.current().add_callback(self._reset)
+
+    def _reset(self):
+        self.spent = 0
+        self.reset_scheduled = False
+
+    def _run(self):
+        '''Write the next slice of queued deliveries.'''
+        self.scheduled = False
+        budget = self.slice
+        jobs = self.jobs
+        while jobs and budget > 0:
+            job = jobs[0]
+            message, lines, connections, position = job
+            end = min(len(connections), position + budget)
+            for connection in connections[position:end]:
+                connection.queued -= 1
+                connection.push(message, lines = lines)
+                if connection.closing and not connection.queued:
+                    connection.close()
+            budget -= end - position
+            if end == len(connections):
+                jobs.popleft()
+            else:
+                job[3] = end
+        self.metrics.counter('fanout_slices').inc()
+        if jobs:
+            self.scheduled = True
+            IOLoop.current().add_callback(self._run)
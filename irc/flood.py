@@ -0,0 +1,92 @@
+# coding: utf-8
+
+from typing import Undefined, Optional, Dict, FrozenSet
+import time
+
+__all__ = ['TokenBucket', 'FloodClass', 'load_flood_classes']
+
+class TokenBucket(object):
+    '''Token bucket refilled at rate tokens per second, up to burst.'''
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate # type: float
+        self.burst = burst # type: float
+        self.tokens = burst # type: float
+        self.stamp = time.monotonic()
+
+    def consume(self, amount: float = 1.0) -> float:
+        '''Take amount tokens. Returns how many seconds to wait until the
+        bucket is out of debt (0.0 if it isn\'t).'''
+        now = time.monotonic()
+        tokens = self.tokens + (now - self.stamp) * self.rate
+        self.tokens = (tokens if tokens < self.burst else self.burst) - amount
+        self.stamp = now
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+    def level(self) -> float:
+        '''Tokens in the bucket now (negative while in debt).'''
+        tokens = self.tokens + (time.monotonic() - self.stamp) * self.rate
+        return tokens if tokens < self.burst else self.burst
+
+    def take(self, amount: float = 1.0) -> bool:
+        '''Take amount tokens if the bucket holds them, without going into
+        debt. Returns whether it did.'''
+        now = time.monotonic()
+        tokens = self.tokens + (now - self.stamp) * self.rate
+        if tokens > self.burst:
+            tokens = self.burst
+        self.stamp = now
+        if tokens < amount:
+            self.tokens = tokens
+            return False
+        self.tokens = tokens - amount
+        return True
+
+class FloodClass(object):
+    '''Flood control limits of a class of connections.
+
+    Every command costs its penalty in tokens from the connection\'s
+    bucket, which refills at rate tokens per second up to burst (RFC 1459
+    8.10 is rate 0.5, burst 5 and a penalty of 1 for every command). A
+    class with no rate is not limited. Connections from hosts are put in
+    the class when they connect.
+    '''
+    name = Undefined(str)
+    rate = Undefined(Optional[float])
+    burst = Undefined(float)
+    penalties = Undefined(Dict[str, float])
+    hosts = Undefined(FrozenSet[str])
+
+    def __init__(self, name: str, rate: Optional[float] = None,
+                 burst: float = 10, penalties: Dict[str, float] = {},
+                 hosts: list = ()):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.penalties = {command.upper(): penalty
+                          for command, penalty in penalties.items()}
+        self.hosts = frozenset(hosts)
+
+    def bucket(self) -> Optional[TokenBucket]:
+        '''New bucket for a connection, or None if it isn\'t limited.'''
+        if not self.rate:
+            return None
+        return TokenBucket(rate = self.rate, burst = self.burst)
+
+    def penalty(self, command: str) -> float:
+        return self.penalties.get(command, 1)
+
+def load_flood_classes(settings: dict) -> Dict[str, FloodClass]:
+    '''Build flood classes from settings['floodclasses'], applying
+    settings['floodpenalties'] beneath each class\' own penalties.'''
+    classes = {}
+    for name, params in settings['floodclasses'].items():
+        params = dict(params)
+        penalties = dict(settings['floodpenalties'])
+        penalties.update(params.pop('penalties', {}))
+        classes[name] = FloodClass(name = name, penalties = penalties,
+                                   **params)
+    return classes
@@ -0,0 +1,402 @@
+# coding: utf-8
+
+from .connection import Connection
+from .user import User
+from .channel import Channel, Membership
+from .journal import encode_state, decode_state
+
+from tornado.ioloop import IOLoop
+from tornado.netutil import bind_unix_socket, add_accept_handler
+from tornado import gen
+
+from typing import Undefined, List, Tuple
+from array import array
+import logging
+import base64
+import socket
+import struct
+import json
+import os
+
+logger = logging.getLogger('tornado.general')
+
+__all__ = ['HandoffListener', 'Handoff', 'receive_handoff']
+
+##
+# Protocol
+##
+# The new process connects to the handoff socket and sends hello. The
+# running one answers with the state, as a length (uint64) and JSON, then
+# with the file descriptors it lists, up to fds_per_message per message,
+# each message carrying a single byte. The new process replies ack once
+# it has them all; only then does the running process stop.
+hello = b'TIRCHO1\n'
+ack = b'OK'
+length = struct.Struct('!Q')
+fds_per_message = 200
+
+def _recv_exact(sock: socket.socket, size: int) -> bytes:
+    chunks = []
+    while size:
+        chunk = sock.recv(size)
+        if not chunk:
+            raise ConnectionError('Handoff connection closed')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+def _send_fds(sock: socket.socket, fds: List[int]):
+    for start in range(0, len(fds), fds_per_message):
+        chunk = array('i', fds[start:start + fds_per_message])
+        sock.sendmsg([b'F'], [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                               chunk.tobytes())])
+
+def _recv_fds(sock: socket.socket, count: int) -> List[int]:
+    fds = array('i')
+    while len(fds) < count:
+        chunk = min(count - len(fds), fds_per_message)
+        data, ancdata, flags, _ = sock.recvmsg(
+                                      1, socket.CMSG_SPACE(chunk * fds.itemsize))
+        if not data:
+            raise ConnectionError('Handoff connection closed')
+        if flags & socket.MSG_CTRUNC:
+            raise ConnectionError('Handoff file descriptors truncated')
+        for level, kind, cdata in ancdata:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                fds.frombytes(cdata[:len(cdata) - len(cdata) % fds.itemsize])
+    return list(fds)
+
+def _b64(data: bytes) -> str:
+    return base64.b64encode(data).decode('ascii')
+
+##
+# State
+##
+def settled(server: 'IRCServer') -> bool:
+    '''Whether everything not processed or not written yet is where
+    snapshot() looks for it.
+
+    Fan-out deliveries must be written out, streams being closed must be
+    gone, and no read may have completed without its lines being moved to
+    Connection.pending yet.
+    '''
+    if server.fanout.jobs:
+        return False
+    for connection in server.connections:
+        reading = connection.reading
+        if (connection.stream.closed() or connection.closing or
+            connection.sendq_exceeded or
+            (reading is not None and reading.done())):
+            return False
+    return True
+
+def pending_input(connection: Connection) -> bytes:
+    '''Bytes received on connection and not processed yet.'''
+    parts = [line + b'\n' for line in connection.pending]
+    parts.append(connection.readbuf)
+    parts.extend(connection.stream._read_buffer)
+    return b''.join(parts)
+
+def pending_output(connection: Connection) -> bytes:
+    '''Bytes sent to connection and not written to the socket yet.'''
+    return b''.join(list(connection.stream._write_buffer) +
+                    connection.sendq)
+
+def snapshot(server: 'IRCServer') -> Tuple[dict, List[int]]:
+    '''State of server, and the file descriptors listed in it: the
+    listening sockets, the metrics endpoint ones, then one per
+    connection.'''
+    listeners = list(server.tcpserver._sockets.values())
+    endpoint = (list(server.endpoint.httpserver._sockets.values())
+                if server.endpoint else [])
+    sockets = listeners + endpoint
+    connections = []
+    for connection in server.connections:
+        sockets.append(connection.stream.socket)
+        record = {
+            'address': connection.address,
+            'port': connection.port,
+            'password': connection.password,
+            'req_nick': connection.req_nick,
+            'req_user': connection.req_user,
+            'floodclass': connection.floodclass.name,
+            'connected': connection.connected,
+            'traffic': [connection.bytes_in, connection.bytes_out,
+                        connection.lines_in, connection.lines_out],
+            'sendq_peak': connection.sendq_peak,
+            'input': _b64(pending_input(connection)),
+            'output': _b64(pending_output(connection)),
+            'user': None,
+        }
+        user = connection.user
+        if user:
+            record['user'] = {
+                'nick': user.nick,
+                'hopcount': user.hopcount,
+                'username': user.username,
+                'hostname': user.hostname,
+                'servername': user.servername,
+                'realname': user.realname,
+                'modes': user.modes,
+            }
+        connections.append(record)
+    channels = [{
+        'name': channel.name,
+        'state': _b64(encode_state(channel)),
+        'members': [[membership.user.folded, membership.flags]
+                    for membership in channel.users.values()],
+    } for channel in server.channels.values()]
+
+    state = {
+        'started': server.started,
+        'listeners': len(listeners),
+        'endpoint': len(endpoint),
+        'families': [int(sock.family) for sock in sockets],
+        'connections': connections,
+        'channels': channels,
+    }
+    return state, [sock.fileno() for sock in sockets]
+
+class Handoff(object):
+    '''State and sockets received from the server process being
+    replaced.'''
+    state = Undefined(dict)
+    listeners = Undefined(List[socket.socket])
+    endpoint = Undefined(List[socket.socket])
+    clients = Undefined(List[socket.socket])
+
+    def __init__(self, state: dict, sockets: List[socket.socket]):
+        self.state = state
+        listeners = state['listeners']
+        endpoint = listeners + state['endpoint']
+        self.listeners = sockets[:listeners]
+        self.endpoint = sockets[listeners:endpoint]
+        self.clients = sockets[endpoint:]
+
+    def restore(self, server: 'IRCServer'):
+        '''Recreate the connections, users and channels in server.'''
+        state = self.state
+        tcpserver = server.tcpserver
+        server.started = state['started']
+
+        connections = []
+        for record, sock in zip(state['connections'], self.clients):
+            connection = Connection(stream = tcpserver.make_stream(sock),
+                                    server = server,
+                                    address = record['address'],
+                                    port = record['port'])
+            connection.password = record['password']
+            connection.req_nick = record['req_nick']
+            connection.req_user = record['req_user']
+            connection.set_flood_class(record['floodclass'])
+            connection.connected = record['connected']
+            (connection.bytes_in, connection.bytes_out,
+             connection.lines_in, connection.lines_out) = record['traffic']
+            connection.sendq_peak = record['sendq_peak']
+            server.limiter.add(connection.address)
+
+            lines = base64.b64decode(record['input']).split(b'\n')
+            connection.readbuf = lines.pop()
+            connection.pending.extend(lines)
+            output = base64.b64decode(record['output'])
+            if output:
+                connection.stream.write(output)
+
+            if record['user']:
+                self._restore_user(server, connection, record['user'])
+            connections.append(connection)
+
+        for record in state['channels']:
+            self._restore_channel(server, record)
+
+        for connection in connections:
+            future = tcpserver.serve(connection)
+            tcpserver.io_loop.add_future(future, lambda f: f.result())
+            if connection.user is None:
+                connection.register_user()
+
+        logger.info('Took over %s connections, %s users and %s channels',
+                    len(connections), len(server.users),
+                    len(server.channels))
+
+    def _restore_user(self, server: 'IRCServer', connection: Connection,
+                      record: dict):
+        user = User(nick = record['nick'], connection = connection,
+                    server = server, hopcount = record['hopcount'],
+                    username = record['username'],
+                    hostname = record['hostname'],
+                    servername = record['servername'],
+                    realname = record['realname'])
+        user.modes = record['modes']
+        connection.user = user
+        server.users[user.folded] = user
+        server.timers.remove_timeout(connection.regtimer)
+        connection.regtimer = None
+        user.schedule_ping()
+
+    def _restore_channel(self, server: 'IRCServer', record: dict):
+        catalog = server.channels
+        payload = base64.b64decode(record['state'])
+        channel = Channel(name = record['name'], catalog = catalog)
+        decode_state(channel, payload)
+        for folded, flags in record['members']:
+            user = server.users[folded]
+            membership = Membership(user = user, channel = channel,
+                                    flags = flags)
+            channel.users[user.folded] = membership
+            user.channels[channel.folded] = membership
+            channel._update_names(membership)
+        catalog[channel.folded] = channel
+        catalog.directory.update(channel)
+
+##
+# Processes
+##
+class HandoffListener(object):
+    '''Unix socket through which a new server process takes over the
+    listening sockets, connections and state of this one.
+
+    The socket is only accessible to its owner (mode 0600).
+    '''
+    server = Undefined('IRCServer')
+    path = Undefined(str)
+    listener = None
+    done = False # connections were handed off
+
+    # Seconds to wait for hello from a process connecting
+    hello_timeout = 5.0
+    # Seconds to wait for the server state to settle
+    settle_timeout = 5.0
+    # Seconds to wait on the new process
+    timeout = 30.0
+
+    def __init__(self, server: 'IRCServer', path: str):
+        self.server = server
+        self.path = path
+
+    def start(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok = True)
+        self.listener = bind_unix_socket(self.path)
+        add_accept_handler(self.listener, self._on_accept)
+        logger.info('Accepting handoff on %s', self.path)
+
+    def close(self):
+        if self.listener is not None:
+            IOLoop.current().remove_handler(self.listener.fileno())
+            self.listener.close()
+            self.listener = None
+
+    def _on_accept(self, connection: socket.socket, address: str):
+        # Not from within the accept handler, as it closes the listener
+        IOLoop.current().spawn_callback(self.hand_off, connection)
+
+    @gen.coroutine
+    def hand_off(self, connection: socket.socket):
+        '''Send everything to the process on connection, then stop.'''
+        ioloop = IOLoop.current()
+        try:
+            received = yield self._read_hello(connection)
+            if len(received) < len(hello):
+                logger.warning('Handoff refused: no hello within %ss',
+                               self.hello_timeout)
+                return
+            if received != hello:
+                logger.warning('Handoff refused: unknown protocol')
+                return
+
+            deadline = ioloop.time() + self.settle_timeout
+            while not settled(self.server):
+                if ioloop.time() > deadline:
+                    logger.error('Handoff aborted: server state did not '
+                                 'settle in %ss', self.settle_timeout)
+                    return
+                yield gen.sleep(0.01)
+
+            # Blocking from here on, so nothing changes during the transfer
+            connection.settimeout(self.timeout)
+            if self._transfer(connection):
+                self._shutdown()
+                # Let the read loops see their streams closed, then stop
+                yield gen.sleep(0.1)
+                ioloop.stop()
+        except OSError as e:
+            logger.error('Handoff aborted: %s', e)
+        finally:
+            connection.close()
+
+    @gen.coroutine
+    def _read_hello(self, connection: socket.socket):
+        '''Read len(hello) bytes without blocking the IOLoop, or what came
+        within hello_timeout seconds.'''
+        ioloop = IOLoop.current()
+        deadline = ioloop.time() + self.hello_timeout
+        connection.setblocking(False)
+        data = b''
+        while len(data) < len(hello) and ioloop.time() < deadline:
+            try:
+                chunk = connection.recv(len(hello) - len(data))
+            except BlockingIOError:
+                yield gen.sleep(0.01)
+                continue
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+    def _transfer(self, connection: socket.socket) -> bool:
+        '''Send state and sockets, without returning to the IOLoop in
+        between. Returns whether the new process got them.'''
+        journal = self.server.channels.journal
+        if journal is not None:
+            journal.close()
+        state, fds = snapshot(self.server)
+        try:
+            data = json.dumps(state).encode('utf-8')
+            connection.sendall(length.pack(len(data)) + data)
+            _send_fds(connection, fds)
+            if _recv_exact(connection, len(ack)) != ack:
+                raise ConnectionError('Handoff not acknowledged')
+        except OSError as e:
+            logger.error('Handoff failed, still serving: %s', e)
+            if journal is not None:
+                journal.start()
+            return False
+        logger.info('Handed off %s connections and %s channels',
+                    len(state['connections']), len(state['channels']))
+        return True
+
+    def _shutdown(self):
+        '''Stop serving without disconnecting anyone: the sockets are
+        closed here, but stay open in the new process.'''
+        server = self.server
+        self.done = True
+        self.close()
+        server.tcpserver.stop()
+        if server.endpoint:
+            server.endpoint.httpserver.stop()
+        for connection in list(server.connections):
+            connection.stream.close()
+
+def receive_handoff(path: str, timeout: float = 30.0) -> Handoff:
+    '''Take over from the server process listening on handoff socket
+    path. Once this returns, that process is stopping.'''
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+        sock.sendall(hello)
+        size, = length.unpack(_recv_exact(sock, length.size))
+        state = json.loads(_recv_exact(sock, size).decode('utf-8'))
+        fds = _recv_fds(sock, len(state['families']))
+        sock.sendall(ack)
+    finally:
+        sock.close()
+
+    sockets = []
+    for family, fd in zip(state['families'], fds):
+        received = socket.socket(family, socket.SOCK_STREAM, fileno = fd)
+        received.setblocking(False)
+        sockets.append(received)
+    return Handoff(state = state, sockets = sockets)
@@ -0,0 +1,254 @@
+# coding: utf-8
+
+from .metrics import MetricsRegistry, Counter
+
+from tornado.ioloop import IOLoop
+from tornado.iostream import IOStream
+from tornado.web import Application, RequestHandler, HTTPError
+from tornado.httpserver import HTTPServer
+
+from typing import Undefined, List, Tuple, Dict
+import ipaddress
+import logging
+import json
+import time
+
+logger = logging.getLogger('tornado.general')
+
+__all__ = ['LoopLagProbe', 'MeteredIOStream', 'render_prometheus',
+           'MetricsEndpoint', 'throttled_clients']
+
+##
+# Probes
+##
+class LoopLagProbe(object):
+    '''Measures how late the IOLoop runs a callback due every interval
+    seconds, into the loop_lag histogram.'''
+    interval = Undefined(float)
+    metrics = Undefined(MetricsRegistry)
+    timeout = None
+    expected = 0.0
+
+    def __init__(self, interval: float, metrics: MetricsRegistry):
+        self.interval = interval
+        self.metrics = metrics
+
+    def start(self):
+        if self.timeout is None:
+            self._schedule()
+
+    def stop(self):
+        if self.timeout is not None:
+            IOLoop.current().remove_timeout(self.timeout)
+            self.timeout = None
+
+    def _schedule(self):
+        ioloop = IOLoop.current()
+        self.expected = ioloop.time() + self.interval
+        self.timeout = ioloop.call_at(self.expected, self.probe)
+
+    def probe(self):
+        lag = IOLoop.current().time() - self.expected
+        self.metrics.histogram('loop_lag').observe(max(0.0, lag))
+        self._schedule()
+
+class MeteredIOStream(IOStream):
+    '''IOStream counting its recv and send system calls.'''
+    reads = Undefined(Counter)
+    writes = Undefined(Counter)
+
+    def __init__(self, *args, metrics: MetricsRegistry, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.reads = metrics.counter('syscalls', 'recv')
+        self.writes = metrics.counter('syscalls', 'send')
+
+    def read_from_fd(self):
+        self.reads.value += 1
+        return super().read_from_fd()
+
+    def write_to_fd(self, data):
+        self.writes.value += 1
+        return super().write_to_fd(data)
+
+    def write_buffer_size(self) -> int:
+        '''Bytes written to stream and not sent to the socket yet.'''
+        # IOStream has no public size of its write buffer (tornado 4.2)
+        return self._write_buffer_size
+
+##
+# Prometheus exposition
+##
+# Label name of the keys of each metric family (default: key)
+labels = {
+    'commands': 'command',
+    'connections_rejected': 'reason',
+    'command_latency': 'command',
+    'flood_throttled': 'class',
+    'flood_throttled_clients': 'class',
+    'syscalls': 'call',
+}
+
+# Counters of closed connections, completed with the live ones on scrape
+traffic = ('bytes_in', 'bytes_out', 'lines_in', 'lines_out')
+
+def _labels(family: str, key: str, extra: str = '') -> str:
+    pairs = []
+    if key:
+        value = key.replace('\\', '\\\\').replace('"', '\\"')
+        pairs.append('%s="%s"' % (labels.get(family, 'key'), value))
+    if extra:
+        pairs.append(extra)
+    return '{%s}' % ','.join(pairs) if pairs else ''
+
+def gauges(server: 'IRCServer') -> List[Tuple[str, float]]:
+    '''Current size of the server state.'''
+    connections = server.connections
+    return [
+        ('connections', len(connections)),
+        ('users', len(server.users)),
+        ('channels', len(server.channels)),
+        ('memberships', sum(len(channel.users)
+                            for channel in server.channels.values())),
+        ('remote_channels', len(server.channels.remote)),
+        ('fanout_queued_writes', len(server.fanout)),
+        ('registrations_active', len(server.admission.active)),
+        ('registrations_queued', len(server.admission)),
+        ('accept_prefixes', len(server.limiter.counts)),
+        ('sendq_bytes_max', max((connection.backlog()
+                                 for connection in connections), default = 0)),
+        ('sendq_peak_bytes_max', max((connection.sendq_peak
+                                      for connection in connections),
+                                     default = 0)),
+        ('uptime_seconds', time.time() - server.started),
+    ]
+
+def throttled_clients(server: 'IRCServer') -> Dict[str, int]:
+    '''Connections held back by flood control now, by flood class.'''
+    counts = {name: 0 for name in server.floodclasses}
+    for connection in server.connections:
+        if connection.is_throttled():
+            counts[connection.floodclass.name] += 1
+    return counts
+
+def render_prometheus(server: 'IRCServer') -> str:
+    '''Server metrics in the Prometheus text exposition format.'''
+    metrics = server.metrics
+    lines = []
+
+    live = {name: 0 for name in traffic}
+    for connection in server.connections:
+        live['bytes_in'] += connection.bytes_in
+        live['bytes_out'] += connection.bytes_out
+        live['lines_in'] += connection.lines_in
+        live['lines_out'] += connection.lines_out
+
+    counters = dict(metrics.counters)
+    for name in traffic:
+        counters.setdefault(name, {})
+    for name in sorted(counters):
+        family = counters[name]
+        lines.append('# TYPE ircd_%s_total counter' % name)
+        for key in sorted(family):
+            value = family[key].value
+            if name in live and key == '':
+                value += live[name]
+            lines.append('ircd_%s_total%s %s' % (name, _labels(name, key),
+                                                 value))
+        if name in live and '' not in family:
+            lines.append('ircd_%s_total %s' % (name, live[name]))
+
+    for name in sorted(metrics.histograms):
+        family = metrics.histograms[name]
+        lines.append('# TYPE ircd_%s histogram' % name)
+        for key in sorted(family):
+            histogram = family[key]
+            seen = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                seen += count
+                lines.append('ircd_%s_bucket%s %s' % (
+                                 name, _labels(name, key, 'le="%r"' % bound),
+                                 seen))
+            lines.append('ircd_%s_bucket%s %s' % (
+                             name, _labels(name, key, 'le="+Inf"'),
+                             histogram.count))
+            lines.append('ircd_%s_sum%s %r' % (name, _labels(name, key),
+                                               histogram.total))
+            lines.append('ircd_%s_count%s %s' % (name, _labels(name, key),
+                                                 histogram.count))
+
+    for name, value in gauges(server):
+        lines.append('# TYPE ircd_%s gauge' % name)
+        lines.append('ircd_%s %s' % (name, value))
+    throttled = throttled_clients(server)
+    lines.append('# TYPE ircd_flood_throttled_clients gauge')
+    for key in sorted(throttled):
+        lines.append('ircd_flood_throttled_clients%s %s' % (
+                         _labels('flood_throttled_clients', key),
+                         throttled[key]))
+    lines.append('')
+    return '\n'.join(lines)
+
+##
+# HTTP endpoint
+##
+class LocalHandler(RequestHandler):
+    '''Handler refusing requests from other hosts.'''
+    def initialize(self, server: 'IRCServer'):
+        self.server = server
+
+    def prepare(self):
+        if not ipaddress.ip_address(self.request.remote_ip).is_loopback:
+            raise HTTPError(403)
+
+class MetricsHandler(LocalHandler):
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write(render_prometheus(self.server))
+
+class ConnectionsHandler(LocalHandler):
+    '''Per-connection I/O counters, as JSON.'''
+    def get(self):
+        now = time.time()
+        rows = []
+        for connection in self.server.connections:
+            user = connection.user
+            rows.append({
+                'address': connection.address,
+                'port': connection.port,
+                'nick': user.nick if user else None,
+                'seconds': round(now - connection.connected, 3),
+                'bytes_in': connection.bytes_in,
+                'bytes_out': connection.bytes_out,
+                'lines_in': connection.lines_in,
+                'lines_out': connection.lines_out,
+                'sendq': connection.backlog(),
+                'sendq_peak': connection.sendq_peak,
+            })
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(rows))
+
+class MetricsEndpoint(object):
+    '''HTTP server on the server IOLoop exposing /metrics (Prometheus)
+    and /connections (JSON), for loopback clients only.'''
+    server = Undefined('IRCServer')
+    httpserver = Undefined(HTTPServer)
+
+    def __init__(self, server: 'IRCServer'):
+        self.server = server
+        application = Application([
+            (r'/metrics', MetricsHandler, {'server': server}),
+            (r'/connections', ConnectionsHandler, {'server': server}),
+        ])
+        self.httpserver = HTTPServer(application)
+
+    def listen(self, port: int, address: str = '127.0.0.1'):
+        if not ipaddress.ip_address(address).is_loopback:
+            raise ValueError('Metrics endpoint must listen on loopback, '
+                             'not %s' % address)
+        self.httpserver.listen(port, address = address)
+        logger.info('Metrics endpoint on http://%s:%s/metrics',
+                    address, port)
+
+    def add_sockets(self, sockets: List['socket']):
+        '''Serve on already bound sockets.'''
+        self.httpserver.add_sockets(sockets)
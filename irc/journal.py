@@ -0,0 +1,310 @@
+# coding: utf-8
+
+from .channel import ModeItem
+
+from tornado.ioloop import IOLoop
+
+from typing import Undefined, Callable, Dict, Set, List
+from zlib import crc32
+import threading
+import logging
+import struct
+import queue
+import mmap
+import os
+
+logger = logging.getLogger('tornado.general')
+
+__all__ = ['ChannelJournal', 'encode_state', 'decode_state']
+
+##
+# Record format
+##
+# File:    magic, then records
+# Record:  payload length (uint32), payload crc32 (uint32), payload
+# Payload: b'P' put: flags (uint8), limit (uint32), topic time (double),
+#                    name, topic, key, then the ban, except and invite
+#                    lists: count (uint16), then mask, author and
+#                    timestamp (int64) of each entry
+#          b'D' delete: name
+# Strings are an uint16 length followed by UTF-8 bytes.
+magic = b'TIRCCHJ1'
+frame = struct.Struct('!II')
+fixed = struct.Struct('!cBId')
+count = struct.Struct('!H')
+stamp = struct.Struct('!q')
+
+# flags bits
+MODERATED = 1
+INVITEONLY = 2
+SECRET = 4
+TOPIC = 8
+KEY = 16
+TOPICTIME = 32
+
+def _pack_str(value: str) -> bytes:
+    data = value.encode('utf-8')
+    return count.pack(len(data)) + data
+
+def _unpack_str(payload: memoryview, offset: int):
+    size, = count.unpack_from(payload, offset)
+    offset += count.size
+    return str(payload[offset:offset + size], 'utf-8'), offset + size
+
+def encode_state(channel: 'Channel') -> bytes:
+    '''Put record payload of channel.'''
+    flags = ((MODERATED if channel.moderated else 0) |
+             (INVITEONLY if channel.inviteonly else 0) |
+             (SECRET if channel.secret else 0) |
+             (TOPIC if channel.topic is not None else 0) |
+             (KEY if channel.key else 0) |
+             (TOPICTIME if channel.topic_time is not None else 0))
+    parts = [fixed.pack(b'P', flags, channel.limit or 0,
+                        channel.topic_time or 0.0),
+             _pack_str(channel.name),
+             _pack_str(channel.topic or ''),
+             _pack_str(channel.key or '')]
+    for modelist in (channel.banlist, channel.exclist, channel.invlist):
+        parts.append(count.pack(len(modelist)))
+        for mask, item in modelist.items():
+            parts.append(_pack_str(mask))
+            parts.append(_pack_str(item.author))
+            parts.append(stamp.pack(item.timestamp))
+    return b''.join(parts)
+
+def decode_state(channel: 'Channel', payload: memoryview):
+    '''Apply put record payload to channel.'''
+    _, flags, limit, topic_time = fixed.unpack_from(payload, 0)
+    offset = fixed.size
+    _, offset = _unpack_str(payload, offset)
+    topic, offset = _unpack_str(payload, offset)
+    key, offset = _unpack_str(payload, offset)
+    channel.moderated = bool(flags & MODERATED)
+    channel.inviteonly = bool(flags & INVITEONLY)
+    channel.secret = bool(flags & SECRET)
+    channel.topic = topic if flags & TOPIC else None
+    channel.key = key if flags & KEY else None
+    channel.topic_time = topic_time if flags & TOPICTIME else None
+    channel.limit = limit or None
+
+    for modelist, maskindex in ((channel.banlist, channel.banmasks),
+                                (channel.exclist, channel.excmasks),
+                                (channel.invlist, channel.invmasks)):
+        entries, = count.unpack_from(payload, offset)
+        offset += count.size
+        for _ in range(entries):
+            mask, offset = _unpack_str(payload, offset)
+            author, offset = _unpack_str(payload, offset)
+            timestamp, = stamp.unpack_from(payload, offset)
+            offset += stamp.size
+            modelist[mask] = ModeItem(author, timestamp)
+            maskindex.add(mask)
+
+def _record_name(payload: memoryview) -> str:
+    '''Channel name of a put or delete payload.'''
+    if payload[:1] == b'D':
+        return str(payload[1:], 'utf-8')
+    return _unpack_str(payload, fixed.size)[0]
+
+def _frame(payload: bytes) -> bytes:
+    return frame.pack(len(payload), crc32(payload)) + payload
+
+##
+# Journal
+##
+class ChannelJournal(object):
+    '''Channel state kept in an append-only journal file.
+
+    Channels whose state changed are written out together every delay
+    seconds; a channel dropped for getting empty gets a delete record.
+    Writes (and compactions, once the file holds more than compact_ratio
+    times the size of the live records) are done by a background thread.
+
+    At startup the file is memory mapped and only indexed; the state of
+    a channel is decoded when it\'s created again.
+    '''
+    path = Undefined(str)
+    fold = Undefined(Callable[[str], str])
+    records = Undefined(Dict[str, memoryview]) # {'#chan': put payload}
+    dirty = Undefined(Set['Channel'])
+    size = 0 # bytes in the file
+    live = 0 # bytes of the live records
+    flush_scheduled = False
+    thread = None
+    queue = Undefined(queue.Queue)
+    file = None
+    map = None
+
+    # Seconds between writes
+    delay = 1.0
+    # Compact when the file is larger than both
+    compact_ratio = 2.0
+    compact_min = 1048576
+
+    def __init__(self, path: str, fold: Callable[[str], str]):
+        self.path = path
+        self.fold = fold
+        self.records = {}
+        self.dirty = set()
+        self.queue = queue.Queue()
+
+    def __len__(self):
+        return len(self.records)
+
+    def load(self):
+        '''Index the records in the journal file, creating it if needed.'''
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok = True)
+        if not os.path.exists(self.path):
+            with open(self.path, 'wb') as journal:
+                journal.write(magic)
+
+        with open(self.path, 'rb') as journal:
+            size = os.fstat(journal.fileno()).st_size
+            if journal.read(len(magic)) != magic:
+                raise ValueError('%s is not a channel journal' % self.path)
+            if size > len(magic):
+                self.map = mmap.mmap(journal.fileno(), 0,
+                                     access = mmap.ACCESS_READ)
+
+        end = self._index(memoryview(self.map) if self.map else b'')
+        if end < size:
+            logger.warning('Channel journal %s: discarding %s bytes of '
+                           'truncated or corrupt records', self.path,
+                           size - end)
+            with open(self.path, 'r+b') as journal:
+                journal.truncate(end)
+        self.size = end
+        logger.info('Channel journal %s: %s channels', self.path,
+                    len(self.records))
+
+    def _index(self, data: memoryview) -> int:
+        '''Index the records in data. Returns the end of the last good
+        one.'''
+        records = self.records
+        fold = self.fold
+        offset = len(magic)
+        end = len(data)
+        live = 0
+        while offset + frame.size <= end:
+            length, checksum = frame.unpack_from(data, offset)
+            start = offset + frame.size
+            if start + length > end:
+                break
+            payload = data[start:start + length]
+            if crc32(payload) != checksum:
+                break
+            key = fold(_record_name(payload))
+            old = records.pop(key, None)
+            if old is not None:
+                live -= frame.size + len(old)
+            if payload[:1] == b'P':
+                records[key] = payload
+                live += frame.size + length
+            offset = start + length
+        self.live = live
+        return offset
+
+    def start(self):
+        '''Start the writer thread.'''
+        if self.thread:
+            return
+        self.file = open(self.path, 'ab')
+        self.thread = threading.Thread(target = self._write_loop,
+                                       name = 'channel-journal',
+                                       daemon = True)
+        self.thread.start()
+
+    def close(self):
+        '''Write pending changes and stop the writer thread.'''
+        self.flush()
+        if self.thread:
+            self.queue.put((None, None))
+            self.thread.join()
+            self.thread = None
+
+    ##
+    # Channel events
+    ##
+    def restore(self, channel: 'Channel') -> bool:
+        '''Apply the saved state of channel, if any.'''
+        payload = self.records.get(channel.folded)
+        if payload is None:
+            return False
+        decode_state(channel, payload)
+        return True
+
+    def changed(self, channel: 'Channel'):
+        self.dirty.add(channel)
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            IOLoop.current().call_later(self.delay, self.flush)
+
+    def removed(self, channel: 'Channel'):
+        self.dirty.discard(channel)
+        payload = self.records.pop(channel.folded, None)
+        if payload is not None:
+            self.live -= frame.size + len(payload)
+            self._append([_frame(b'D' + channel.name.encode('utf-8'))])
+
+    def flush(self):
+        '''Write the state of the changed channels.'''
+        self.flush_scheduled = False
+        if not self.dirty:
+            return
+        records = []
+        for channel in self.dirty:
+            payload = encode_state(channel)
+            old = self.records.get(channel.folded)
+            if old is not None:
+                self.live -= frame.size + len(old)
+            self.records[channel.folded] = payload
+            self.live += frame.size + len(payload)
+            records.append(_frame(payload))
+        self.dirty.clear()
+        self._append(records)
+
+        if (self.size > self.compact_min and
+            self.size > self.compact_ratio * self.live):
+            self.size = len(magic) + self.live
+            self.queue.put(('compact', list(self.records.values())))
+
+    def _append(self, records: List[bytes]):
+        data = b''.join(records)
+        self.size += len(data)
+        self.queue.put(('append', data))
+
+    ##
+    # Writer thread
+    ##
+    def _write_loop(self):
+        while True:
+            operation, data = self.queue.get()
+            if operation is None:
+                break
+            try:
+                if operation == 'append':
+                    self.file.write(data)
+                    self.file.flush()
+                    os.fsync(self.file.fileno())
+                elif operation == 'compact':
+                    self._compact(data)
+            except OSError as e:
+                logger.error('Channel journal %s: %s', self.path, e)
+        self.file.close()
+
+    def _compact(self, payloads: List[memoryview]):
+        '''Rewrite the journal with only the live records.'''
+        temp = self.path + '.compact'
+        with open(temp, 'wb') as journal:
+            journal.write(magic)
+            for payload in payloads:
+                journal.write(_frame(payload))
+            journal.flush()
+            os.fsync(journal.fileno())
+        os.replace(temp, self.path)
+        self.file.close()
+        self.file = open(self.path, 'ab')
+        logger.info('Channel journal %s compacted: %s channels',
+                    self.path, len(payloads))
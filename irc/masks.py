@@ -0,0 +1,55 @@
+# coding: utf-8
+
+from typing import Undefined, Optional, Set
+import re
+
+__all__ = ['MaskIndex']
+
+class MaskIndex(object):
+    '''Set of lowercase address masks, matched in a single lookup.
+
+    Masks without wildcards are kept in a set. The others are compiled
+    together into one regex, which is rebuilt on the first match after
+    a change.
+    '''
+    literals = Undefined(Set[str])
+    wildcards = Undefined(Set[str])
+    _regex = Undefined(Optional['re.Pattern'])
+
+    def __init__(self):
+        self.literals = set()
+        self.wildcards = set()
+        self._regex = None
+
+    def __len__(self):
+        return len(self.literals) + len(self.wildcards)
+
+    def add(self, mask: str):
+        if '*' in mask or '?' in mask:
+            self.wildcards.add(mask)
+            self._regex = None
+        else:
+            self.literals.add(mask)
+
+    def remove(self, mask: str):
+        if mask in self.wildcards:
+            self.wildcards.remove(mask)
+            self._regex = None
+        else:
+            self.literals.discard(mask)
+
+    def match(self, lcaddr: str) -> bool:
+        '''Tell whether lowercase address lcaddr matches any mask.'''
+        if lcaddr in self.literals:
+            return True
+        if not self.wildcards:
+            return False
+        if self._regex is None:
+            self._regex = self._compile(self.wildcards)
+        return self._regex.match(lcaddr) is not None
+
+    @staticmethod
+    def _compile(masks: Set[str]) -> 're.Pattern':
+        patterns = (re.escape(mask).replace(r'\*', '.*').replace(r'\?', '.')
+                    for mask in masks)
+        return re.compile(r'(?:%s)\Z' % '|'.join(patterns), re.S)
@@ -1,11 +1,17 @@
 # coding: utf-8
 
+from typing import Undefined, Optional
+import re
+
 messages = {
     'RPL_WELCOME':          ':%(servername)s 001 %(target)s :Welcome to the Internet Relay Network %(targetaddr)s',
     'RPL_YOURHOST':         ':%(servername)s 002 %(target)s :Your host is %(servername)s, running version %(version)s',
     'RPL_CREATED':          ':%(servername)s 003 %(target)s :This server was created %(date)s',
     'RPL_MYINFO':           ':%(servername)s 004 %(target)s :%(servername)s %(version)s %(usermodes)s %(channelmodes)s',
+    'RPL_STATSCOMMANDS':    ':%(servername)s 212 %(target)s %(command)s %(count)s %(bytecount)s %(remotecount)s',
+    'RPL_ENDOFSTATS':       ':%(servername)s 219 %(target)s %(query)s :End of STATS report',
     'RPL_UMODEIS':          ':%(servername)s 221 %(target)s :%(modes)s',
+    'RPL_STATSDEBUG':       ':%(servername)s 249 %(target)s :%(text)s',
     'RPL_LUSERCLIENT':      ':%(servername)s 251 %(target)s :There are %(usercount)s users and %(servicescount)s services on %(serverscount)s servers',
     'RPL_LUSERME':          ':%(servername)s 255 %(target)s :I have %(usercount)s clients and %(serverscount)s servers',
     'RPL_ISON':             ':%(servername)s 303 %(target)s :%(nicklist)s',
@@ -30,6 +36,7 @@ messages = {
     'RPL_MOTD':             ':%(servername)s 372 %(target)s :- %(text)s',
     'RPL_MOTDSTART':        ':%(servername)s 375 %(target)s :- %(servername)s Message of the day - ',
     'RPL_ENDOFMOTD':        ':%(servername)s 376 %(target)s :End of MOTD command',
+    'RPL_YOUREOPER':        ':%(servername)s 381 %(target)s :You are now an IRC operator',
 
     'ERR_NOSUCHNICK':       ':%(servername)s 401 %(target)s %(nick)s :No such nick/channel',
     'ERR_NOSUCHSERVER':     ':%(servername)s 402 %(target)s %(server)s :No such server',
@@ -44,10 +51,12 @@ messages = {
     'ERR_NOTONCHANNEL':     ':%(servername)s 442 %(target)s %(channel)s :You\'re not on that channel',
     'ERR_NEEDMOREPARAMS':   ':%(servername)s 461 %(target)s %(command)s :Not enough parameters',
     'ERR_ALREADYREGISTRED': ':%(servername)s 462 %(target)s :You may not reregister',
+    'ERR_PASSWDMISMATCH':   ':%(servername)s 464 %(target)s :Password incorrect',
     'ERR_CHANNELISFULL':    ':%(servername)s 471 %(target)s %(channel)s :Cannot join channel (+l)',
     'ERR_INVITEONLYCHAN':   ':%(servername)s 473 %(target)s %(channel)s :Cannot join channel (+i)',
     'ERR_BANNEDFROMCHAN':   ':%(servername)s 474 %(target)s %(channel)s :Cannot join channel (+b)',
     'ERR_BADCHANNELKEY':    ':%(servername)s 475 %(target)s %(channel)s :Cannot join channel (+k)',
+    'ERR_NOPRIVILEGES':     ':%(servername)s 481 %(target)s :Permission Denied- You\'re not an IRC operator',
     'ERR_CHANOPRIVSNEEDED': ':%(servername)s 482 %(target)s %(channel)s :You\'re not channel operator',
 
     'CMD_ERROR':            'ERROR :Closing Link: %(ipaddr)s (%(text)s)',
@@ -63,3 +72,52 @@ messages = {
     'CMD_MODE':             ':%(sender)s MODE %(recipient)s :%(modes)s',
     'CMD_MODE_CHAN':        ':%(useraddr)s MODE %(channel)s %(modes)s',
 }
+
+# Fields filled in by Connection.send_message for each recipient
+target_fields = frozenset(('target', 'targetaddr', 'ipaddr'))
+
+class MessageTemplate(object):
+    '''Message template compiled into a server prefix and a body.
+
+    Templates starting with ":%(servername)s " have that prefix stripped,
+    as it\'s constant for a server and is prepended already encoded.
+    Templates with no fields are encoded once, at compile time.
+    '''
+    msgid = Undefined(str)
+    fields = Undefined(frozenset)
+    prefixed = Undefined(bool)
+    body = Undefined(str)
+    static = Undefined(Optional[bytes])
+    _prefix = ':%(servername)s '
+    _field_regex = re.compile(r'%\((\w+)\)s')
+
+    def __init__(self, msgid: str, template: str):
+        self.msgid = msgid
+        self.prefixed = template.startswith(self._prefix)
+        if self.prefixed:
+            template = template[len(self._prefix):]
+        self.body = template + '\r\n'
+        self.fields = frozenset(self._field_regex.findall(self.body))
+        self.static = None if self.fields else (self.body % {}).encode('utf-8')
+
+    def render(self, prefix: bytes, params: dict) -> bytes:
+        '''Render message as a wire line.
+
+        prefix is the encoded ":servername " of the sending server and
+        params must hold every name in fields.
+        '''
+        body = self.static
+        if body is None:
+            body = (self.body % params).encode('utf-8')
+        return prefix + body if self.prefixed else body
+
+templates = {msgid: MessageTemplate(msgid, template)
+             for msgid, template in messages.items()}
+
+# Messages whose wire format is the same for every recipient
+untargeted = frozenset(msgid for msgid, template in templates.items()
+                       if not template.fields & target_fields)
+
+def format_message(msgid: str, prefix: bytes, params: dict) -> bytes:
+    '''Format message and encode it as a wire line.'''
+    return templates[msgid].render(prefix, params)
@@ -0,0 +1,99 @@
+# coding: utf-8
+
+from typing import Undefined, Optional, Tuple, List, Dict
+from bisect import bisect_left
+from random import random
+
+__all__ = ['Counter', 'Histogram', 'MetricsRegistry']
+
+class Counter(object):
+    '''Monotonic counter.'''
+    value = 0
+
+    def inc(self, amount: int = 1):
+        self.value += amount
+
+class Histogram(object):
+    '''Histogram of observed values over fixed bucket upper bounds.'''
+    buckets = Undefined(Tuple[float])
+    counts = Undefined(List[int])
+    count = 0
+    total = 0.0
+
+    # Latency buckets, in seconds (50us ~ 10s)
+    default_buckets = (0.00005, 0.0001, 0.00025, 0.0005,
+                       0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                       0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, buckets: Optional[Tuple[float]] = None):
+        self.buckets = tuple(buckets) if buckets else self.default_buckets
+        self.counts = [0] * (len(self.buckets) + 1) # last one is +Inf
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def percentile(self, p: float) -> float:
+        '''Upper bound of the bucket holding the p-th percentile.'''
+        if not self.count:
+            return 0.0
+        rank = p / 100 * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def snapshot(self) -> dict:
+        return {'buckets': self.buckets,
+                'counts': list(self.counts),
+                'count': self.count,
+                'sum': self.total,
+                'p50': self.percentile(50),
+                'p99': self.percentile(99)}
+
+class MetricsRegistry(object):
+    '''In-process registry of counters and histograms.
+
+    Metrics are grouped in families: registry.counter('commands', 'JOIN')
+    is the 'JOIN' counter of the 'commands' family. Unkeyed metrics use
+    the '' key.
+    '''
+    counters = Undefined(Dict[str, Dict[str, Counter]])
+    histograms = Undefined(Dict[str, Dict[str, Histogram]])
+    sample_rate = Undefined(float)
+
+    def __init__(self, sample_rate: float = 1.0):
+        self.counters = {}
+        self.histograms = {}
+        self.sample_rate = sample_rate
+
+    def counter(self, name: str, key: str = '') -> Counter:
+        family = self.counters.setdefault(name, {})
+        if key not in family:
+            family[key] = Counter()
+        return family[key]
+
+    def histogram(self, name: str, key: str = '',
+                  buckets: Optional[Tuple[float]] = None) -> Histogram:
+        family = self.histograms.setdefault(name, {})
+        if key not in family:
+            family[key] = Histogram(buckets = buckets)
+        return family[key]
+
+    def sampled(self) -> bool:
+        '''Tell whether the current event should be timed.'''
+        return self.sample_rate >= 1.0 or random() < self.sample_rate
+
+    def snapshot(self) -> dict:
+        '''Copy of all metrics values, as plain dicts.'''
+        return {
+            'counters': {name: {key: counter.value
+                                for key, counter in family.items()}
+                         for name, family in self.counters.items()},
+            'histograms': {name: {key: histogram.snapshot()
+                                  for key, histogram in family.items()}
+                           for name, family in self.histograms.items()},
+        }
@@ -0,0 +1,98 @@
+# coding: utf-8
+
+from typing import Undefined, Optional, List, Dict
+
+__all__ = ['NameList']
+
+class NameChunk(object):
+    '''Entries fitting in the trailing param of a single reply line.'''
+    entries = Undefined(Dict[str, bytes])
+    size = 0
+    _payload = Undefined(Optional[bytes])
+
+    def __init__(self):
+        self.entries = {}
+        self._payload = None
+
+    @property
+    def payload(self) -> bytes:
+        if self._payload is None:
+            self._payload = b' '.join(self.entries.values())
+        return self._payload
+
+    def add(self, key: str, entry: bytes):
+        self.entries[key] = entry
+        self.size += len(entry) + 1
+        self._payload = None
+
+    def remove(self, key: str):
+        self.size -= len(self.entries.pop(key)) + 1
+        self._payload = None
+
+class NameList(object):
+    '''Encoded "@nick" / "+nick" / "nick" entries packed into chunks.
+
+    Each chunk fits in capacity bytes (separating spaces included) and
+    caches its joined payload, so adding, removing or changing an entry
+    only rebuilds the payload of the chunk it lives in.
+    '''
+    capacity = Undefined(int)
+    chunks = Undefined(List[NameChunk])
+    where = Undefined(Dict[str, NameChunk])
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.chunks = []
+        self.where = {}
+
+    def __len__(self):
+        return len(self.where)
+
+    def __contains__(self, key: str):
+        return key in self.where
+
+    def set(self, key: str, entry: bytes):
+        '''Add entry under key, replacing the previous one if any.'''
+        chunk = self.where.get(key)
+        if chunk is not None:
+            if chunk.entries[key] == entry:
+                return
+            chunk.remove(key)
+            if chunk.size + len(entry) + 1 <= self.capacity + 1:
+                chunk.add(key, entry)
+                return
+            self._discard(chunk)
+
+        chunk = self._room(len(entry) + 1)
+        chunk.add(key, entry)
+        self.where[key] = chunk
+
+    def remove(self, key: str):
+        chunk = self.where.pop(key, None)
+        if chunk is None:
+            return
+        chunk.remove(key)
+        self._discard(chunk)
+
+    def payloads(self) -> List[bytes]:
+        '''Trailing params of the reply lines.'''
+        return [chunk.payload for chunk in self.chunks]
+
+    def entries(self):
+        for chunk in self.chunks:
+            yield from chunk.entries.values()
+
+    def _room(self, size: int) -> NameChunk:
+        '''Chunk with room for size more bytes, newest ones first.'''
+        limit = self.capacity + 1 # last entry has no trailing space
+        for chunk in reversed(self.chunks):
+            if chunk.size + size <= limit:
+                return chunk
+        chunk = NameChunk()
+        self.chunks.append(chunk)
+        return chunk
+
+    def _discard(self, chunk: NameChunk):
+        '''Drop chunk if it got empty.'''
+        if not chunk.entries:
+            self.chunks.remove(chunk)
@@ -0,0 +1,75 @@
+# coding: utf-8
+
+from typing import Optional, Tuple, List
+
+__all__ = ['parse_message', 'decode']
+
+# Byte values used by the parser
+_COLON = 58
+_SPACE = 32
+
+# Max number of middle params before the rest of line becomes trailing
+_MAXMIDDLE = 14
+
+def parse_message(data: bytes) -> Optional[Tuple[Optional[memoryview], str,
+                                                 List[memoryview]]]:
+    '''Split a line into prefix, command and params (RFC2812 2.3.1).
+
+    The line is scanned once, left to right. Prefix and params are
+    returned as memoryview slices of data, so nothing is copied or decoded
+    until a handler needs it (see decode). Returns None if the line
+    doesn\'t hold a valid command.
+    '''
+    end = len(data)
+    while end and (data[end - 1] == 10 or data[end - 1] == 13): # CR LF
+        end -= 1
+    view = memoryview(data)
+    find = data.find
+    pos = 0
+
+    # Prefix
+    prefix = None
+    if end and data[0] == _COLON:
+        space = find(b' ', 1, end)
+        if space < 0:
+            return None
+        prefix = view[1 : space]
+        pos = space + 1
+
+    # Command
+    while pos < end and data[pos] == _SPACE:
+        pos += 1
+    space = find(b' ', pos, end)
+    if space < 0:
+        space = end
+    command = data[pos : space]
+    if not (command.isalpha() or (len(command) == 3 and command.isdigit())):
+        return None
+    pos = space
+
+    # Params
+    params = []
+    while pos < end:
+        while pos < end and data[pos] == _SPACE:
+            pos += 1
+        if pos == end:
+            break
+        if data[pos] == _COLON:
+            params.append(view[pos + 1 : end])
+            break
+        if len(params) == _MAXMIDDLE:
+            params.append(view[pos : end])
+            break
+        space = find(b' ', pos, end)
+        if space < 0:
+            space = end
+        params.append(view[pos : space])
+        pos = space
+
+    return prefix, command.decode('ascii'), params
+
+def decode(field: Optional[memoryview]) -> Optional[str]:
+    '''Decode a field returned by parse_message.'''
+    if field is None:
+        return None
+    return str(field, 'utf-8', 'ignore')
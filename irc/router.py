@@ -13,14 +13,9 @@ class EntityRouter(object):
     def __init__(self, *paths: Tuple[Tuple[str, dict]]):
         self.paths = dict(paths)
 
-    def __contains__(self, name: str):
+    def find(self, name: str):
+        '''Entity named name, or None.'''
         prefix = name[0]
         if prefix in self.paths:
-            return name in self.paths[prefix]
-        return name in self.paths['']
-
-    def __getitem__(self, name: str):
-        prefix = name[0]
-        if prefix in self.paths:
-            return self.paths[prefix][name]
-        return self.paths[''][name]
+            return self.paths[prefix].find(name)
+        return self.paths[''].find(name)
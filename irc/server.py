@@ -1,17 +1,30 @@
 # coding: utf-8
 
 from .connection import Connection
-from .util import LowerCaseDict
+from .casemapping import casefolder, IdentityIndex
 from .channel import ChannelCatalog
 from .router import EntityRouter
+from .parser import parse_message
+from .metrics import MetricsRegistry
+from .timers import TimerWheel
+from .cluster import ClusterCoordinator, ClusterLink
+from .flood import FloodClass, load_flood_classes
+from .fanout import FanoutQueue
+from .instrumentation import LoopLagProbe, MeteredIOStream, MetricsEndpoint
+from .journal import ChannelJournal
+from .handoff import HandoffListener, Handoff
+from .admission import RegistrationAdmission
+from .welcome import WelcomeBurst, MotdFile
+from .accept import AcceptLimiter
+from .messages import format_message
 
 from tornado.tcpserver import TCPServer
 from tornado import gen
 from tornado.iostream import StreamClosedError, UnsatisfiableReadError
 
-from typing import Undefined
+from typing import Undefined, List, Dict, Set, Callable
 import logging
-import re
+import time
 import sys
 import os.path
 
@@ -22,30 +35,112 @@ __all__ = ['IRCServer']
 class IRCServer(object):
     tcpserver = Undefined('IRCTCPServer')
     name = Undefined(str)
+    prefix = Undefined(bytes)
     date = Undefined(str)
     version = 'tornadoirc-0.0'
     usermodes = 'aiwroO'
     usermodes_restricted_add = 'aoO'
     usermodes_restricted_rem = 'ar'
     channelmodes = 'beiklmIov'
-    users = Undefined(dict)
+    fold = Undefined(Callable[[str], str])
+    users = Undefined(IdentityIndex)
+    connections = Undefined(Set[Connection])
     channels = Undefined(ChannelCatalog)
     router = Undefined(EntityRouter)
+    metrics = Undefined(MetricsRegistry)
+    timers = Undefined(TimerWheel)
+    floodclasses = Undefined(Dict[str, FloodClass])
+    fanout = Undefined(FanoutQueue)
+    looplag = Undefined(LoopLagProbe)
+    admission = Undefined(RegistrationAdmission)
+    welcome = Undefined(WelcomeBurst)
+    motdfile = None
+    limiter = Undefined(AcceptLimiter)
+    endpoint = None
+    handoff = None
+    started = Undefined(float)
+    cluster = None
 
     def __init__(self, settings):
         self.tcpserver = IRCTCPServer(self)
         self.settings = settings
         self.name = settings['name']
+        self.prefix = (':%s ' % self.name).encode('utf-8')
         self.date = settings['date']
-        self.users = LowerCaseDict()
+        self.fold = casefolder(settings['casemapping'])
+        self.users = IdentityIndex(self.fold)
+        self.connections = set()
         self.channels = ChannelCatalog(server = self)
         self.router = EntityRouter(('',  self.users),
                                    ('#', self.channels))
+        self.metrics = MetricsRegistry(
+                            sample_rate = settings['metricsamplerate'])
+        self.timers = TimerWheel()
+        self.timers.start()
+        self.floodclasses = load_flood_classes(settings)
+        self.fanout = FanoutQueue(slice = settings['fanoutslice'],
+                                  metrics = self.metrics)
+        self.looplag = LoopLagProbe(interval = settings['looplaginterval'],
+                                    metrics = self.metrics)
+        self.looplag.start()
+        self.admission = RegistrationAdmission(
+                             window = settings['registrationwindow'],
+                             metrics = self.metrics)
+        self.limiter = AcceptLimiter(settings)
+        self.welcome = WelcomeBurst(self)
+        if settings['motdfile']:
+            self.motdfile = MotdFile(path = settings['motdfile'],
+                                     burst = self.welcome)
+            self.motdfile.start()
+        self.started = time.time()
 
     def listen(self, *args, **kwargs):
         '''Listen to address and port.'''
         self.tcpserver.listen(*args, **kwargs)
 
+    def add_sockets(self, sockets: List['socket']):
+        '''Accept connections on already bound sockets.'''
+        self.tcpserver.add_sockets(sockets)
+
+    def serve_metrics(self, port: int, address: str = '127.0.0.1'):
+        '''Serve metrics over HTTP on a loopback address.'''
+        self.endpoint = MetricsEndpoint(server = self)
+        self.endpoint.listen(port, address = address)
+
+    def listen_handoff(self, path: str):
+        '''Let a new server process take over through Unix socket path.'''
+        self.handoff = HandoffListener(server = self, path = path)
+        self.handoff.start()
+
+    def take_over(self, handoff: Handoff):
+        '''Carry on serving what was handed off by the previous server
+        process. The channel journal, if any, must be loaded first.'''
+        self.add_sockets(handoff.listeners)
+        if handoff.endpoint:
+            self.endpoint = MetricsEndpoint(server = self)
+            self.endpoint.add_sockets(handoff.endpoint)
+        handoff.restore(self)
+
+    def load_channel_state(self, path: str):
+        '''Restore and keep saving channel state in journal file path.'''
+        journal = ChannelJournal(path = path, fold = self.fold)
+        journal.load()
+        journal.start()
+        self.channels.journal = journal
+
+    def flood_class(self, address: str) -> FloodClass:
+        '''Flood class of new connections from address.'''
+        for floodclass in self.floodclasses.values():
+            if address in floodclass.hosts:
+                return floodclass
+        return self.floodclasses['default']
+
+    def join_cluster(self, coordinator: ClusterCoordinator,
+                     worker_id: int, workers: int):
+        '''Run as worker_id of a multi-process cluster.'''
+        self.cluster = ClusterLink(server = self, coordinator = coordinator,
+                                   worker_id = worker_id, workers = workers)
+
 class IRCTCPServer(TCPServer):
     ircserver = None
 
@@ -53,57 +148,114 @@ class IRCTCPServer(TCPServer):
         super().__init__(*args, **kwargs)
         self.ircserver = ircserver
 
-    message_regex = re.compile(
-        r'(?P<prefix>:\S+)?'
-        r'[ ]*'
-        r'(?P<command>[a-zA-Z]+|[0-9]{3})'
-        r'[ ]*'
-        r'(?P<params>[\S: ]+)?'
-    )
+    # Max bytes taken from the stream buffer per read in batch mode
+    read_batch_size = 65536
+
+    # ERROR text of connections refused, by AcceptLimiter reason
+    refusals = {
+        'host': 'Too many connections from your host',
+        'network': 'Too many connections from your network',
+        'rate': 'Server is busy, try again later',
+    }
+
+    def _handle_connection(self, connection, address):
+        '''Refuse connections past the accept limits, and wrap accepted
+        sockets in streams counting their syscalls.'''
+        # Overrides a private TCPServer method, with the signature and the
+        # non-SSL path of tornado 4.2 (pinned in requirements.txt): TCPServer
+        # has no stream factory, and refusing here happens before any stream
+        # or Connection is allocated. Recheck it when upgrading tornado.
+        reason = self.ircserver.limiter.admit(address[0])
+        if reason:
+            self.refuse(connection, address, reason)
+            return
+        if self.ssl_options is not None:
+            return super()._handle_connection(connection, address)
+        try:
+            future = self.handle_stream(self.make_stream(connection), address)
+            self.io_loop.add_future(future, lambda f: f.result())
+        except Exception:
+            logger.error('Error in connection callback', exc_info = True)
+
+    def refuse(self, connection: 'socket', address: tuple, reason: str):
+        '''Close a connection over the accept limits, with an ERROR line
+        if the socket takes it right away.'''
+        server = self.ircserver
+        server.metrics.counter('connections_rejected', reason).inc()
+        message = format_message('CMD_ERROR', server.prefix,
+                                 {'ipaddr': address[0],
+                                  'text': self.refusals[reason]})
+        try:
+            connection.setblocking(False)
+            connection.send(message)
+        except OSError:
+            pass
+        connection.close()
+
+    def make_stream(self, connection: 'socket') -> MeteredIOStream:
+        return MeteredIOStream(connection, io_loop = self.io_loop,
+                               max_buffer_size = self.max_buffer_size,
+                               read_chunk_size = self.read_chunk_size,
+                               metrics = self.ircserver.metrics)
 
-    @gen.coroutine
     def handle_stream(self, stream, address):
         connection = Connection(stream = stream,
                                 address = address[0],
                                 port = address[1],
                                 server = self.ircserver)
         logger.info('Connection from %s', address[0])
+        return self.serve(connection)
+
+    @gen.coroutine
+    def serve(self, connection: Connection):
+        '''Read and process messages from connection until it closes.
+
+        Lines read but not processed yet wait in connection.pending, so
+        they are never only held by this coroutine (see irc.handoff).
+        '''
+        self.ircserver.connections.add(connection)
+        stream = connection.stream
+        pending = connection.pending
+        batchread = self.ircserver.settings['batchread']
         while True:
-            # Receive message
+            # Receive messages
             try:
-                data = yield stream.read_until(b'\n', max_bytes = 512)
-                data = data.decode('utf-8', 'ignore')
-                data = data.rstrip('\r\n')
+                if stream.closed() or not pending:
+                    if batchread:
+                        yield self.read_lines(connection)
+                    else:
+                        yield self.read_line(connection)
 
-                # Parse message
-                match = self.message_regex.match(data)
-                if not match:
-                    continue
+                while pending and not stream.closed():
+                    data = pending.popleft()
+                    connection.lines_in += 1
+                    if len(data) >= 512:
+                        raise UnsatisfiableReadError(
+                                'Line exceeds 512 bytes')
 
-                prefix, command, param_str = match.groups()
+                    # Parse message
+                    message = parse_message(data)
+                    if not message:
+                        continue
+                    prefix, command, params = message
 
-                if prefix:
-                    prefix = prefix.split(':', maxsplit = 1)[1].rstrip()
-                param_str = param_str if param_str else ''
+                    # Delgate handling of message
+                    connection.on_read(prefix, command, params)
 
-                params = []
-                autoword = True
-                for word in param_str.split(' '):
-                    if not word:
-                        continue
-                    if autoword or (word[0] == ':'):
-                        if word[0] == ':':
-                            autoword = False
-                            word = word.split(':')[1] if len(word) > 1 else ''
-                        params.append(word)
-                    else:
-                        params[-1] = '%s %s' % (params[-1], word)
+                    # Wait for a command completing asynchronously
+                    if connection.suspended is not None:
+                        yield connection.suspended
 
-                # Delgate handling of message
-                connection.on_read(prefix, command, params)
+                    # Flood control: stop reading until back within budget
+                    delay = connection.charge(command)
+                    if delay:
+                        yield connection.throttle(delay)
             except StreamClosedError:
+                handoff = self.ircserver.handoff
+                if handoff is not None and handoff.done:
+                    return # carried on by the new server process
                 connection.on_close()
-                logger.info('Connection from %s closed.', address[0])
+                logger.info('Connection from %s closed.', connection.address)
                 return
             except UnsatisfiableReadError:
                 stream.close()
@@ -114,4 +266,44 @@ class IRCTCPServer(TCPServer):
                 error_line = sys.exc_info()[2].tb_lineno
                 logger.info('IOStream read loop failed at %s (line: %s): %s',
                             error_file, error_line, error_desc)
+                self.ircserver.connections.discard(connection)
+                self.ircserver.limiter.release(connection.address)
                 return
+
+    @gen.coroutine
+    def read_lines(self, connection: Connection):
+        '''Read whatever is available on stream and split it in lines.
+
+        Complete lines go to connection.pending (without the trailing
+        LF); a partial line is kept in connection.readbuf until the next
+        read.
+        '''
+        connection.reading = connection.stream.read_bytes(
+                                 self.read_batch_size, partial = True)
+        data = yield connection.reading
+        connection.reading = None
+        connection.bytes_in += len(data)
+        lines = (connection.readbuf + data).split(b'\n')
+        connection.readbuf = lines.pop()
+        if len(connection.readbuf) >= 512:
+            lines.append(connection.readbuf)
+            connection.readbuf = b''
+        connection.pending.extend(lines)
+
+    @gen.coroutine
+    def read_line(self, connection: Connection):
+        '''Read a single line to connection.pending (without the trailing
+        LF, as read_lines does).
+
+        Only a connection taken over from another process can have a
+        partial line in connection.readbuf; it is completed here.
+        '''
+        connection.reading = connection.stream.read_until(b'\n',
+                                                          max_bytes = 512)
+        data = yield connection.reading
+        connection.reading = None
+        connection.bytes_in += len(data)
+        if connection.readbuf:
+            data = connection.readbuf + data
+            connection.readbuf = b''
+        connection.pending.append(data[:-1])
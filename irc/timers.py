@@ -0,0 +1,138 @@
+# coding: utf-8
+
+from tornado.ioloop import PeriodicCallback
+
+from typing import Undefined, Optional, Callable, List, Set
+from math import ceil
+import logging
+import time
+import sys, os
+
+logger = logging.getLogger('tornado.general')
+
+__all__ = ['TimerWheel', 'Deadline']
+
+class Deadline(object):
+    '''Callback armed on a TimerWheel.'''
+    __slots__ = ('expires', 'callback', 'slot')
+
+    def __init__(self, expires: int, callback: Callable):
+        self.expires = expires # type: int
+        self.callback = callback # type: Callable
+        self.slot = None # type: Optional[Set[Deadline]]
+
+class TimerWheel(object):
+    '''Hierarchical timer wheel ticking every resolution seconds.
+
+    Level 0 has one slot per tick; each slot of level n spans a whole
+    turn of level n - 1 and is cascaded down when level n - 1 wraps
+    around. Arming and cancelling a deadline are O(1) and all deadlines
+    expiring on the same tick are fired together, from a single IOLoop
+    periodic callback, instead of one IOLoop timeout each.
+    '''
+    resolution = Undefined(float)
+    slots = Undefined(int)
+    wheels = Undefined(List[List[Set[Deadline]]])
+    current = Undefined(int)
+    started = Undefined(float)
+    periodic = Undefined(Optional[PeriodicCallback])
+
+    def __init__(self, resolution: float = 1.0, slots: int = 64,
+                 levels: int = 3):
+        self.resolution = resolution
+        self.slots = slots
+        self.wheels = [[set() for _ in range(slots)] for _ in range(levels)]
+        self.current = 0
+        self.started = time.monotonic()
+        self.periodic = None
+
+    def __len__(self):
+        return sum(len(slot) for wheel in self.wheels for slot in wheel)
+
+    def start(self):
+        '''Start ticking on the current IOLoop.'''
+        if self.periodic:
+            return
+        self.periodic = PeriodicCallback(self.tick, self.resolution * 1e3)
+        self.periodic.start()
+
+    def stop(self):
+        if self.periodic:
+            self.periodic.stop()
+            self.periodic = None
+
+    def call_later(self, delay: float, callback: Callable) -> Deadline:
+        '''Run callback after delay seconds (rounded up to a tick).'''
+        ticks = max(1, int(ceil(delay / self.resolution)))
+        # From the current time: the wheel may lag behind it
+        deadline = Deadline(expires = self._now() + ticks,
+                            callback = callback)
+        self._insert(deadline)
+        return deadline
+
+    def remove_timeout(self, deadline: Deadline):
+        '''Cancel deadline if it\'s still armed.'''
+        if deadline.slot is not None:
+            deadline.slot.discard(deadline)
+            deadline.slot = None
+
+    def tick(self):
+        '''Advance the wheel up to the current time, firing deadlines.'''
+        now = self._now()
+        while self.current < now:
+            self.current += 1
+            self._cascade()
+            slot = self.wheels[0][self.current % self.slots]
+            expired = list(slot)
+            slot.clear()
+            for deadline in expired:
+                deadline.slot = None
+                self._run(deadline)
+
+    def _now(self) -> int:
+        '''Tick of the current time.'''
+        return int((time.monotonic() - self.started) / self.resolution)
+
+    def _insert(self, deadline: Deadline):
+        '''Put deadline on the lowest level whose turn holds it.'''
+        expires = deadline.expires
+        slots = self.slots
+        levels = len(self.wheels)
+        span = 1
+        for level in range(levels):
+            if (expires // (span * slots) == self.current // (span * slots) or
+                level == levels - 1):
+                slot = self.wheels[level][(expires // span) % slots]
+                slot.add(deadline)
+                deadline.slot = slot
+                return
+            span *= slots
+
+    def _cascade(self):
+        '''Move deadlines down from upper level slots that are now due.'''
+        slots = self.slots
+        due = []
+        span = slots
+        for level in range(1, len(self.wheels)):
+            if self.current % span:
+                break
+            due.append((level, span))
+            span *= slots
+
+        # Upper levels first, as they may cascade into lower due slots
+        for level, span in reversed(due):
+            slot = self.wheels[level][(self.current // span) % slots]
+            pending = list(slot)
+            slot.clear()
+            for deadline in pending:
+                self._insert(deadline)
+
+    def _run(self, deadline: Deadline):
+        try:
+            deadline.callback()
+        except Exception as e:
+            error_file = os.path.basename(
+                            sys.exc_info()[2].tb_next.tb_frame.f_code.co_filename)
+            error_line = sys.exc_info()[2].tb_next.tb_lineno
+            logger.info('Timer callback failed at %s (line: %s), %s: %s',
+                        error_file, error_line, type(e).__name__, e)
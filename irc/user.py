@@ -1,63 +1,88 @@
 # coding: utf-8
 
 from .exceptions import *
-from .util import LowerCaseDict
-from .util import log_exceptions
+from .casemapping import IdentityIndex
+from .util import log_exceptions, build_dispatch_table
+from .messages import format_message
+from .timers import Deadline
+from .welcome import Splice
+from .instrumentation import throttled_clients
 
-from tornado.ioloop import IOLoop
+from tornado import gen
 
-from typing import Undefined, Optional, List, Tuple
+from typing import Undefined, Optional, List, Tuple, Dict, Set
 from random import randint
+from hmac import compare_digest
 import logging
 import re
 
 logger = logging.getLogger('tornado.general')
 
 class User(object):
-    _nick = Undefined(Optional[str])
-    hopcount = Undefined(int)
-    username = Undefined(Optional[str])
-    hostname = Undefined(Optional[str])
-    servername = Undefined(Optional[str])
-    realname = Undefined(Optional[str])
-    connection = Undefined('Connection')
-    server = Undefined('IRCServer')
-    channels = Undefined(LowerCaseDict)
-    pingtimer = None
-    timeouttimer = None
-    modes = Undefined(set)
+    __slots__ = ('_nick', 'folded', '_address', '_folded_address',
+                 'hopcount', 'username', 'hostname', 'servername', 'realname',
+                 'connection', 'server', 'channels', 'pingtimer',
+                 'timeouttimer', 'modes')
+    commands = Undefined(Dict[str, 'CommandHandler'])
 
     ##
     # Nick getter and setter
     ##
-    _nick_regex = re.compile(r'(\w+)')
+    # A letter or special, then letters, digits, specials or '-'
+    _nick_regex = re.compile(r'([A-Za-z\[\]\\`_^{|}][\w\[\]\\`^{|}-]*)')
 
     @property
     def nick(self):
         return self._nick
 
-    @nick.setter
-    def nick(self, value):
-        '''Validate and set nick value.'''
-        match = self._nick_regex.match(value)
+    @classmethod
+    def parse_nick(cls, value: str, nicklen: int) -> str:
+        '''Valid part of nick value, up to nicklen characters.'''
+        match = cls._nick_regex.match(value)
         if not match:
             raise ErroneousNicknameError(value)
         value = match.groups()[0]
+        return value[0 : min(len(value), nicklen)]
+
+    @nick.setter
+    def nick(self, value):
+        '''Validate and set nick value.
 
-        nicklen = self.server.settings['nicklen']
-        value = value[0 : min(len(value), nicklen)]
+        In a cluster, the nick must have been claimed already (see
+        ClusterLink.claim_nick).
+        '''
+        value = self.parse_nick(value, self.server.settings['nicklen'])
 
-        if value.lower() == self._nick.lower():
+        folded = self.server.fold(value)
+        if folded == self.folded:
             return
 
-        if value in self.server.users:
+        if folded in self.server.users:
             raise NicknameInUseError(value)
 
         self._nick = value
+        self.folded = folded
+        self._address = None
+        self._folded_address = None
 
     @property
-    def address(self):
-        return '%s!%s@%s' % (self.nick, self.username, self.hostname)
+    def address(self) -> str:
+        '''nick!user@host hostmask, cached until the nick changes.'''
+        if self._address is None:
+            self._address = '%s!%s@%s' % (self.nick, self.username,
+                                          self.hostname)
+        return self._address
+
+    @property
+    def folded_address(self) -> str:
+        '''Hostmask folded with the server casemapping, for mask matching.'''
+        if self._folded_address is None:
+            self._folded_address = self.server.fold(self.address)
+        return self._folded_address
+
+    @property
+    def is_operator(self):
+        return 'o' in self.modes or 'O' in self.modes
 
     ##
     # Init
@@ -65,17 +90,22 @@ class User(object):
     def __init__(self, nick: str, connection: 'Connection', server: 'Server',
                  hopcount: int, username: str, hostname: str, servername: str,
                  realname: str):
-        self.connection = connection
-        self.server = server
+        self.connection = connection # type: Connection
+        self.server = server # type: IRCServer
         self._nick = ''
+        self.folded = '' # nick folded with the server casemapping
+        self._address = None # type: Optional[str]
+        self._folded_address = None # type: Optional[str]
         self.nick = nick
-        self.hopcount = hopcount
-        self.username = username
-        self.hostname = hostname
-        self.servername = servername
-        self.realname = realname
-        self.channels = LowerCaseDict()
-        self.modes = set()
+        self.hopcount = hopcount # type: int
+        self.username = username # type: Optional[str]
+        self.hostname = hostname # type: Optional[str]
+        self.servername = servername # type: Optional[str]
+        self.realname = realname # type: Optional[str]
+        self.channels = IdentityIndex(server.fold) # {'#channel': Membership}
+        self.pingtimer = None # type: Optional[Deadline]
+        self.timeouttimer = None # type: Optional[Deadline]
+        self.modes = '' # mode chars
 
         logger.info('Registered new user: %s!%s@%s',
                     self.nick, self.username, self.hostname)
@@ -93,18 +123,20 @@ class User(object):
         self.send_welcome()
 
     def on_close(self):
-        io_loop = IOLoop.current()
+        timers = self.server.timers
         if self.pingtimer:
-            io_loop.remove_timeout(self.pingtimer)
+            timers.remove_timeout(self.pingtimer)
             self.pingtimer = None
         if self.timeouttimer:
-            io_loop.remove_timeout(self.timeouttimer)
-            self.timeoutttimer = None
+            timers.remove_timeout(self.timeouttimer)
+            self.timeouttimer = None
 
         self.quit(message = 'Connection reset by peer.')
 
         # Remove nick from server catalog
-        del self.server.users[self.nick]
+        del self.server.users[self.folded]
+        if self.server.cluster:
+            self.server.cluster.release_nick(self.nick)
 
     ##
     # Server send msg commands
@@ -114,34 +146,35 @@ class User(object):
         self.connection.send_message(*args, **kwargs)
 
     def schedule_ping(self):
-        io_loop = IOLoop.current()
+        timers = self.server.timers
 
         # Disable previous timers
         if self.pingtimer:
-            io_loop.remove_timeout(self.pingtimer)
+            timers.remove_timeout(self.pingtimer)
 
         interval = self.server.settings['pinginterval']
         interval = randint(0.5 * interval, 1.5 * interval)
-        self.pingtimer = io_loop.call_later(
+        self.pingtimer = timers.call_later(
                             interval,
                             self.send_ping)
 
     def send_ping(self):
         '''Send PING to user'''
+        self.pingtimer = None
         if self.connection.stream.closed():
             return
-        io_loop = IOLoop.current()
+        timers = self.server.timers
 
         # Disable previous timeouts
         if self.timeouttimer:
-            io_loop.remove_timeout(self.timeouttimer)
+            timers.remove_timeout(self.timeouttimer)
 
         # Send PING
         self.send_message('CMD_PING')
 
         # Setup timeout timer
         timeout = self.server.settings['pingtimeout']
-        self.timeouttimer = io_loop.call_later(
+        self.timeouttimer = timers.call_later(
                                 timeout,
                                 self.timeout)
 
@@ -149,19 +182,20 @@ class User(object):
         '''Disconnect user for timeout.'''
         self.quit(message = 'Ping timeout')
 
+    def send_splice(self, splice: Splice):
+        '''Send precomputed lines of the server welcome burst to user.'''
+        values = self.server.welcome.values(self)
+        self.connection.send_raw(splice.fill(values), lines = splice.lines)
+
     def send_welcome(self):
         '''Send welcome messages to user.'''
-        self.send_message('RPL_WELCOME')
-        self.send_message('RPL_YOURHOST', version = self.server.version)
-        self.send_message('RPL_CREATED', date = self.server.date)
-        self.send_message('RPL_MYINFO',
-                          date = self.server.date,
-                          version = self.server.version,
-                          usermodes = self.server.usermodes,
-                          channelmodes = self.server.channelmodes)
-
-        self.cmd_lusers()
-        self.cmd_motd()
+        welcome = self.server.welcome
+        self.send_splice(welcome.welcome)
+        self.send_splice(welcome.lusers)
+        if welcome.motd is not None:
+            self.send_splice(welcome.motd)
+        else:
+            self.send_message('ERR_NOMOTD')
         self.schedule_ping()
 
     def send_privmsg(self, sender: str, recipient: str, text: str):
@@ -178,18 +212,42 @@ class User(object):
                           recipient = recipient,
                           text = text)
 
+    def neighbours(self) -> Set['Connection']:
+        '''Connections of the local users sharing a channel with this user.'''
+        connections = set()
+        for membership in self.channels.values():
+            connections.update(member.user.connection
+                               for member in membership.channel.users.values())
+        connections.discard(self.connection)
+        return connections
+
+    def send_neighbours(self, msgid: str, origin: Optional[str] = None,
+                        **params):
+        '''Send message once to every user sharing a channel with this
+        user, here and on the other cluster workers (which know the user
+        as origin, by default its nick).'''
+        params['servername'] = self.server.name
+        message = format_message(msgid, self.server.prefix, params)
+        self.server.fanout.deliver(message, list(self.neighbours()))
+        if self.server.cluster:
+            self.server.cluster.neighbour_message(origin or self.nick,
+                                                  message)
+
     def quit(self, message: str = ''):
         '''QUIT user (called by cmd_quit, ping timeout, conn reset etc).'''
         # Leave channels
-        channels = self.channels
-        channels = [channels[name] for name in channels]
+        if self.channels:
+            self.send_neighbours('CMD_QUIT', useraddr = self.address,
+                                 message = message)
+        channels = [membership.channel
+                    for membership in self.channels.values()]
 
         for channel in channels:
-            channel.quit(self, message = message)
+            channel.quit(self)
 
         # Close connection
         self.send_message('CMD_ERROR', text = 'Quit: %s' % message)
-        self.connection.stream.close()
+        self.connection.close()
 
     ##
     # Server command handlers
@@ -202,28 +260,42 @@ class User(object):
 
     def cmd_pong(self, payload: str):
         if self.timeouttimer:
-            IOLoop.current().remove_timeout(self.timeouttimer)
+            self.server.timers.remove_timeout(self.timeouttimer)
             self.timeouttimer = None
         self.schedule_ping()
 
     def cmd_privmsg(self, target: str, text: str):
         '''Process PRIVMSG command.'''
-        if target not in self.server.router:
-            raise NoSuchNickError(nick = target)
-        entity = self.server.router[target]
+        entity = self.server.router.find(target)
+        if entity is None:
+            if not self._relay_message('CMD_PRIVMSG', target, text):
+                raise NoSuchNickError(nick = target)
+            return
         entity.send_privmsg(sender = self.address,
                             recipient = target,
                             text = text)
 
     def cmd_notice(self, target: str, text: str):
         '''Process NOTICE command.'''
-        if target not in self.server.router:
+        entity = self.server.router.find(target)
+        if entity is None:
+            self._relay_message('CMD_NOTICE', target, text)
             return
-        entity = self.server.router[target]
         entity.send_notice(sender = self.address,
                            recipient = target,
                            text = text)
 
+    def _relay_message(self, msgid: str, target: str, text: str) -> bool:
+        '''Relay message to a user connected to another worker.'''
+        cluster = self.server.cluster
+        if not cluster or target[0] == '#':
+            return False
+        message = format_message(msgid, self.server.prefix,
+                                 {'sender': self.address,
+                                  'recipient': target,
+                                  'text': text})
+        return cluster.private_message(target, message)
+
     def cmd_profiling(self):
         '''Process PROFILING command.'''
         import yappi
@@ -250,25 +322,79 @@ class User(object):
     ##
     def cmd_nick(self, nick: str):
         '''Process NICK command.'''
+        cluster = self.server.cluster
+        if cluster is None:
+            self.rename(nick)
+            return
+
+        # Claim the new nick across the cluster first
+        nick = self.parse_nick(nick, self.server.settings['nicklen'])
+        folded = self.server.fold(nick)
+        if folded == self.folded:
+            self.rename(nick)
+            return
+        if folded in self.server.users:
+            raise NicknameInUseError(nick)
+
+        def claimed(success: bool):
+            if not success:
+                raise NicknameInUseError(nick)
+            if self.server.users.get(self.folded) is not self:
+                cluster.release_nick(nick) # quit meanwhile
+                return
+            try:
+                self.rename(nick)
+            except CommandError:
+                cluster.release_nick(nick)
+                raise
+        self.connection.suspend(cluster.claim_nick(nick), claimed)
+
+    def rename(self, nick: str):
+        '''Change nick, telling the user and its neighbours.'''
         oldaddr = self.address
         oldnick = self.nick
+        oldkey = self.folded
         self.nick = nick
-        if self.nick.lower() != oldnick.lower():
-            self.server.users[self.nick] = self
-            del self.server.users[oldnick]
+        if self.folded != oldkey:
+            self.server.users[self.folded] = self
+            del self.server.users[oldkey]
+            if self.channels:
+                self.send_neighbours('CMD_NICK', origin = oldnick,
+                                     oldaddr = oldaddr, nick = self.nick)
+            cluster = self.server.cluster
+            if cluster:
+                cluster.release_nick(oldnick)
+                cluster.nick_change(oldnick, self.nick)
+            for membership in list(self.channels.values()):
+                membership.channel.rename_user(self, oldkey)
 
         self.send_message('CMD_NICK', oldaddr = oldaddr, nick = self.nick)
 
+    def cmd_oper(self, name: str, password: str):
+        '''Process OPER command.'''
+        operators = self.server.settings['operators']
+        if (name not in operators or
+            not compare_digest(operators[name].encode('utf-8'),
+                               password.encode('utf-8'))):
+            raise PasswdMismatchError()
+        if 'o' in self.modes:
+            return
+        self.modes += 'o'
+        self.connection.set_flood_class('operator')
+        self.send_message('RPL_YOUREOPER')
+        self.send_message('CMD_MODE', sender = self.nick,
+                          recipient = self.nick, modes = '+o')
+
     @log_exceptions
     def cmd_mode(self, target: str, *modes: Tuple[str]):
         '''Process MODE command.'''
-        if target.lower() != self.nick.lower():
+        if self.server.fold(target) != self.folded:
             if target[0] != '#':
                 return
-            if target not in self.channels:
+            membership = self.channels.find(target)
+            if membership is None:
                 raise NotOnChannelError(channel = target)
-            #logger.info('%s %s %s', self, modes, self.channels[target].mode)
-            self.channels[target].mode(user = self, modes = modes)
+            membership.channel.mode(user = self, modes = modes)
             return
 
         if not modes:
@@ -292,13 +418,13 @@ class User(object):
             if m in usermodes:
                 if add and m not in usermodes_restricted_add:
                     if m not in self.modes:
-                        self.modes.add(m)
+                        self.modes += m
                         added.add(m)
                         if m in removed:
                             removed.remove(m)
                 if not add and m not in usermodes_restricted_add:
                     if m in self.modes:
-                        self.modes.remove(m)
+                        self.modes = self.modes.replace(m, '')
                         removed.add(m)
                         if m in added:
                             added.remove(m)
@@ -321,7 +447,8 @@ class User(object):
     def cmd_join(self, channels: str, keys: Optional[str] = None):
         '''Process JOIN Command.'''
         if channels == '0':
-            channels = [name for name in self.channels]
+            channels = [membership.channel.name
+                        for membership in self.channels.values()]
             channels = ','.join(channels)
             self.cmd_part(channels)
             return
@@ -347,20 +474,21 @@ class User(object):
 
         # Part channels
         for name in channels:
-            if name not in self.channels:
+            membership = self.channels.find(name)
+            if membership is None:
                 raise NotOnChannelError(channel = name)
-            channel = self.channels[name]
-            channel.part(user = self, message = message)
+            membership.channel.part(user = self, message = message)
 
     @log_exceptions
     def cmd_topic(self, channel: str, topic: Optional[str] = None):
         '''Process TOPIC command.'''
-        if channel not in self.channels:
+        membership = self.channels.find(channel)
+        if membership is None:
             raise NotOnChannelError(channel = channel)
         if topic == None:
-            self.channels[channel].send_topic(user = self)
+            membership.channel.send_topic(user = self)
             return
-        self.channels[channel].set_topic(user = self, topic = topic)
+        membership.channel.set_topic(user = self, topic = topic)
 
     @log_exceptions
     def cmd_names(self, channels: Optional[str] = None,
@@ -373,13 +501,15 @@ class User(object):
         '''
         userchannels = self.channels
         if not channels:
-            chanlist = list(userchannels.keys())
+            chanlist = [membership.channel.name
+                        for membership in userchannels.values()]
         else:
             chanlist = channels.split(',')
 
         for name in chanlist:
-            if name in userchannels:
-                userchannels[name].send_names(user = self, suppress_end = True)
+            membership = userchannels.find(name)
+            if membership is not None:
+                membership.channel.send_names(user = self, suppress_end = True)
         self.send_message('RPL_ENDOFNAMES',
                           channel = channels if channels else '*')
 
@@ -388,14 +518,47 @@ class User(object):
                  target: Optional[str] = None):
         '''Process LIST command.
 
-        This method violates RFC2812 in the sense that it always sends 0
-        as the number of visible members of the channel.
+        channels may hold channel names, masks and the ELIST conditions
+        understood by ChannelDirectory.search. Secret channels are only
+        listed to their members.
         '''
-        chancatalog = self.server.channels
-        for name in chancatalog:
-            topic = chancatalog[name].topic
-            self.send_message('RPL_LIST', channel = name, visible = 0,
-                              topic = topic if topic else '')
+        directory = self.server.channels.directory
+        matches = directory.search(channels or '')
+        self._send_list(matches)
+
+    # Seconds between checks of a LIST reply waiting on the client
+    list_interval = 0.05
+
+    @gen.coroutine
+    def _send_list(self, channels: List['Channel']):
+        '''Send RPL_LIST replies for channels, a chunk at a time.
+
+        Once a quarter of the send queue limit is pending (or anything is
+        queued in server.fanout), wait for the client to read it down to
+        half that before going on, so a long list neither blocks the
+        IOLoop nor overflows the send queue.
+        '''
+        connection = self.connection
+        chunk = self.server.settings['sendq'] // 4
+        for channel in channels:
+            if connection.sendq_exceeded or connection.stream.closed():
+                return
+            if channel.catalog is None: # gone meanwhile
+                continue
+            if channel.secret and self.folded not in channel.users:
+                continue
+            self.send_message('RPL_LIST', channel = channel.name,
+                              visible = len(channel.users),
+                              topic = channel.topic or '')
+            # Polled: tornado 4.2 orphans an earlier write future when a
+            # later write comes in. Replies sent while fan-out deliveries
+            # are queued for the client go through server.fanout, out of
+            # the backlog, so those are waited for too.
+            if connection.queued or connection.backlog() >= chunk:
+                while ((connection.queued or
+                        connection.backlog() >= chunk // 2) and
+                       not connection.stream.closed()):
+                    yield gen.sleep(self.list_interval)
         self.send_message('RPL_LISTEND')
 
     ##
@@ -403,23 +566,66 @@ class User(object):
     ##
     def cmd_motd(self, target: Optional[str] = None):
         '''Process MOTD command.'''
-        if not self.server.settings['motd']:
+        motd = self.server.welcome.motd
+        if motd is None:
             raise NoMotdError()
-        self.send_message('RPL_MOTDSTART')
-        for text in self.server.settings['motd']:
-            self.send_message('RPL_MOTD', text = text[0 : min(len(text) + 1, 81)])
-        self.send_message('RPL_ENDOFMOTD')
+        self.send_splice(motd)
 
     def cmd_lusers(self, mask: Optional[str] = None,
                    target: Optional[str] = None):
         '''Process LUSERS command.'''
-        self.send_message('RPL_LUSERCLIENT',
-                          usercount = len(self.server.users),
-                          servicescount = 0,
-                          serverscount = 1)
-        self.send_message('RPL_LUSERME',
-                          usercount = len(self.server.users),
-                          serverscount = 0)
+        self.send_splice(self.server.welcome.lusers)
+
+    def cmd_stats(self, query: Optional[str] = None,
+                  target: Optional[str] = None):
+        '''Process STATS command.
+
+        Supported queries (operators only):
+          m - number of times each command was processed;
+          L - sampled latency percentiles of each command and of the
+              IOLoop lag;
+          f - flood control pauses, and clients throttled now, per class.
+        '''
+        if target != None and target != self.server.name:
+            raise NoSuchServerError(server = target)
+        if not self.is_operator:
+            raise NoPrivilegesError()
+
+        query = query[0] if query else '*'
+        metrics = self.server.metrics
+        if query == 'm':
+            counters = metrics.counters.get('commands', {})
+            for command in sorted(counters):
+                self.send_message('RPL_STATSCOMMANDS', command = command,
+                                  count = counters[command].value,
+                                  bytecount = 0, remotecount = 0)
+        elif query == 'L':
+            histograms = metrics.histograms.get('command_latency', {})
+            for command in sorted(histograms):
+                histogram = histograms[command]
+                self.send_message('RPL_STATSDEBUG',
+                                  text = '%s count=%s p50=%sms p99=%sms' % (
+                                      command, histogram.count,
+                                      format(histogram.percentile(50) * 1e3, '.2f'),
+                                      format(histogram.percentile(99) * 1e3, '.2f')))
+            looplag = metrics.histograms.get('loop_lag', {}).get('')
+            if looplag is not None:
+                self.send_message('RPL_STATSDEBUG',
+                                  text = 'loop lag count=%s p50=%sms p99=%sms' % (
+                                      looplag.count,
+                                      format(looplag.percentile(50) * 1e3, '.2f'),
+                                      format(looplag.percentile(99) * 1e3, '.2f')))
+        elif query == 'f':
+            pauses = metrics.counters.get('flood_throttled', {})
+            clients = throttled_clients(self.server)
+            for name in sorted(self.server.floodclasses):
+                floodclass = self.server.floodclasses[name]
+                self.send_message('RPL_STATSDEBUG',
+                                  text = '%s rate=%s burst=%s pauses=%s clients=%s' % (
+                                      name, floodclass.rate, floodclass.burst,
+                                      pauses[name].value if name in pauses else 0,
+                                      clients[name]))
+        self.send_message('RPL_ENDOFSTATS', query = query)
 
     def cmd_version(self, target: Optional[str] = None):
         '''Process VERSION command.'''
@@ -444,9 +650,9 @@ class User(object):
             mask = par1
         nick = mask.split('!')[0]
 
-        if nick not in self.server.users:
+        user = self.server.users.find(nick)
+        if user is None:
             raise NoSuchNickError(nick = nick)
-        user = self.server.users[nick]
 
         self.send_message('RPL_WHOISUSER', nick = user.nick,
                           username = user.username, hostname = user.hostname,
@@ -455,8 +661,8 @@ class User(object):
                           servername = user.servername,
                           serverinfo = '')
         if user.channels:
-            chandict = user.channels
-            channels = (chandict[name].name for name in chandict)
+            channels = (membership.channel.name
+                        for membership in user.channels.values())
             self.send_message('RPL_WHOISCHANNELS', nick = user.nick,
                               iterator = channels)
 
@@ -470,6 +676,9 @@ class User(object):
         nicklist = list(nicklist)
         nicklist.insert(0, nick)
         users = self.server.users
-        online = [nick for nick in nicklist if nick in users]
+        online = [nick for nick in nicklist if users.fold(nick) in users]
         online = ' '.join(online)
         self.send_message('RPL_ISON', nicklist = online)
+
+# Commands handled by registered users: {'PRIVMSG': CommandHandler, ...}
+User.commands = build_dispatch_table(User, skip = 1)
@@ -2,7 +2,9 @@
 
 from .exceptions import CommandError
 
-from inspect import signature
+from typing import Dict
+from inspect import signature, getfullargspec
+from collections import namedtuple
 import functools, sys, os
 import logging
 
@@ -28,48 +30,26 @@ def log_exceptions(f):
     wrapper.__signature__ = signature(f)
     return wrapper
 
-class LowerCaseDict(dict):
-    '''Dict compatible class that convert str keys to lower case keys.'''
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        for key in self:
-            lc = key.lower()
-            if key != lc:
-                super().__setitem__(lc, super().__getitem__(key))
-                super().__delitem__(key)
-
-    def __contains__(self, key, *args, **kwargs):
-        return super().__contains__(key.lower(), *args, **kwargs)
-
-    def __delitem__(self, key, *args, **kwargs):
-        return super().__delitem__(key.lower(), *args, **kwargs)
-
-    def __getitem__(self, key, *args, **kwargs):
-        return super().__getitem__(key.lower(), *args, **kwargs)
-
-    def __setitem__(self, key, *args, **kwargs):
-        super().__setitem__(key.lower(), *args, **kwargs)
-
-    def fromkeys(self, iterable, *args, **kwargs):
-        iterable = (x.lower() for x in iterable)
-        return super().fromkeys(iterable, *args, **kwargs)
-
-    def get(self, k, *args, **kwargs):
-        return super().get(k.lower(), *args, **kwargs)
-
-    def pop(self, k, *args, **kwargs):
-        return super().pop(k.lower(), *args, **kwargs)
-
-    def setdefault(self, k, *args, **kwargs):
-        return super().setdefault(k.lower(), *args, **kwargs)
-
-    def update(self, E = None, **F):
-        if E:
-            if hasattr(E, 'keys'):
-                for k in E:
-                    self[k] = E[k]
-            else:
-                for k, v in E:
-                    self[k] = v
-        for k in F:
-            self[k] = F[k]
+CommandHandler = namedtuple('CommandHandler',
+                            ['function', 'minparams', 'maxparams', 'varargs'])
+
+def build_dispatch_table(cls: type, skip: int) -> Dict[str, CommandHandler]:
+    '''Map upper-cased command names to the cmd_* methods of cls.
+
+    skip is the number of leading arguments filled in by the caller
+    (self, prefix, ...), which don\'t count as command params.
+    '''
+    table = {}
+    for methodname in dir(cls):
+        if not methodname.startswith('cmd_'):
+            continue
+        function = getattr(cls, methodname)
+        args, varargs, _, defaults, _, _, _ = getfullargspec(function)
+        argnum = len(args) if args else 0
+        defnum = len(defaults) if defaults else 0
+        table[methodname[4:].upper()] = CommandHandler(
+                                            function = function,
+                                            minparams = argnum - defnum - skip,
+                                            maxparams = argnum - skip,
+                                            varargs = bool(varargs))
+    return table
@@ -0,0 +1,178 @@
+# coding: utf-8
+
+from .messages import templates
+
+from tornado.ioloop import PeriodicCallback
+
+from typing import Undefined, Optional, List, Dict, Tuple
+from functools import reduce
+import operator
+import logging
+import os
+import re
+
+logger = logging.getLogger('tornado.general')
+
+__all__ = ['Splice', 'WelcomeBurst', 'MotdFile']
+
+class Splice(object):
+    '''Encoded lines with slots filled in when sent.
+
+    parts are the encoded text around the slots: parts[i] comes before
+    slots[i], and parts[-1] after the last one.
+    '''
+    __slots__ = ('parts', 'slots', 'lines')
+    _field_regex = re.compile(r'%\((\w+)\)s')
+
+    def __init__(self, parts: List[bytes], slots: List[str], lines: int):
+        self.parts = parts # type: List[bytes]
+        self.slots = slots # type: List[str]
+        self.lines = lines # type: int
+
+    @classmethod
+    def render(cls, msgid: str, prefix: bytes, params: dict,
+               slots: Dict[str, str]) -> 'Splice':
+        '''Render message msgid, leaving the fields named in slots (as
+        {field: slot name}) to be filled in when sent.'''
+        template = templates[msgid]
+        pieces = cls._field_regex.split(template.body)
+        parts = [prefix] if template.prefixed else [b'']
+        names = []
+        for index, piece in enumerate(pieces):
+            if index % 2 == 0:
+                parts[-1] += (piece % params).encode('utf-8')
+            elif piece in slots:
+                names.append(slots[piece])
+                parts.append(b'')
+            else:
+                parts[-1] += str(params[piece]).encode('utf-8')
+        return cls(parts, names, 1)
+
+    def __add__(self, other: 'Splice') -> 'Splice':
+        parts = self.parts[:-1]
+        parts.append(self.parts[-1] + other.parts[0])
+        parts.extend(other.parts[1:])
+        return Splice(parts, self.slots + other.slots,
+                      self.lines + other.lines)
+
+    def fill(self, values: Dict[str, bytes]) -> bytes:
+        parts = self.parts
+        chunks = [parts[0]]
+        for index, name in enumerate(self.slots, 1):
+            chunks.append(values[name])
+            chunks.append(parts[index])
+        return b''.join(chunks)
+
+class WelcomeBurst(object):
+    '''Lines sent on registration (RPL_WELCOME to RPL_MYINFO, LUSERS and
+    the MOTD), encoded once per server, with the nick, address and user
+    count of each user spliced in.
+
+    The MOTD part is rebuilt by set_motd when the MOTD changes.
+    '''
+    welcome = Undefined(Splice)
+    lusers = Undefined(Splice)
+    motd = Undefined(Optional[Splice]) # None if there's no MOTD
+    params = Undefined(dict)
+    prefix = Undefined(bytes)
+
+    # Message fields filled in for each user, as {field: slot name}
+    slots = {'target': 'nick', 'targetaddr': 'address', 'usercount': 'users'}
+
+    # Characters that can't go in a line, dropped from the MOTD text
+    unsafe = {ord(char): None for char in '\0\r\n'}
+
+    def __init__(self, server: 'IRCServer'):
+        self.prefix = server.prefix
+        self.params = {'servername': server.name,
+                       'version': server.version,
+                       'date': server.date,
+                       'usermodes': server.usermodes,
+                       'channelmodes': server.channelmodes,
+                       'servicescount': 0,
+                       'serverscount': 1}
+
+        self.welcome = self._render('RPL_WELCOME', 'RPL_YOURHOST',
+                                    'RPL_CREATED', 'RPL_MYINFO')
+        self.lusers = (self._render('RPL_LUSERCLIENT') +
+                       self._render('RPL_LUSERME', serverscount = 0))
+        self.set_motd(server.settings['motd'])
+
+    def _render(self, *msgids: str, **extra) -> Splice:
+        params = dict(self.params, **extra)
+        splices = [Splice.render(msgid, self.prefix, params, self.slots)
+                   for msgid in msgids]
+        return reduce(operator.add, splices)
+
+    def set_motd(self, motd: Optional[List[str]]):
+        '''Encode MOTD lines (None or empty for no MOTD).'''
+        if not motd:
+            self.motd = None
+            return
+        lines = [self._render('RPL_MOTDSTART')]
+        for text in motd:
+            text = text.translate(self.unsafe)
+            lines.append(self._render('RPL_MOTD',
+                                      text = text[0 : min(len(text) + 1, 81)]))
+        lines.append(self._render('RPL_ENDOFMOTD'))
+        self.motd = reduce(operator.add, lines)
+
+    def values(self, user: 'User') -> Dict[str, bytes]:
+        return {'nick': user.nick.encode('utf-8'),
+                'address': user.address.encode('utf-8'),
+                'users': str(len(user.server.users)).encode('ascii')}
+
+class MotdFile(object):
+    '''MOTD read from a text file, checked for changes every interval
+    seconds and loaded into a WelcomeBurst when it changes.
+
+    A missing or unreadable file leaves the server without a MOTD.
+    '''
+    path = Undefined(str)
+    burst = Undefined(WelcomeBurst)
+    stamp = None # type: Optional[Tuple[int, int, int]]
+    periodic = None # type: Optional[PeriodicCallback]
+
+    # Seconds between checks of the file
+    interval = 5.0
+
+    def __init__(self, path: str, burst: WelcomeBurst):
+        self.path = path
+        self.burst = burst
+
+    def start(self):
+        self.check()
+        if self.periodic is None:
+            self.periodic = PeriodicCallback(self.check, self.interval * 1e3)
+            self.periodic.start()
+
+    def stop(self):
+        if self.periodic is not None:
+            self.periodic.stop()
+            self.periodic = None
+
+    def check(self):
+        '''Reload the MOTD if the file changed.'''
+        try:
+            stat = os.stat(self.path)
+            stamp = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        except OSError:
+            stamp = None
+        if stamp == self.stamp:
+            return
+        self.stamp = stamp
+
+        motd = None
+        if stamp is not None:
+            try:
+                with open(self.path, encoding = 'utf-8',
+                          errors = 'replace') as motdfile:
+                    motd = motdfile.read().splitlines()
+            except OSError as e:
+                logger.warning('MOTD file %s: %s', self.path, e)
+        else:
+            logger.warning('MOTD file %s is missing', self.path)
+        self.burst.set_motd(motd)
+        if motd is not None:
+            logger.info('MOTD loaded from %s (%s lines)', self.path,
+                        len(motd))
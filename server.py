@@ -4,11 +4,15 @@
 import settings
 from settings import ircd as ircdsettings
 from irc.server import IRCServer
+from irc.cluster import ClusterCoordinator
+from irc.handoff import receive_handoff
 
 from setproctitle import setproctitle # pylint: disable=no-name-in-module
 from tornado.options import define, options
 from tornado.ioloop import IOLoop
 from tornado import autoreload
+from tornado.netutil import bind_sockets
+from tornado.process import fork_processes, cpu_count
 
 def main() -> None:
     '''Runs server'''
@@ -18,6 +22,11 @@ def main() -> None:
                default = False,
                help = 'run in production mode',
                type = bool)
+    define('takeover',
+               default = False,
+               help = 'take over from the running server through its '
+                      'handoff socket',
+               type = bool)
     options.parse_command_line()
 
     # Set server name
@@ -26,20 +35,71 @@ def main() -> None:
         setproctitle(pname)
 
     # Register IRC server
-    server = IRCServer(settings = ircdsettings)
-    for address, port in ircdsettings['listen']:
-        server.listen(port, address = address)
+    workers = ircdsettings['workers']
+    handoff = None
+    if workers == 1:
+        server = IRCServer(settings = ircdsettings)
+        if options.takeover:
+            handoff = receive_handoff(ircdsettings['handoff'])
+        else:
+            for address, port in ircdsettings['listen']:
+                server.listen(port, address = address)
+    else:
+        if options.takeover:
+            raise SystemExit('--takeover requires workers = 1')
+
+        # Bind sockets and start state coordinator before forking workers
+        workers = workers or cpu_count()
+        sockets = []
+        for address, port in ircdsettings['listen']:
+            sockets.extend(bind_sockets(port, address = address))
+        coordinator = ClusterCoordinator(rundir = ircdsettings['rundir'])
+        coordinator.start()
+        worker_id = fork_processes(workers)
+
+        server = IRCServer(settings = ircdsettings)
+        server.join_cluster(coordinator = coordinator,
+                            worker_id = worker_id, workers = workers)
+        server.add_sockets(sockets)
+
+    # Restore channel state
+    if ircdsettings['channeljournal']:
+        path = ircdsettings['channeljournal']
+        if workers != 1:
+            path += '.%d' % worker_id
+        server.load_channel_state(path)
+        autoreload.add_reload_hook(server.channels.journal.close)
+
+    # Carry on from the previous server process
+    if handoff is not None:
+        server.take_over(handoff)
+
+    # Serve metrics
+    if ircdsettings['metricslisten'] and server.endpoint is None:
+        address, port = ircdsettings['metricslisten']
+        if workers != 1:
+            port += worker_id
+        server.serve_metrics(port, address = address)
+
+    # Let the next server process take over (not supported by workers)
+    if workers == 1 and ircdsettings['handoff']:
+        server.listen_handoff(ircdsettings['handoff'])
 
     # Start profiling
     if settings.profiling:
         import yappi
         yappi.start()
 
-    # Setup autoreload
-    autoreload.start()
+    # Setup autoreload (not supported by forked workers)
+    if workers == 1:
+        autoreload.start()
 
     # Run application
-    IOLoop.instance().start()
+    try:
+        IOLoop.instance().start()
+    finally:
+        if server.channels.journal is not None:
+            server.channels.journal.close()
 
 if __name__ == '__main__':
     main()
@@ -23,11 +23,61 @@ ircd = {
     'motd': ['Welcome to my humble server!',
              'This server is a test version of tornadoirc',
              'If you find any issues, please report to the developer.'],
+    # Text file to read the MOTD from instead, reloaded when it changes
+    'motdfile': None,
     'nicklen': 30,
+    'casemapping': 'rfc1459', # ascii, rfc1459 or strict-rfc1459
     'chanlen': 50,
     'pinginterval': 120,
     'pingtimeout': 60,
     'chanlimit': 100,
+    'batchread': True,
+    'sendq': 1048576,
+    # Flood control: tokens per second and bucket size of each class of
+    # connections (no rate: unlimited); hosts lists addresses put in the
+    # class on connect, operators move to the operator class on OPER
+    'floodclasses': {
+        'default': {'rate': 2.0, 'burst': 20},
+        'operator': {'rate': None},
+    },
+    # Tokens taken by each command (1 if not listed); classes may override
+    # them with a 'penalties' dict of their own
+    'floodpenalties': {'PONG': 0, 'PING': 0.5, 'JOIN': 2, 'PART': 1,
+                       'NICK': 3, 'NAMES': 2, 'WHO': 2, 'WHOIS': 2,
+                       'LIST': 10},
+    'metricsamplerate': 1.0,
+    # Prometheus /metrics and /connections over HTTP, on a loopback
+    # address (worker n of a cluster listens on port + n); None disables
+    'metricslisten': ('127.0.0.1', 9667),
+    'looplaginterval': 0.5,
+    # Writes of a channel message fan-out done per IOLoop iteration; the
+    # rest is written in the following ones
+    'fanoutslice': 1000,
+    # Registrations in progress at once (until the welcome burst is written
+    # out); past that, new clients wait their turn, taken round-robin across
+    # source addresses
+    'registrationwindow': 256,
+    # Connections refused on accept past maxperhost open ones from the same
+    # address, maxpernetwork from the same network (networkprefix bits, for
+    # IPv4 and IPv6), or acceptrate new ones per second server-wide (in
+    # bursts of acceptburst); None disables a limit. Networks (CIDR) in
+    # acceptexempt are not limited
+    'maxperhost': 10,
+    'maxpernetwork': 50,
+    'networkprefix': (24, 64),
+    'acceptrate': 100.0,
+    'acceptburst': 500,
+    'acceptexempt': ['127.0.0.0/8', '::1/128'],
+    'logcommands': False,
+    'operators': {},
+    'workers': 1,
+    'rundir': '/tmp/tornadoircd',
+    # Journal of channel topics, modes and ban/except/invite lists, kept
+    # across restarts (worker n of a cluster uses path.n); None disables
+    'channeljournal': '/tmp/tornadoircd/channels.journal',
+    # Unix socket a new server process started with --takeover gets the
+    # listening sockets, connections and state from; None disables
+    'handoff': '/tmp/tornadoircd/handoff.sock',
 }
 
 ##
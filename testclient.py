@@ -1,60 +1,404 @@
+#!/usr/bin/env python3
 # coding: utf-8
+'''Load generator and benchmark harness for tornadoirc.
+
+Connects a number of clients to a local server, makes them join channels
+picked from a uniform or zipf distribution and talk, churn (part/join)
+and send NAMES, LIST and WHOIS at the given per-client rates. Messages
+carry a timestamp, so the clients receiving them measure end-to-end
+delivery latency. Every --report seconds (and at the end, when
+--duration is set) it prints throughput, latency percentiles and, with
+--server-pid, the server RSS and CPU usage.
+
+With --takeover, the server is upgraded (./server.py --takeover) that
+many seconds into the run, and the final report tells whether any client
+was disconnected or missed channel messages: each client numbers the
+messages it sends to each channel, and receivers count the gaps.
+
+Example: ./testclient.py --clients=2000 --channels=50 --joins=2 \\
+             --distribution=zipf --rate=0.5 --duration=60 --server-pid=1234
+         ./testclient.py --clients=500 --rate=1 --duration=20 --takeover=5
+'''
+
+from irc.metrics import MetricsRegistry
 
 from tornado.tcpclient import TCPClient
+from tornado.iostream import StreamClosedError
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.options import define, options
 from tornado import gen
-from tornado.iostream import StreamClosedError, UnsatisfiableReadError
-from tornado.ioloop import IOLoop
-from random import randint
-
-@gen.coroutine
-def ircbot(nick: str, channel: str, master: str):
-    io_loop = IOLoop.current()
-    while True:
+
+from typing import Undefined, List, Dict
+from collections import deque
+from bisect import bisect
+import subprocess
+import random
+import shlex
+import time
+import os
+import sys
+
+define('host', default = '127.0.0.1', help = 'server address')
+define('port', default = 6667, help = 'server port')
+define('clients', default = 90, help = 'number of clients')
+define('connect_rate', default = 200.0,
+       help = 'new connections per second while ramping up')
+define('channels', default = 1, help = 'number of channels')
+define('joins', default = 1, help = 'channels joined by each client')
+define('distribution', default = 'uniform',
+       help = 'channel popularity: uniform or zipf')
+define('zipf_s', default = 1.0, help = 'exponent of the zipf distribution')
+define('rate', default = 1 / 180,
+       help = 'channel messages per second, per client')
+define('churn', default = 0.0,
+       help = 'part/join cycles per second, per client')
+define('names', default = 0.0, help = 'NAMES per second, per client')
+define('list', default = 0.0, help = 'LIST per second, per client')
+define('whois', default = 0.0, help = 'WHOIS per second, per client')
+define('duration', default = 0.0,
+       help = 'seconds to run once all clients are up (0: forever)')
+define('report', default = 10.0, help = 'seconds between reports')
+define('server_pid', default = '',
+       help = 'comma separated pids of the server processes, for RSS/CPU')
+define('prefix', default = 'bench', help = 'nick and channel name prefix')
+define('takeover', default = 0.0,
+       help = 'seconds into the run to upgrade the server at (0: never)')
+define('takeover_command', default = './server.py --takeover',
+       help = 'command starting the server taking over')
+
+##
+# Channel selection
+##
+class ChannelPicker(object):
+    '''Random channel names following a popularity distribution.'''
+    names = Undefined(List[str])
+    cumulative = Undefined(List[float])
+
+    def __init__(self, count: int, distribution: str, s: float = 1.0):
+        self.names = ['#%s%d' % (options.prefix, i) for i in range(count)]
+        if distribution == 'zipf':
+            weights = [1 / (rank ** s) for rank in range(1, count + 1)]
+        elif distribution == 'uniform':
+            weights = [1.0] * count
+        else:
+            raise ValueError('Unknown distribution: %s' % distribution)
+        total = 0.0
+        self.cumulative = []
+        for weight in weights:
+            total += weight
+            self.cumulative.append(total)
+
+    def pick(self) -> str:
+        point = random.random() * self.cumulative[-1]
+        index = min(bisect(self.cumulative, point), len(self.names) - 1)
+        return self.names[index]
+
+##
+# Clients
+##
+class BenchClient(object):
+    '''Client connection driven by the benchmark.'''
+    nick = Undefined(str)
+    bench = Undefined('Benchmark')
+    stream = None
+    channels = Undefined(List[str])
+    pending = Undefined(Dict[str, deque]) # {'366': deque([(time, 'join')])}
+    sequences = Undefined(Dict[str, int]) # {channel: last number sent}
+    seen = Undefined(Dict[str, Dict[str, int]]) # {channel: {nick: number}}
+    registered = False
+
+    # Replies ending a query, and errors ending it early
+    query_ends = ('366', '323', '318')
+    query_errors = {'401': '318', '403': '366', '471': '366', '473': '366',
+                    '474': '366', '475': '366'}
+
+    def __init__(self, nick: str, bench: 'Benchmark'):
+        self.nick = nick
+        self.bench = bench
+        self.channels = []
+        self.pending = {numeric: deque() for numeric in self.query_ends}
+        self.sequences = {}
+        self.seen = {}
+
+    def send(self, line: str):
+        if self.stream is None or self.stream.closed():
+            return
+        self.stream.write(('%s\r\n' % line).encode('utf-8'))
+
+    @gen.coroutine
+    def run(self):
+        metrics = self.bench.metrics
         try:
-            stream = yield TCPClient().connect('127.0.0.1', 6667)
-            stream.write(('NICK %s\r\n' % nick).encode('utf-8'))
-            stream.write(b'USER bot * * :IRC Bot\r\n')
-            ret = None
-            while True:
+            self.stream = yield TCPClient().connect(options.host,
+                                                    options.port)
+        except (StreamClosedError, OSError):
+            metrics.counter('connect_errors').inc()
+            return
+        self.send('NICK %s' % self.nick)
+        self.send('USER %s * * :Benchmark client' % options.prefix)
+
+        while True:
+            try:
+                line = yield self.stream.read_until(b'\r\n')
+            except StreamClosedError:
+                break
+            self.on_line(line.decode('utf-8', 'ignore').rstrip('\r\n'))
+
+        if self.registered:
+            self.bench.connected -= 1
+        metrics.counter('disconnects').inc()
+
+    def on_line(self, line: str):
+        bench = self.bench
+        fields = line.split(' ', 3)
+        if fields[0] == 'PING':
+            self.send('PONG %s' % fields[1])
+            return
+        if len(fields) < 2:
+            return
+        kind = fields[1]
+
+        if kind == 'PRIVMSG':
+            bench.metrics.counter('received').inc()
+            text = fields[3].split(' ')
+            if text[0] == ':bench' and len(text) == 3:
                 try:
-                    data = yield stream.read_until(b'\r\n', max_bytes = 512)
-                    data = data.decode('utf-8', 'ignore')
-                    data = data.rstrip('\r\n')
-                    datalist = data.split(' ')
-
-                    # Answer to PING
-                    if datalist[0] == 'PING':
-                        stream.write(('PONG %s\r\n' % datalist[1]).encode('utf-8'))
-                        continue
-
-                    # Join channel when motd ends
-                    if channel and datalist[1] == '376' or datalist[1] == '422':
-                        stream.write(('JOIN %s\r\n' % channel).encode('utf-8'))
-                        def talk():
-                            stream.write(('PRIVMSG %s :just babbling\r\n' % channel).encode('utf-8'))
-                            io_loop.call_later(randint(1, 359), talk)
-                        talk()
-                        continue
-
-                    # Die on command
-                    if (datalist[0].split('!')[0] == (':%s' % master) and
-                        (datalist[1] == 'PRIVMSG' or datalist[1] == 'NOTICE') and
-                        datalist[3].lstrip(':') == '!die'):
-                        stream.write(b'QUIT :I\'m a good bot and I obey my master.\r\n')
-                        stream.close()
-                except UnsatisfiableReadError:
-                    raise UnsatisfiableReadError(data)
-        except StreamClosedError:
-            yield gen.sleep(1)
-            continue
-
-@gen.coroutine
+                    latency = time.perf_counter() - float(text[1])
+                    number = int(text[2])
+                except ValueError:
+                    return
+                bench.metrics.histogram('delivery').observe(latency)
+                self.check_sequence(fields[0][1:].split('!', 1)[0],
+                                    fields[2], number)
+            return
+        if kind in self.query_errors:
+            kind = self.query_errors[kind]
+        if kind in self.pending:
+            pending = self.pending[kind]
+            if pending:
+                sent, name = pending.popleft()
+                bench.metrics.histogram(name).observe(time.perf_counter() -
+                                                      sent)
+            return
+        if kind in ('376', '422') and not self.registered:
+            self.on_register()
+
+    def on_register(self):
+        self.registered = True
+        self.bench.connected += 1
+        for _ in range(options.joins):
+            self.join(self.bench.picker.pick())
+        self.schedule(options.rate, self.talk)
+        self.schedule(options.churn, self.churn)
+        self.schedule(options.names, self.query_names)
+        self.schedule(options.list, self.query_list)
+        self.schedule(options.whois, self.query_whois)
+
+    def schedule(self, rate: float, action):
+        '''Run action at random (Poisson) intervals averaging 1 / rate.'''
+        if rate <= 0:
+            return
+        def run():
+            if self.stream.closed():
+                return
+            action()
+            IOLoop.current().call_later(random.expovariate(rate), run)
+        IOLoop.current().call_later(random.expovariate(rate), run)
+
+    def check_sequence(self, nick: str, channel: str, number: int):
+        '''Count the messages from nick to channel missed before this one.'''
+        seen = self.seen.setdefault(channel, {})
+        last = seen.get(nick)
+        if last is not None and number > last + 1:
+            self.bench.metrics.counter('lost').inc(number - last - 1)
+        seen[nick] = number
+
+    def join(self, channel: str):
+        if channel in self.channels:
+            return
+        self.channels.append(channel)
+        # Messages sent while out of channel aren't missed ones
+        self.seen.pop(channel, None)
+        self.send('JOIN %s' % channel)
+        # JOIN replies end with the names list
+        self.pending['366'].append((time.perf_counter(), 'join'))
+
+    ##
+    # Actions
+    ##
+    def talk(self):
+        if not self.channels:
+            return
+        channel = random.choice(self.channels)
+        number = self.sequences[channel] = self.sequences.get(channel, 0) + 1
+        self.send('PRIVMSG %s :bench %.6f %d' % (channel, time.perf_counter(),
+                                                 number))
+        self.bench.metrics.counter('sent').inc()
+
+    def churn(self):
+        if self.channels:
+            channel = self.channels.pop(random.randrange(len(self.channels)))
+            self.send('PART %s' % channel)
+        self.join(self.bench.picker.pick())
+        self.bench.metrics.counter('churn').inc()
+
+    def query_names(self):
+        if not self.channels:
+            return
+        self.send('NAMES %s' % random.choice(self.channels))
+        self.pending['366'].append((time.perf_counter(), 'names'))
+
+    def query_list(self):
+        self.send('LIST')
+        self.pending['323'].append((time.perf_counter(), 'list'))
+
+    def query_whois(self):
+        self.send('WHOIS %s' % self.bench.random_nick())
+        self.pending['318'].append((time.perf_counter(), 'whois'))
+
+##
+# Benchmark
+##
+class ServerProcess(object):
+    '''RSS and CPU time of a server process, read from /proc.'''
+    pid = Undefined(int)
+    ticks = os.sysconf('SC_CLK_TCK')
+    pagesize = os.sysconf('SC_PAGE_SIZE')
+
+    def __init__(self, pid: int):
+        self.pid = pid
+
+    def rss(self) -> int:
+        '''Resident set size, in bytes.'''
+        with open('/proc/%d/statm' % self.pid) as statm:
+            return int(statm.read().split()[1]) * self.pagesize
+
+    def cpu(self) -> float:
+        '''User plus system CPU time, in seconds.'''
+        with open('/proc/%d/stat' % self.pid) as stat:
+            fields = stat.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / self.ticks
+
+class Benchmark(object):
+    metrics = Undefined(MetricsRegistry)
+    picker = Undefined(ChannelPicker)
+    clients = Undefined(List[BenchClient])
+    servers = Undefined(List[ServerProcess])
+    successor = None # server process started by take_over
+    connected = 0
+    started = Undefined(float)
+    baseline = Undefined(tuple) # (time, sent, received, cpu)
+    last = Undefined(tuple)
+
+    def __init__(self):
+        self.metrics = MetricsRegistry()
+        self.picker = ChannelPicker(options.channels, options.distribution,
+                                    options.zipf_s)
+        self.clients = [BenchClient('%s%d' % (options.prefix, i), self)
+                        for i in range(options.clients)]
+        self.servers = [ServerProcess(int(pid))
+                        for pid in options.server_pid.split(',') if pid]
+        self.reset()
+
+    def reset(self):
+        '''Start measuring from now.'''
+        self.metrics = MetricsRegistry()
+        self.started = time.monotonic()
+        self.baseline = self.last = (self.started, 0, 0, self.server_cpu())
+
+    def server_cpu(self) -> float:
+        return sum(server.cpu() for server in self.servers)
+
+    def random_nick(self) -> str:
+        return random.choice(self.clients).nick
+
+    @gen.coroutine
+    def run(self):
+        reporter = PeriodicCallback(self.report, options.report * 1e3)
+        reporter.start()
+
+        # Ramp up
+        runs = []
+        for client in self.clients:
+            runs.append(client.run())
+            yield gen.sleep(1 / options.connect_rate)
+        while self.connected < len(self.clients):
+            yield gen.sleep(0.1)
+            if all(run.done() for run in runs):
+                break
+        print('%d clients up in %.1fs' %
+              (self.connected, time.monotonic() - self.started))
+
+        # Measure
+        self.reset()
+        if options.takeover:
+            IOLoop.current().call_later(options.takeover, self.take_over)
+        if options.duration:
+            yield gen.sleep(options.duration)
+            reporter.stop()
+            self.report(final = True)
+        else:
+            yield runs
+
+    def take_over(self):
+        '''Start the server process taking over from the running one.'''
+        self.successor = subprocess.Popen(
+                             shlex.split(options.takeover_command))
+        print('takeover started, pid %d' % self.successor.pid)
+
+    def count(self, name: str) -> int:
+        counter = self.metrics.counters.get(name, {}).get('')
+        return counter.value if counter else 0
+
+    def report(self, final: bool = False):
+        now = time.monotonic()
+        counters = self.metrics.counters
+        sent = counters.get('sent', {}).get('', None)
+        received = counters.get('received', {}).get('', None)
+        sent = sent.value if sent else 0
+        received = received.value if received else 0
+        cpu = self.server_cpu()
+        since, lastsent, lastreceived, lastcpu = (self.baseline if final
+                                                  else self.last)
+        self.last = (now, sent, received, cpu)
+        elapsed = max(now - since, 1e-9)
+
+        print('%s %.0fs clients=%d sent=%.0f/s delivered=%.0f/s' %
+              ('TOTAL' if final else 'report', now - self.started,
+               self.connected, (sent - lastsent) / elapsed,
+               (received - lastreceived) / elapsed))
+        for name in ('delivery', 'join', 'names', 'list', 'whois'):
+            histogram = self.metrics.histograms.get(name, {}).get('')
+            if histogram is None or not histogram.count:
+                continue
+            print('  %-8s n=%d p50=%.2fms p90=%.2fms p99=%.2fms' %
+                  (name, histogram.count, histogram.percentile(50) * 1e3,
+                   histogram.percentile(90) * 1e3,
+                   histogram.percentile(99) * 1e3))
+        if self.servers:
+            rss = sum(server.rss() for server in self.servers)
+            print('  server rss=%.1fMiB cpu=%.0f%%' %
+                  (rss / 2 ** 20, (cpu - lastcpu) / elapsed * 100))
+        if options.takeover:
+            print('  disconnects=%d lost=%d' %
+                  (self.count('disconnects'), self.count('lost')))
+
+    def survived(self) -> bool:
+        '''Whether the new server took over, with no client disconnected
+        nor missing a message.'''
+        if self.successor is None or self.successor.poll() is not None:
+            print('takeover process not running')
+            return False
+        return not (self.count('disconnects') or self.count('lost'))
+
 def main():
-    count = 90
-    channel = '#channel%s' % randint(int(1e6), int(1e7))
-    yield [ircbot(nick = 'Bot%s' % randint(int(1e6), int(1e7)),
-                  channel = channel,
-                  master = 'BotMaster')
-           for i in range(count)]
-
-IOLoop.instance().run_sync(main)
+    options.parse_command_line()
+    bench = Benchmark()
+    IOLoop.current().run_sync(bench.run)
+    if options.takeover:
+        survived = bench.survived()
+        print('takeover %s' % ('OK' if survived else 'FAILED'))
+        sys.exit(0 if survived else 1)
+
+if __name__ == '__main__':
+    main()